@@ -0,0 +1,85 @@
+"""Admission filter for advertisements, run before any vendor decoding."""
+from device_state import mac_to_int
+
+# admission flags
+ADMIT_SENSOR = 1
+ADMIT_TRACKER = 2
+
+
+def oui_to_int(oui):
+    """Return an OUI (MAC prefix as bytes, hex string or int) as a 24-bit integer."""
+    if isinstance(oui, int):
+        return oui
+    if isinstance(oui, str):
+        return int(oui.replace(":", "").replace("-", ""), 16)
+    return int.from_bytes(oui, "big")
+
+
+class MacSet(set):
+    """Set of MAC addresses as 48-bit integers, MACs added as bytes or hex strings are converted.
+
+    append() is kept for code written against the whitelists as lists.
+    """
+    def __init__(self, macs=()):
+        super().__init__(mac_to_int(mac) for mac in macs)
+
+    def add(self, mac):
+        super().add(mac_to_int(mac))
+
+    append = add
+
+    def discard(self, mac):
+        super().discard(mac_to_int(mac))
+
+    def remove(self, mac):
+        super().remove(mac_to_int(mac))
+
+    def update(self, *macs):
+        for iterable in macs:
+            super().update(mac_to_int(mac) for mac in iterable)
+
+
+def compile_admission_filter(
+    discovery=True,
+    sensor_whitelist=frozenset(),
+    tracker_whitelist=frozenset(),
+    oui_allow=(),
+    oui_deny=(),
+    min_rssi=None
+):
+    """Return admit(mac, rssi), a filter for the MAC (48-bit integer) and RSSI of a frame.
+
+    admit returns 0 for frames to drop, otherwise ADMIT_SENSOR and/or
+    ADMIT_TRACKER. The whitelists are used as given, so MACs added to them
+    later are taken into account.
+    """
+    oui_allow = frozenset(oui_to_int(oui) for oui in oui_allow)
+    oui_deny = frozenset(oui_to_int(oui) for oui in oui_deny)
+
+    if not oui_allow and not oui_deny and min_rssi is None:
+        # only the whitelists
+        if discovery:
+            def admit(mac, rssi):
+                return ADMIT_SENSOR | ADMIT_TRACKER if mac in tracker_whitelist else ADMIT_SENSOR
+        else:
+            def admit(mac, rssi):
+                return (
+                    (ADMIT_SENSOR if mac in sensor_whitelist else 0)
+                    | (ADMIT_TRACKER if mac in tracker_whitelist else 0)
+                )
+        return admit
+
+    if min_rssi is None:
+        min_rssi = -128
+
+    def admit(mac, rssi):
+        if rssi < min_rssi:
+            return 0
+        oui = mac >> 24
+        if oui in oui_deny or (oui_allow and oui not in oui_allow):
+            return 0
+        flags = ADMIT_TRACKER if mac in tracker_whitelist else 0
+        if discovery or mac in sensor_whitelist:
+            flags |= ADMIT_SENSOR
+        return flags
+    return admit
@@ -1,14 +1,164 @@
 """Parser for passive BLE advertisements."""
+from collections import deque
+from copy import copy
+import importlib
 import logging
+import threading
+from time import perf_counter
 
-from miscale import parse_miscale
-from xiaomi import parse_xiaomi
+from admission import ADMIT_SENSOR, ADMIT_TRACKER, MacSet, compile_admission_filter
+from device_state import DeviceStateTable, format_mac, mac_to_int
+from metrics import (
+    DROP_FILTERED,
+    DROP_INVALID_LENGTH,
+    DROP_REPEAT,
+    DROP_UNKNOWN_ADVERTISEMENT,
+    DROP_VENDOR_UNAVAILABLE,
+    ParserMetrics,
+)
+from readings import Reading
 
 _LOGGER = logging.getLogger(__name__)
 
+# Diagnostics levels
+# off: no diagnostic work at all, debug: structured records in BleParser.diagnostic_records
+DIAGNOSTICS_OFF = 0
+DIAGNOSTICS_DEBUG = 1
+
+# Vendor parsers, imported on the first advertisement of the vendor
+# {vendor: (module, parser function)}
+VENDOR_MODULES = {
+    "atc": ("atc", "parse_atc"),
+    "bluemaestro": ("bluemaestro", "parse_bluemaestro"),
+    "brifit": ("brifit", "parse_brifit"),
+    "govee": ("govee", "parse_govee"),
+    "inode": ("inode", "parse_inode"),
+    "kegtron": ("kegtron", "parse_kegtron"),
+    "miscale": ("miscale", "parse_miscale"),
+    "moat": ("moat", "parse_moat"),
+    "qingping": ("qingping", "parse_qingping"),
+    "ruuvitag": ("ruuvitag", "parse_ruuvitag"),
+    "sensorpush": ("sensorpush", "parse_sensorpush"),
+    "teltonika": ("teltonika", "parse_teltonika"),
+    "thermoplus": ("thermoplus", "parse_thermoplus"),
+    "xiaogui": ("xiaogui", "parse_xiaogui"),
+    "xiaomi": ("xiaomi", "parse_xiaomi"),
+}
+
+
+def load_vendor_parser(vendor):
+    """Import the parser function of a vendor, return None if it isn't available."""
+    try:
+        module_name, function_name = VENDOR_MODULES[vendor]
+    except KeyError:
+        _LOGGER.warning("Unknown vendor %s", vendor)
+        return None
+    try:
+        return getattr(importlib.import_module(module_name), function_name)
+    except (ImportError, AttributeError) as error:
+        _LOGGER.warning("No parser available for %s advertisements: %s", vendor, error)
+        return None
+
+# Service data (AD type 0x16) dispatch table
+# {UUID16: (vendor, parse whole payload)}
+SERVICE_DATA_UUIDS = {
+    0xFFF9: ("qingping", False),  # Cleargrass
+    0xFDCD: ("qingping", False),  # Qingping
+    0x181A: ("atc", False),
+    0xFE95: ("xiaomi", False),
+    0x181D: ("miscale", False),  # Mi Scale V1
+    0x181B: ("miscale", False),  # Mi Scale V2
+    0xFEAA: ("ruuvitag", False),  # Ruuvitag V2/V4
+    # Teltonika can contain multiple sevice data payloads in one advertisement
+    0x2A6E: ("teltonika", True),
+    0x2A6F: ("teltonika", True),
+}
+
+# 128-bit service UUID (AD type 0x06) dispatch table
+# {reversed UUID128: (vendor, parse whole payload)}
+SERVICE_UUIDS_128 = {
+    b'\xb0\x0a\x09\xec\xd7\x9d\xb8\x93\xba\x42\xd6\x11\x00\x00\x09\xef': ("sensorpush", True),
+}
+
+# Manufacturer specific data (AD type 0xFF) dispatch table
+# {(AD structure length, company id): vendor}, a length of None matches any length
+MANUFACTURER_IDS = {
+    (0x1E, 0xFFFF): "kegtron",
+    (0x15, 0x0010): "thermoplus",
+    (0x15, 0x0011): "thermoplus",
+    (0x0C, 0xEC88): "govee",  # H5051
+    (0x0A, 0xEC88): "govee",  # H5074
+    (0x09, 0xEC88): "govee",  # H5072/H5075
+    (0x09, 0x0001): "govee",  # H5101/H5102/H5177
+    (0x0C, 0x0001): "govee",  # H5178
+    (0x0C, 0x8801): "govee",  # H5179
+    (None, 0x0499): "ruuvitag",  # Ruuvitag V3/V5
+    (0x14, 0xAA55): "brifit",
+    (0x15, 0x1000): "moat",  # Moat S2
+    (0x11, 0x0133): "bluemaestro",
+}
+# iNode and Xiaogui only match on one byte of the company id
+MANUFACTURER_IDS.update({(0x0E, 0x8200 | low): "inode" for low in range(256)})
+MANUFACTURER_IDS.update({
+    (0x19, (high << 8) | low): "inode"  # iNode Care Sensors
+    for high in [0x91, 0x92, 0x93, 0x94, 0x95, 0x96, 0x9A, 0x9B, 0x9C, 0x9D]
+    for low in range(256)
+})
+MANUFACTURER_IDS.update({(0x10, (high << 8) | 0xC0): "xiaogui" for high in range(256)})
+
+
+def report_offsets(data):
+    """Return the offsets of the reports of an HCI LE advertising report event.
+
+    Returns [(AD payload start, AD payload size, MAC start, RSSI index)],
+    or None if the lengths in the event don't match the frame.
+    """
+    data_length = len(data)
+    # check for BTLE msg size
+    msg_length = data[2] + 3 if data_length > 4 else 0
+    num_reports = data[4] if data_length > 4 and msg_length == data_length else 0
+    # check if packet is Extended scan result
+    is_ext_packet = num_reports and data[3] == 0x0D
+    # https://www.silabs.com/community/wireless/bluetooth/knowledge-base.entry.html/2017/02/10/bluetooth_advertisin-hGsf
+    reports = []
+    report_start = 5
+    for _ in range(num_reports):
+        if is_ext_packet:
+            # event type (2), address type, address (6), PHYs (2), SID, TX power, RSSI,
+            # periodic advertising interval (2), direct address type, direct address (6), data length
+            adpayload_start = report_start + 24
+            if adpayload_start > msg_length:
+                return None
+            adpayload_size = data[adpayload_start - 1]
+            rssi_index = report_start + 13
+            mac_start = report_start + 3
+            report_start = adpayload_start + adpayload_size
+        else:
+            # event type, address type, address (6), data length, data, RSSI
+            adpayload_start = report_start + 9
+            if adpayload_start > msg_length:
+                return None
+            adpayload_size = data[adpayload_start - 1]
+            mac_start = report_start + 2
+            report_start = adpayload_start + adpayload_size + 1
+            rssi_index = report_start - 1
+        if report_start > msg_length:
+            return None
+        reports.append((adpayload_start, adpayload_size, mac_start, rssi_index))
+    if not reports or report_start != msg_length:
+        return None
+    return reports
+
 
 class BleParser:
-    """Parser for BLE advertisements"""
+    """Parser for BLE advertisements
+
+    A parser can be shared by several threads. The per-MAC state is striped
+    (state_stripes locks), the reports of a device are parsed under the lock
+    of its stripe, so threads parsing different devices rarely contend.
+    Metrics counters aren't locked and can miss counts under contention,
+    and a drop on one thread can hide a result of another.
+    """
     def __init__(
         self,
         report_unknown=False,
@@ -16,53 +166,180 @@ class BleParser:
         filter_duplicates=False,
         sensor_whitelist=[],
         tracker_whitelist=[],
-        aeskeys={}
+        aeskeys={},
+        zero_copy=False,
+        max_devices=4096,
+        device_ttl=None,
+        state_stripes=None,
+        oui_allow=[],
+        oui_deny=[],
+        min_rssi=None,
+        cache_raw=True,
+        decrypt_workers=0,
+        decrypt_batch_size=64,
+        diagnostics=DIAGNOSTICS_OFF,
+        diagnostics_buffer=1000
     ):
         self.report_unknown = report_unknown
-        self.discovery = discovery
         self.filter_duplicates = filter_duplicates
-        self.sensor_whitelist = sensor_whitelist
-        self.tracker_whitelist = tracker_whitelist
-        self.aeskeys = aeskeys
+        # parsers only build diagnostic information when diagnostics is set
+        self.diagnostics = diagnostics
+        self.diagnostic_records = deque(maxlen=diagnostics_buffer)
+        # frame, drop reason and device type counters, parse time histograms
+        self.metrics = ParserMetrics()
+        self.aeskeys = {mac_to_int(mac): key for mac, key in aeskeys.items()}
+        # devices without key or failing decryption are ignored for a backoff time
+        self.decrypt_max_failures = 3
+        self.decrypt_backoff = 60
+        self.decrypt_max_backoff = 3600
+        # parse_many decrypts MiBeacon payloads on a thread pool when decrypt_workers > 0
+        self.decrypt_workers = decrypt_workers
+        self.decrypt_batch_size = decrypt_batch_size
+        self._local = threading.local()
+        self._decryption_stage = None
+        # drop frames by MAC and RSSI before any vendor decoding, the filter is
+        # compiled again when discovery or a whitelist is set
+        # MAC addresses are handled as 48-bit integers
+        self._discovery = discovery
+        self._sensor_whitelist = MacSet(sensor_whitelist)
+        self._tracker_whitelist = MacSet(tracker_whitelist)
+        self._admission_options = (oui_allow, oui_deny, min_rssi)
+        self._compile_admission()
+        # parse a memoryview of the frame, bytes are only copied for emitted fields
+        self.zero_copy = zero_copy
 
-        self.lpacket_ids = {}
-        self.movements_list = {}
-        self.adv_priority = {}
+        # per-MAC state, bounded to max_devices and expired after device_ttl seconds idle
+        # max_devices is enforced per stripe, by default stripes hold at least 256 devices
+        if state_stripes is None:
+            state_stripes = max(1, min(16, max_devices // 256))
+        self.device_state = DeviceStateTable(max_devices, device_ttl, stripes=state_stripes)
+        self.lpacket_ids = self.device_state.column("packet")
+        self.movements_list = self.device_state.column("movements")
+        self.adv_priority = self.device_state.column("adv_priority")
+        # byte-identical repeats of the last advertisement of a device aren't decoded again
+        self.cache_raw = cache_raw
+        self.raw_payloads = self.device_state.column("raw")
+        self.raw_results = self.device_state.column("result")
+        self.aes_ciphers = self.device_state.column("cipher")
+        self.aes_failures = self.device_state.column("decrypt_failures")
 
-    def parse_data(self, data):
-        """Parse the raw data."""
-        # check if packet is Extended scan result
-        is_ext_packet = True if data[3] == 0x0D else False
-        # check for no BR/EDR + LE General discoverable mode flags
-        adpayload_start = 29 if is_ext_packet else 14
-        # https://www.silabs.com/community/wireless/bluetooth/knowledge-base.entry.html/2017/02/10/bluetooth_advertisin-hGsf
-        try:
-            adpayload_size = data[adpayload_start - 1]
-        except IndexError:
-            return None, None
-        # check for BTLE msg size
-        msg_length = data[2] + 3
-        if (
-            msg_length <= adpayload_start or msg_length != len(data) or msg_length != (
-                adpayload_start + adpayload_size + (0 if is_ext_packet else 1)
-            )
-        ):
-            print(f"msg_length={msg_length}, len(data)={len(data)}, adpayload_start={adpayload_start}, adpayload_size={adpayload_size}")
-            print(f"msg_length <= adpayload_start: {msg_length <= adpayload_start} (debe ser False)")
-            print(f"msg_length != len(data): {msg_length != len(data)} (debe ser False)")
-            print(f"msg_length != (adpayload_start + adpayload_size + (0 if is_ext_packet else 1)): {msg_length != (adpayload_start + adpayload_size + (0 if is_ext_packet else 1))} (debe ser False)")
-            return None, None
+        # dispatch tables, compiled once per parser
+        # {vendor: parser function or None if not available}, filled in on first use
+        self.vendor_parsers = {}
+        self.service_decoders = {(0x16, uuid16): decoder for uuid16, decoder in SERVICE_DATA_UUIDS.items()}
+        self.service_decoders.update({(0x06, uuid128): decoder for uuid128, decoder in SERVICE_UUIDS_128.items()})
+        self.manufacturer_decoders = {key: (vendor, False) for key, vendor in MANUFACTURER_IDS.items()}
+
+    def _compile_admission(self):
+        self.admit = compile_admission_filter(
+            self._discovery, self._sensor_whitelist, self._tracker_whitelist, *self._admission_options
+        )
+
+    @property
+    def discovery(self):
+        """Parse the sensor data of all devices, not only of the sensor whitelist."""
+        return self._discovery
+
+    @discovery.setter
+    def discovery(self, value):
+        self._discovery = value
+        self._compile_admission()
+
+    @property
+    def sensor_whitelist(self):
+        """MACs whose sensor data is parsed without discovery, MACs added later are taken into account."""
+        return self._sensor_whitelist
+
+    @sensor_whitelist.setter
+    def sensor_whitelist(self, macs):
+        self._sensor_whitelist = MacSet(macs)
+        self._compile_admission()
+
+    @property
+    def tracker_whitelist(self):
+        """MACs reported as device trackers, MACs added later are taken into account."""
+        return self._tracker_whitelist
+
+    @tracker_whitelist.setter
+    def tracker_whitelist(self, macs):
+        self._tracker_whitelist = MacSet(macs)
+        self._compile_admission()
+
+    @property
+    def defer_decryption(self):
+        """True while parse_many of the current thread queues decryption jobs."""
+        return getattr(self._local, "defer_decryption", False)
+
+    @defer_decryption.setter
+    def defer_decryption(self, value):
+        self._local.defer_decryption = value
+
+    def diagnose(self, source, message, **fields):
+        """Record a diagnostic, callers check self.diagnostics first."""
+        record = {"source": source, "message": message}
+        record.update(fields)
+        self.diagnostic_records.append(record)
+        _LOGGER.debug("%s: %s %s", source, message, fields)
+
+    def set_aeskey(self, mac, key):
+        """Set (or remove with None) the encryption key of a device."""
+        mac = mac_to_int(mac)
+        if key is None:
+            self.aeskeys.pop(mac, None)
+        else:
+            self.aeskeys[mac] = key
+        self.aes_ciphers.pop(mac, None)
+        self.aes_failures.pop(mac, None)
+        self.raw_payloads.pop(mac, None)
+
+    def register_decoder(self, ad_type, key, vendor, parser=None, whole_payload=False):
+        """Register a vendor decoder for an AD structure.
+
+        For service data (0x16) and 128-bit UUIDs (0x06) the key is the UUID,
+        for manufacturer specific data (0xFF) it is (AD structure length, company id).
+        """
+        if parser is not None:
+            self.vendor_parsers[vendor] = parser
+        # cached results may come from another decoder
+        self.raw_payloads.clear()
+        if ad_type == 0xFF:
+            self.manufacturer_decoders[key] = (vendor, whole_payload)
+        elif ad_type in (0x16, 0x06):
+            self.service_decoders[(ad_type, key)] = (vendor, whole_payload)
+        else:
+            raise ValueError("Unsupported AD type: 0x%02X" % ad_type)
+
+    def unregister_decoder(self, ad_type, key):
+        """Remove a vendor decoder, return True if it was registered."""
+        self.raw_payloads.clear()
+        if ad_type == 0xFF:
+            return self.manufacturer_decoders.pop(key, None) is not None
+        return self.service_decoders.pop((ad_type, key), None) is not None
 
-        # extract RSSI byte
-        rssi_index = 18 if is_ext_packet else msg_length - 1
-        rssi = data[rssi_index]
-        # strange positive RSSI workaround
-        if rssi > 127:
-            rssi = rssi - 256
-        # MAC address
-        mac = (data[8 if is_ext_packet else 7:14 if is_ext_packet else 13])[::-1]
-        sensor_data = None
+    def parse_vendor(self, vendor, adstruct, mac, rssi):
+        """Run the parser of a vendor on an AD structure."""
+        try:
+            parser = self.vendor_parsers[vendor]
+        except KeyError:
+            parser = self.vendor_parsers[vendor] = load_vendor_parser(vendor)
+        metrics = self.metrics
+        if parser is None:
+            metrics.drop(DROP_VENDOR_UNAVAILABLE)
+            return None
+        metrics.vendor_frames[vendor] += 1
+        dropped = metrics.dropped
+        start = perf_counter()
+        result = parser(self, adstruct, mac, rssi)
+        metrics.observe(vendor, perf_counter() - start)
+        # a reading can be returned for a dropped frame (failed decryption), it counts as drop only
+        if result is not None and metrics.dropped == dropped:
+            metrics.vendor_results[vendor] += 1
+        return result
 
+    def parse_ad_structures(self, data, adpayload_start, adpayload_size, mac, rssi):
+        """Walk the AD structures of an advertisement and run the matching vendor parser."""
+        # the reports of an event are followed by an RSSI byte and the other reports
+        adpayload_end = adpayload_start + adpayload_size
         while adpayload_size > 1:
             adstuct_size = data[adpayload_start] + 1
             if adstuct_size > 1 and adstuct_size <= adpayload_size:
@@ -72,105 +349,261 @@ class BleParser:
                 if adstuct_type == 0x16 and adstuct_size > 4:
                     # AD type 'UUI16' https://www.bluetooth.com/specifications/assigned-numbers/
                     uuid16 = (adstruct[3] << 8) | adstruct[2]
-                    # check for service data of supported manufacturers
-                    if uuid16 == 0xFFF9 or uuid16 == 0xFDCD:  # UUID16 = Cleargrass or Qingping
-                        sensor_data = parse_qingping(self, adstruct, mac, rssi)
-                        break
-                    elif uuid16 == 0x181A:  # UUID16 = ATC
-                        sensor_data = parse_atc(self, adstruct, mac, rssi)
-                        break
-                    elif uuid16 == 0xFE95:  # UUID16 = Xiaomi
-                        sensor_data = parse_xiaomi(self, adstruct, mac, rssi)
-                        break
-                    elif uuid16 == 0x181D or uuid16 == 0x181B:  # UUID16 = Mi Scale
-                        sensor_data = parse_miscale(self, adstruct, mac, rssi)
-                        break
-                    elif uuid16 == 0xFEAA:  # UUID16 = Ruuvitag V2/V4
-                        sensor_data = parse_ruuvitag(self, adstruct, mac, rssi)
-                        break
-                    elif uuid16 == 0x2A6E or uuid16 == 0x2A6F:  # UUID16 = Teltonika
-                        # Teltonika can contain multiple sevice data payloads in one advertisement
-                        sensor_data = parse_teltonika(self, data[adpayload_start:], mac, rssi)
-                        break
-                    else:
-                        if self.report_unknown == "Other":
-                            _LOGGER.info("Unknown advertisement received: %s", data.hex())
+                    decoder = self.service_decoders.get((0x16, uuid16))
                 elif adstuct_type == 0xFF:
+                    if adstuct_size <= 3:
+                        # too short for a company identifier
+                        self.metrics.drop(DROP_INVALID_LENGTH)
+                        return None
                     # AD type 'Manufacturer Specific Data' with company identifier
                     # https://www.bluetooth.com/specifications/assigned-numbers/company-identifiers/
                     comp_id = (adstruct[3] << 8) | adstruct[2]
-                    # check for service data of supported companies
-                    if adstruct[0] == 0x1E and comp_id == 0xFFFF:  # Kegtron
-                        sensor_data = parse_kegtron(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x15 and (comp_id == 0x0010 or comp_id == 0x0011):  # Thermoplus
-                        sensor_data = parse_thermoplus(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x0C and comp_id == 0xEC88:  # Govee H5051
-                        sensor_data = parse_govee(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x0A and comp_id == 0xEC88:  # Govee H5074
-                        sensor_data = parse_govee(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x09 and comp_id == 0xEC88:  # Govee H5072/H5075
-                        sensor_data = parse_govee(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x09 and comp_id == 0x0001:  # Govee H5101/H5102/H5177
-                        sensor_data = parse_govee(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x0C and comp_id == 0x0001:  # Govee H5178
-                        sensor_data = parse_govee(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x0C and comp_id == 0x8801:  # Govee H5179
-                        sensor_data = parse_govee(self, adstruct, mac, rssi)
-                        break
-                    elif comp_id == 0x0499:  # Ruuvitag V3/V5
-                        sensor_data = parse_ruuvitag(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x14 and (comp_id == 0xaa55):  # Brifit
-                        sensor_data = parse_brifit(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x0E and adstruct[3] == 0x82:  # iNode
-                        sensor_data = parse_inode(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x19 and adstruct[3] in [0x91, 0x92, 0x93, 0x94, 0x95, 0x96, 0x9A, 0x9B, 0x9C, 0x9D]:  # iNode Care Sensors
-                        sensor_data = parse_inode(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x15 and comp_id == 0x1000:  # Moat S2
-                        sensor_data = parse_moat(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x11 and comp_id == 0x0133:  # BlueMaestro
-                        sensor_data = parse_bluemaestro(self, adstruct, mac, rssi)
-                        break
-                    elif adstruct[0] == 0x10 and adstruct[2] == 0xC0:  # Xiaogui Scale
-                        sensor_data = parse_xiaogui(self, adstruct, mac, rssi)
-                        break
-                    else:
-                        if self.report_unknown == "Other":
-                            _LOGGER.info("Unknown advertisement received: %s", data.hex())
+                    decoder = self.manufacturer_decoders.get((adstruct[0], comp_id))
+                    if decoder is None:
+                        decoder = self.manufacturer_decoders.get((None, comp_id))
                 elif adstuct_type == 0x06 and adstuct_size > 16:
-                    sensorpush_uuid_reversed = b'\xb0\x0a\x09\xec\xd7\x9d\xb8\x93\xba\x42\xd6\x11\x00\x00\x09\xef'
-                    if str(adstruct[2:]) == str(sensorpush_uuid_reversed):
-                        sensor_data = parse_sensorpush(self, data[adpayload_start:], mac, rssi)
-                        break
-                    else:
-                        if self.report_unknown == "Other":
-                            _LOGGER.info("Unknown advertisement received: %s", data.hex())
+                    # AD type 'Complete List of 128-bit Service Class UUIDs'
+                    decoder = self.service_decoders.get((0x06, bytes(adstruct[2:])))
                 else:
-                    if self.report_unknown == "Other":
-                        _LOGGER.info("Unknown advertisement received: %s", data.hex())
-                    sensor_data = None
+                    decoder = None
+                if decoder is not None:
+                    vendor, whole_payload = decoder
+                    if whole_payload:
+                        # some vendors have multiple AD structures in one advertisement
+                        adstruct = data[adpayload_start:adpayload_end]
+                    return self.parse_vendor(vendor, adstruct, mac, rssi)
+                if self.report_unknown == "Other":
+                    _LOGGER.info("Unknown advertisement received: %s", data.hex())
             adpayload_size -= adstuct_size
             adpayload_start += adstuct_size
 
+        self.metrics.drop(DROP_UNKNOWN_ADVERTISEMENT)
+        return None
+
+    def parse_cached(self, data, adpayload_start, adpayload_size, mac, rssi):
+        """Parse the AD structures, unless they repeat the last advertisement of the device.
+
+        A repeat is a duplicate (None) with filter_duplicates, otherwise a
+        copy of the cached result is returned with the new RSSI. Callers
+        never get the cached object, so changing a result doesn't change
+        later repeats.
+        """
+        payload = data[adpayload_start:adpayload_start + adpayload_size]
+        try:
+            if self.raw_payloads[mac] == payload:
+                if self.filter_duplicates is True:
+                    self.metrics.drop(DROP_REPEAT)
+                    return None
+                self.metrics.cache_hits += 1
+                result = self.raw_results[mac]
+                if result is None:
+                    return None
+                if isinstance(result, dict):
+                    return dict(result, rssi=rssi) if "rssi" in result else dict(result)
+                return result.with_rssi(rssi)
+        except KeyError:
+            pass
+        result = self.parse_ad_structures(data, adpayload_start, adpayload_size, mac, rssi)
+        self.raw_payloads[mac] = bytes(payload)
+        if isinstance(result, dict):
+            self.raw_results[mac] = dict(result)
+        elif result is not None:
+            self.raw_results[mac] = copy(result)
+        else:
+            self.raw_results[mac] = None
+        return result
+
+    def parse_data(self, data):
+        """Parse the raw data of an HCI advertising report event.
+
+        Returns (sensor_data, tracker_data) of the first report, use
+        parse_event for events with several reports.
+        """
+        reports = self.parse_event(data)
+        if not reports:
+            return None, None
+        return reports[0]
+
+    def parse_event(self, data):
+        """Parse an HCI LE advertising report event, return [(sensor_data, tracker_data)] per report.
+
+        Legacy (0x02) and extended (0x0D) advertising report events can hold
+        any number of reports, they are all parsed at their offsets in data.
+        An event with an invalid length returns an empty list.
+        """
+        if self.zero_copy:
+            data = memoryview(data)
+        parse_report = self.parse_report
+        return [parse_report(data, *report) for report in self.event_reports(data)]
+
+    def event_reports(self, data):
+        """Return [(AD payload start, AD payload size, MAC, RSSI)] of the reports of an event.
+
+        Counts the frame and its reports, an event with an invalid length
+        is dropped and returns an empty list.
+        """
+        metrics = self.metrics
+        metrics.frames += 1
+        reports = report_offsets(data)
+        if reports is None:
+            if self.diagnostics:
+                self.diagnose(
+                    "ble_parser", "Invalid message length",
+                    msg_length=data[2] + 3 if len(data) > 2 else None, data_length=len(data),
+                    num_reports=data[4] if len(data) > 4 else None, data=data.hex(),
+                )
+            metrics.drop(DROP_INVALID_LENGTH)
+            return []
+
+        metrics.reports += len(reports)
+        results = []
+        for adpayload_start, adpayload_size, mac_start, rssi_index in reports:
+            rssi = data[rssi_index]
+            # strange positive RSSI workaround
+            if rssi > 127:
+                rssi = rssi - 256
+            mac = int.from_bytes(data[mac_start:mac_start + 6], "little")
+            results.append((adpayload_start, adpayload_size, mac, rssi))
+        return results
+
+    def parse_report(self, data, adpayload_start, adpayload_size, mac, rssi):
+        """Parse one advertising report of an event, return (sensor_data, tracker_data)."""
+        metrics = self.metrics
+        admitted = self.admit(mac, rssi)
+        if not admitted:
+            metrics.drop(DROP_FILTERED)
+            return None, None
+        if admitted & ADMIT_SENSOR:
+            sensor_data = self.parse_sensor(data, adpayload_start, adpayload_size, mac, rssi)
+        else:
+            metrics.drop(DROP_FILTERED)
+            sensor_data = None
+
         # check for monitored device trackers
-        if mac in self.tracker_whitelist:
+        if admitted & ADMIT_TRACKER:
             tracker_data = {
                 "is connected": True,
-                "mac": ''.join('{:02X}'.format(x) for x in mac),
+                "mac": format_mac(mac),
                 "rssi": rssi,
             }
         else:
             tracker_data = None
 
         return sensor_data, tracker_data
+
+    def parse_sensor(self, data, adpayload_start, adpayload_size, mac, rssi):
+        """Decode the sensor data of an admitted report."""
+        metrics = self.metrics
+        dropped = metrics.dropped
+        # dedup, raw cache and decryption state of the device are read and updated together
+        with self.device_state.lock(mac):
+            if self.cache_raw:
+                sensor_data = self.parse_cached(data, adpayload_start, adpayload_size, mac, rssi)
+            else:
+                sensor_data = self.parse_ad_structures(data, adpayload_start, adpayload_size, mac, rssi)
+        if sensor_data is not None and metrics.dropped == dropped:
+            # custom decoders can return results without a device type
+            device_type = sensor_data.get("type")
+            if device_type is not None:
+                metrics.device_types[device_type] += 1
+        return sensor_data
+
+    def parse_many(self, frames):
+        """Parse an iterable of raw frames into columnar results.
+
+        Returns (sensor columns, tracker columns), each a dict of
+        {field: list of values}. Fields missing in a result are None.
+        Results are appended to the columns as they are decoded, without
+        building a result tuple per report or a tracker dict.
+        """
+        metrics = self.metrics
+        admit = self.admit
+        event_reports = self.event_reports
+        parse_sensor = self.parse_sensor
+        zero_copy = self.zero_copy
+        sensor_columns = {}
+        sensor_count = 0
+        tracker_macs = []
+        tracker_rssis = []
+        # with parallel decryption the readings are only complete after the decryption stage
+        deferred_rows = [] if self.decrypt_workers > 0 else None
+        self.defer_decryption = deferred_rows is not None
+        try:
+            for data in frames:
+                if zero_copy:
+                    data = memoryview(data)
+                for adpayload_start, adpayload_size, mac, rssi in event_reports(data):
+                    admitted = admit(mac, rssi)
+                    if not admitted:
+                        metrics.drop(DROP_FILTERED)
+                        continue
+                    if admitted & ADMIT_SENSOR:
+                        sensor_data = parse_sensor(data, adpayload_start, adpayload_size, mac, rssi)
+                        if sensor_data is not None:
+                            if deferred_rows is None:
+                                _append_row(sensor_columns, sensor_data, sensor_count)
+                                sensor_count += 1
+                            else:
+                                deferred_rows.append(sensor_data)
+                    else:
+                        metrics.drop(DROP_FILTERED)
+                    if admitted & ADMIT_TRACKER:
+                        tracker_macs.append(format_mac(mac))
+                        tracker_rssis.append(rssi)
+        finally:
+            self.defer_decryption = False
+        if deferred_rows is not None:
+            if self._decryption_stage is None:
+                from decrypt_stage import DecryptionStage
+                self._decryption_stage = DecryptionStage(self, self.decrypt_workers, self.decrypt_batch_size)
+            self._decryption_stage.run(deferred_rows)
+            sensor_columns = _to_columns(deferred_rows)
+        tracker_columns = {}
+        if tracker_macs:
+            tracker_columns = {"is connected": [True] * len(tracker_macs), "mac": tracker_macs, "rssi": tracker_rssis}
+        return sensor_columns, tracker_columns
+
+    def close(self):
+        """Stop the decryption threads, if any."""
+        if self._decryption_stage is not None:
+            self._decryption_stage.close()
+            self._decryption_stage = None
+
+
+def _to_columns(rows):
+    """Return a list of results as {field: list of values}."""
+    columns = {}
+    for count, row in enumerate(rows):
+        _append_row(columns, row, count)
+    return columns
+
+
+def _append_row(columns, row, rows):
+    """Append a result to columns that already hold a number of rows."""
+    appended = 0
+    if type(row).as_dict is Reading.as_dict:
+        # fixed-key reading, read the attributes without building the result dict
+        optional = row.OPTIONAL
+        for key, attribute in row.KEYS.items():
+            value = getattr(row, attribute)
+            if value is None and key in optional:
+                continue
+            try:
+                columns[key].append(value)
+            except KeyError:
+                columns[key] = [None] * rows
+                columns[key].append(value)
+            appended += 1
+    else:
+        for key, value in row.items():
+            try:
+                columns[key].append(value)
+            except KeyError:
+                columns[key] = [None] * rows
+                columns[key].append(value)
+            appended += 1
+    if appended != len(columns):
+        # pad the columns this result doesn't have
+        for column in columns.values():
+            if len(column) == rows:
+                column.append(None)
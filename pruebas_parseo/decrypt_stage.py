@@ -0,0 +1,126 @@
+"""Parallel decryption stage for encrypted MiBeacon advertisements."""
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import DROP_DECRYPTION_BLOCKED
+from xiaomi import decryption_blocked, decryption_done, parse_payload, run_decryption_job
+
+
+class DecryptionStage:
+    """Decrypts the pending payloads of a batch of Xiaomi readings on a thread pool.
+
+    The parser only queues the decryption jobs (with BleParser.defer_decryption),
+    all dedup state is updated while parsing, in frame order. The frames of a
+    device are decrypted in order by one task, and decryption failures are
+    accounted for on the calling thread in frame order, so the outcome is the
+    same as with inline decryption. Repeats served from the raw cache get
+    the outcome of the reading they repeat, which is also written back to
+    the cache. Cryptodome releases the GIL while decrypting.
+    """
+    def __init__(self, parser, workers=None, batch_size=64):
+        self.parser = parser
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="mibeacon-decrypt")
+
+    def run(self, readings):
+        """Decrypt and decode the pending readings of a batch, in place."""
+        pending = [reading for reading in readings if getattr(reading, "pending", None) is not None]
+        if not pending:
+            return readings
+        # repeats served from the raw cache share the job of the reading that was parsed,
+        # only that one is decrypted and accounted for
+        originals = {}
+        for reading in pending:
+            originals.setdefault(id(reading.pending), reading)
+        # keep the frames of a device together, in order
+        devices = {}
+        for reading in originals.values():
+            devices.setdefault(reading.address, []).append(reading)
+        batches = []
+        batch = []
+        for device_readings in devices.values():
+            batch.extend(device_readings)
+            if len(batch) >= self.batch_size:
+                batches.append(batch)
+                batch = []
+        if batch:
+            batches.append(batch)
+
+        report_unknown = self.parser.report_unknown
+        futures = [self._executor.submit(_decrypt_batch, batch, report_unknown) for batch in batches]
+        outcomes = {}
+        for batch, future in zip(batches, futures):
+            for reading, outcome in zip(batch, future.result()):
+                outcomes[id(reading.pending)] = outcome
+
+        device_state = self.parser.device_state
+        raw_results = self.parser.raw_results
+        metrics = self.parser.metrics
+        # {id(job): decoded values, None if the job was dropped}
+        decoded = {}
+        for reading in pending:
+            job = reading.pending
+            reading.pending = None
+            if reading is not originals[id(job)]:
+                # a cache hit isn't counted as a result, it only gets the outcome of its original
+                values = decoded[id(job)]
+                if values is not None:
+                    reading.data = True
+                    reading.values = values
+                continue
+            values = None
+            # the failure state of the device is shared with the threads parsing it
+            with device_state.lock(reading.address):
+                if decryption_blocked(self.parser, reading.address):
+                    # an earlier frame of the batch started a backoff, inline decryption would have skipped it
+                    metrics.drop(DROP_DECRYPTION_BLOCKED)
+                    metrics.retract("xiaomi", reading.device_type)
+                else:
+                    values, error = outcomes[id(job)]
+                    decryption_done(self.parser, reading.address, job, error)
+                    if error is not None:
+                        # counted as a result when it was queued, decryption_done counted the drop
+                        metrics.retract("xiaomi", reading.device_type)
+                _complete_cached(raw_results, reading.address, job, values)
+            decoded[id(job)] = values
+            if values is not None:
+                reading.data = True
+                reading.values = values
+        return readings
+
+    def close(self):
+        self._executor.shutdown()
+
+
+class _PayloadContext:
+    """Stand-in for the parser in parse_payload, which only reads report_unknown and diagnostics."""
+    __slots__ = ("report_unknown", "diagnostics")
+
+    def __init__(self, report_unknown):
+        self.report_unknown = report_unknown
+        # diagnostic records are only made on the parser thread
+        self.diagnostics = False
+
+
+def _complete_cached(raw_results, mac, job, values):
+    """Store the outcome of a job in the raw cache entry of the device, if it still holds the job."""
+    cached = raw_results.get(mac)
+    if getattr(cached, "pending", None) is not job:
+        return
+    cached.pending = None
+    if values is not None:
+        cached.data = True
+        cached.values = values
+
+
+def _decrypt_batch(batch, report_unknown):
+    """Return (values, error) for every reading of a batch."""
+    context = _PayloadContext(report_unknown)
+    outcomes = []
+    for reading in batch:
+        try:
+            payload = run_decryption_job(reading.pending)
+        except ValueError as error:
+            outcomes.append((None, error))
+            continue
+        outcomes.append((parse_payload(context, payload, reading.device_type), None))
+    return outcomes
@@ -0,0 +1,257 @@
+"""Bounded per-MAC state for BleParser."""
+from array import array
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from functools import lru_cache
+import threading
+import time
+
+# marker for a field that isn't set for a device
+_MISSING = object()
+# markers for unset fields in typed columns
+_TYPED_MISSING = {
+    "b": -0x80,
+    "h": -0x8000,
+    "i": -0x80000000,
+    "q": -0x8000000000000000,
+}
+
+# {field: array typecode}, None for fields that hold any python object
+DEFAULT_FIELDS = {
+    # Mi Scale packet fingerprints are up to 104 bits, too wide for an array
+    "packet": None,
+    "adv_priority": "b",
+    "movements": None,
+    # last raw AD payload and its parse result
+    "raw": None,
+    "result": None,
+    # MiBeacon cipher factory and decryption failures
+    "cipher": None,
+    "decrypt_failures": None,
+}
+
+
+def mac_to_int(mac):
+    """Return a MAC address (bytes, hex string or int) as a 48-bit integer."""
+    if isinstance(mac, int):
+        return mac
+    if isinstance(mac, str):
+        return int(mac.replace(":", "").replace("-", ""), 16)
+    return int.from_bytes(mac, "big")
+
+
+@lru_cache(maxsize=4096)
+def format_mac(mac):
+    """Return the formatted MAC address of a 48-bit integer, cached per device."""
+    return "%012X" % mac
+
+
+class DeviceStateTable:
+    """Per-MAC state table with a maximum size and an idle timeout.
+
+    Devices are kept in least recently used order, a device is touched every
+    time its state is read or written. When the table is full the least
+    recently used device is evicted, devices idle for longer than ttl
+    seconds are expired. All operations are O(1) (amortized for expiry).
+
+    The table is safe for concurrent callers. Devices are spread over
+    stripes by MAC, each stripe has its own lock, capacity and LRU order,
+    so threads working on devices of different stripes don't contend.
+    lock(mac) returns the (reentrant) lock of the stripe of a device, for
+    read-modify-write sections over several fields. The capacity is split
+    evenly between the stripes and enforced per stripe, so a table with
+    several stripes can evict devices before it holds capacity devices.
+    """
+    def __init__(self, capacity=4096, ttl=None, fields=DEFAULT_FIELDS, clock=time.monotonic, stripes=1):
+        if capacity < 1:
+            raise ValueError("capacity should be at least 1")
+        stripes = max(1, min(stripes, capacity))
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self._stripes = [
+            _Stripe(capacity // stripes + (1 if stripe < capacity % stripes else 0), self, fields)
+            for stripe in range(stripes)
+        ]
+
+    def _stripe(self, mac):
+        stripes = self._stripes
+        return stripes[hash(mac) % len(stripes)]
+
+    def lock(self, mac):
+        """Return the lock of the stripe of a device."""
+        return self._stripe(mac).lock
+
+    def column(self, field):
+        """Return a dict-like view of one field of the device states."""
+        return DeviceStateColumn(self, field)
+
+    @property
+    def evictions(self):
+        return sum(stripe.evictions for stripe in self._stripes)
+
+    @property
+    def expirations(self):
+        return sum(stripe.expirations for stripe in self._stripes)
+
+    def stats(self):
+        """Return the size and eviction counters of the table."""
+        return {
+            "devices": len(self),
+            "capacity": self.capacity,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def __len__(self):
+        return sum(len(stripe.slots) for stripe in self._stripes)
+
+    def __contains__(self, mac):
+        stripe = self._stripe(mac)
+        with stripe.lock:
+            return stripe.find(mac, touch=False) is not None
+
+    def discard(self, mac):
+        """Forget the state of a device."""
+        stripe = self._stripe(mac)
+        with stripe.lock:
+            slot = stripe.slots.pop(mac, None)
+            if slot is not None:
+                stripe.release(slot)
+
+
+class _Stripe:
+    """Devices, LRU order and columns of one stripe of a DeviceStateTable."""
+    def __init__(self, capacity, table, fields):
+        self.capacity = capacity
+        self.table = table
+        self.lock = threading.RLock()
+        self.evictions = 0
+        self.expirations = 0
+        # {mac: slot}, in least recently used order
+        self.slots = OrderedDict()
+        self.last_seen = array("d")
+        self.free = []
+        self.columns = {}
+        self.missing = {}
+        for field, typecode in fields.items():
+            if typecode is None:
+                self.columns[field] = []
+                self.missing[field] = _MISSING
+            else:
+                self.columns[field] = array(typecode)
+                self.missing[field] = _TYPED_MISSING[typecode]
+
+    def find(self, mac, touch=True):
+        """Return the slot of a device, or None."""
+        now = self.table.clock()
+        if self.table.ttl is not None:
+            self.expire(now)
+        slot = self.slots.get(mac)
+        if slot is not None and touch:
+            self.slots.move_to_end(mac)
+            self.last_seen[slot] = now
+        return slot
+
+    def acquire(self, mac):
+        """Return the slot of a device, allocating one if needed."""
+        slot = self.find(mac)
+        if slot is not None:
+            return slot
+        if len(self.slots) >= self.capacity:
+            (_, evicted) = self.slots.popitem(last=False)
+            self.release(evicted)
+            self.evictions += 1
+        if self.free:
+            slot = self.free.pop()
+            self.last_seen[slot] = self.table.clock()
+        else:
+            slot = len(self.last_seen)
+            self.last_seen.append(self.table.clock())
+            for field, values in self.columns.items():
+                values.append(self.missing[field])
+        self.slots[mac] = slot
+        return slot
+
+    def expire(self, now):
+        """Evict the devices that have been idle for longer than the ttl."""
+        deadline = now - self.table.ttl
+        slots = self.slots
+        while slots:
+            mac = next(iter(slots))
+            slot = slots[mac]
+            if self.last_seen[slot] > deadline:
+                break
+            del slots[mac]
+            self.release(slot)
+            self.expirations += 1
+
+    def release(self, slot):
+        for field, values in self.columns.items():
+            values[slot] = self.missing[field]
+        self.free.append(slot)
+
+
+class DeviceStateColumn(MutableMapping):
+    """Dict-like view of one field of a DeviceStateTable."""
+    __slots__ = ("_table", "_field")
+
+    def __init__(self, table, field):
+        if field not in table._stripes[0].columns:
+            raise KeyError(field)
+        self._table = table
+        self._field = field
+
+    def __getitem__(self, mac):
+        stripe = self._table._stripe(mac)
+        with stripe.lock:
+            slot = stripe.find(mac)
+            if slot is None:
+                raise KeyError(mac)
+            value = stripe.columns[self._field][slot]
+            if value == stripe.missing[self._field]:
+                raise KeyError(mac)
+            return value
+
+    def __setitem__(self, mac, value):
+        stripe = self._table._stripe(mac)
+        with stripe.lock:
+            stripe.columns[self._field][stripe.acquire(mac)] = value
+
+    def __delitem__(self, mac):
+        stripe = self._table._stripe(mac)
+        with stripe.lock:
+            slot = stripe.find(mac, touch=False)
+            if slot is None or not self._is_set(stripe, slot):
+                raise KeyError(mac)
+            stripe.columns[self._field][slot] = stripe.missing[self._field]
+
+    def __iter__(self):
+        macs = []
+        for stripe in self._table._stripes:
+            with stripe.lock:
+                macs.extend(mac for mac, slot in stripe.slots.items() if self._is_set(stripe, slot))
+        return iter(macs)
+
+    def __len__(self):
+        count = 0
+        for stripe in self._table._stripes:
+            with stripe.lock:
+                count += sum(1 for slot in stripe.slots.values() if self._is_set(stripe, slot))
+        return count
+
+    def snapshot(self):
+        """Return {mac: value} of the devices with the field set, without touching them."""
+        values = {}
+        for stripe in self._table._stripes:
+            with stripe.lock:
+                column = stripe.columns[self._field]
+                missing = stripe.missing[self._field]
+                for mac, slot in stripe.slots.items():
+                    value = column[slot]
+                    if value != missing:
+                        values[mac] = value
+        return values
+
+    def _is_set(self, stripe, slot):
+        return stripe.columns[self._field][slot] != stripe.missing[self._field]
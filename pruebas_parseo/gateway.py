@@ -0,0 +1,275 @@
+"""asyncio gateway: ingestion, parsing and sink stages around BleParser."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import logging
+import socket
+import struct
+import time
+
+from hci_capture import HCI_EVENT_PKT, HCI_LE_META_EVENT, read_capture
+
+_LOGGER = logging.getLogger(__name__)
+
+# struct hci_filter: packet type mask, event mask, opcode
+HCI_FILTER = struct.Struct("<IIIH")
+
+
+async def hci_source(device=0):
+    """Yield (timestamp, frame) for the LE meta events of a local HCI device (Linux raw HCI socket).
+
+    The socket only listens, scanning has to be enabled separately (for
+    example with bluetoothctl).
+    """
+    sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+    try:
+        sock.setsockopt(
+            socket.SOL_HCI, socket.HCI_FILTER,
+            HCI_FILTER.pack(1 << HCI_EVENT_PKT, 0, 1 << (HCI_LE_META_EVENT - 32), 0)
+        )
+        sock.bind((device,))
+        sock.setblocking(False)
+        loop = asyncio.get_running_loop()
+        while True:
+            frame = await loop.sock_recv(sock, 1024)
+            yield time.time(), frame
+    finally:
+        sock.close()
+
+
+async def capture_source(path, realtime=False, speed=1.0):
+    """Yield (timestamp, frame) from a btsnoop/pcap capture, optionally with the original timing."""
+    capture_start = None
+    replay_start = None
+    for count, (timestamp, frame) in enumerate(read_capture(path)):
+        if realtime:
+            if capture_start is None:
+                capture_start = timestamp
+                replay_start = time.monotonic()
+            delay = replay_start + (timestamp - capture_start) / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % 256 == 0:
+            # let the other stages run
+            await asyncio.sleep(0)
+        yield timestamp, frame
+
+
+async def stream_source(reader):
+    """Yield (timestamp, frame) from a stream of H4 HCI event packets (an asyncio StreamReader)."""
+    while True:
+        try:
+            header = await reader.readexactly(3)
+            frame = header + await reader.readexactly(header[2])
+        except asyncio.IncompleteReadError:
+            return
+        if frame[0] == HCI_EVENT_PKT:
+            yield time.time(), frame
+
+
+class Gateway:
+    """Pipeline of an ingestion, a parse and a sink stage, connected by bounded queues.
+
+    Ingestion collects frames of the source in batches of up to batch_size
+    frames, or the frames of batch_interval seconds. When the frame queue is
+    full the batch is dropped, so ingestion never waits for the later
+    stages. The parse stage runs BleParser.parse_event on an executor (one
+    thread by default) and waits for room in
+    the result queue, the sink stage calls sink(results) for every batch of
+    (timestamp, sensor_data, tracker_data) results, sink can be a coroutine
+    function. A frame that fails to parse is logged and counted in
+    parse_errors, a stage that fails stops the others and run() raises.
+
+    stop() ends ingestion, the batches that are in the queues are still
+    parsed and published before run() returns.
+    """
+    def __init__(
+        self, parser, source, sink, queue_size=16, batch_size=256, batch_interval=0.1, executor=None
+    ):
+        self.parser = parser
+        self.source = source
+        self.sink = sink
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.executor = executor
+        self.frames = 0
+        self.dropped_frames = 0
+        self.results = 0
+        self.parse_errors = 0
+        self.sink_errors = 0
+        self._stopping = None
+
+    def stats(self):
+        """Return the frame, drop and result counters."""
+        return {
+            "frames": self.frames,
+            "dropped_frames": self.dropped_frames,
+            "results": self.results,
+            "parse_errors": self.parse_errors,
+            "sink_errors": self.sink_errors,
+        }
+
+    async def run(self):
+        """Run the stages until the source ends or stop() is called, then drain the queues."""
+        self._stopping = asyncio.Event()
+        frame_queue = asyncio.Queue(self.queue_size)
+        result_queue = asyncio.Queue(self.queue_size)
+        executor = self.executor
+        if executor is None:
+            executor = ThreadPoolExecutor(1, thread_name_prefix="ble-parser")
+        stages = [
+            asyncio.ensure_future(self._ingest(frame_queue)),
+            asyncio.ensure_future(self._parse(frame_queue, result_queue, executor)),
+            asyncio.ensure_future(self._publish(result_queue)),
+        ]
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            # a failed stage leaves the others waiting on their queues
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            if self.executor is None:
+                executor.shutdown()
+
+    def stop(self):
+        """Stop ingestion, run() returns when the queued frames are published."""
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def _ingest(self, frame_queue):
+        frames = self.source.__aiter__()
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        next_frame = None
+        batch = []
+        deadline = None
+        cancelled = False
+        try:
+            while True:
+                if next_frame is None:
+                    next_frame = asyncio.ensure_future(frames.__anext__())
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                await asyncio.wait({next_frame, stopping}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if next_frame.done():
+                    try:
+                        frame = next_frame.result()
+                    except StopAsyncIteration:
+                        break
+                    next_frame = None
+                    batch.append(frame)
+                    self.frames += 1
+                    if deadline is None:
+                        deadline = time.monotonic() + self.batch_interval
+                elif stopping.done():
+                    break
+                if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                    self._hand_off(frame_queue, batch)
+                    batch = []
+                    deadline = None
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            stopping.cancel()
+            if next_frame is not None:
+                next_frame.cancel()
+                try:
+                    await next_frame
+                except (asyncio.CancelledError, StopAsyncIteration):
+                    pass
+            if hasattr(frames, "aclose"):
+                await frames.aclose()
+            # end of input, wait for room for the last batch and the end marker
+            if not cancelled:
+                if batch:
+                    await frame_queue.put(batch)
+                await frame_queue.put(None)
+
+    def _hand_off(self, frame_queue, batch):
+        try:
+            frame_queue.put_nowait(batch)
+        except asyncio.QueueFull:
+            self.dropped_frames += len(batch)
+
+    async def _parse(self, frame_queue, result_queue, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await frame_queue.get()
+            if batch is None:
+                break
+            results = await loop.run_in_executor(executor, self._parse_batch, batch)
+            if results:
+                await result_queue.put(results)
+        await result_queue.put(None)
+
+    def _parse_batch(self, batch):
+        parse_event = self.parser.parse_event
+        results = []
+        for timestamp, frame in batch:
+            try:
+                reports = parse_event(frame)
+            except Exception:
+                self.parse_errors += 1
+                _LOGGER.exception("Failed to parse frame %s", frame.hex())
+                continue
+            for sensor_data, tracker_data in reports:
+                if sensor_data is not None or tracker_data is not None:
+                    results.append((timestamp, sensor_data, tracker_data))
+        return results
+
+    async def _publish(self, result_queue):
+        sink_is_async = inspect.iscoroutinefunction(self.sink)
+        while True:
+            results = await result_queue.get()
+            if results is None:
+                break
+            self.results += len(results)
+            try:
+                if sink_is_async:
+                    await self.sink(results)
+                else:
+                    self.sink(results)
+            except Exception:
+                self.sink_errors += 1
+                _LOGGER.exception("Sink failed for a batch of %s results", len(results))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from ble_parser import BleParser
+
+    argparser = argparse.ArgumentParser(description="Run BleParser on a live HCI device, a capture or a TCP stream")
+    sources = argparser.add_mutually_exclusive_group(required=True)
+    sources.add_argument("--hci", type=int, help="HCI device number")
+    sources.add_argument("--capture", help="btsnoop/pcap capture")
+    sources.add_argument("--tcp", help="host:port sending H4 HCI event packets")
+    argparser.add_argument("--realtime", action="store_true", help="replay a capture with the original timing")
+    args = argparser.parse_args()
+
+    def print_results(results):
+        for timestamp, sensor_data, tracker_data in results:
+            print(timestamp, sensor_data, tracker_data)
+
+    async def main():
+        if args.hci is not None:
+            source = hci_source(args.hci)
+        elif args.capture is not None:
+            source = capture_source(args.capture, args.realtime)
+        else:
+            host, port = args.tcp.rsplit(":", 1)
+            reader, _ = await asyncio.open_connection(host, int(port))
+            source = stream_source(reader)
+        gateway = Gateway(BleParser(), source, print_results)
+        loop = asyncio.get_running_loop()
+        try:
+            import signal
+            loop.add_signal_handler(signal.SIGINT, gateway.stop)
+            loop.add_signal_handler(signal.SIGTERM, gateway.stop)
+        except (ImportError, NotImplementedError):
+            pass
+        await gateway.run()
+        print(gateway.stats())
+
+    asyncio.run(main())
@@ -0,0 +1,173 @@
+"""Reader for btsnoop and pcap captures of HCI traffic."""
+import logging
+import mmap
+import struct
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+BTSNOOP_MAGIC = b"btsnoop\x00"
+BTSNOOP_HEADER = struct.Struct(">8sII")
+BTSNOOP_RECORD = struct.Struct(">IIIIq")
+# btsnoop timestamps are microseconds since 0000-01-01
+BTSNOOP_EPOCH_DELTA = 0x00DCDDB30F2F8000
+BTSNOOP_HCI_UART = 1001  # H1, no packet type indicator
+BTSNOOP_HCI_H4 = 1002
+
+PCAP_HEADER = struct.Struct("IHHiIII")
+PCAP_RECORD = struct.Struct("IIII")
+PCAP_MAGIC_US = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+LINKTYPE_BLUETOOTH_HCI_H4 = 187
+LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR = 201
+
+HCI_EVENT_PKT = 0x04
+HCI_LE_META_EVENT = 0x3E
+# LE Advertising Report and LE Extended Advertising Report
+LE_ADVERTISING_REPORTS = (0x02, 0x0D)
+
+
+def read_capture(path):
+    """Yield (timestamp, frame) for every LE advertising report event of a capture.
+
+    The capture is memory-mapped and read lazily, frames start with the
+    H4 packet type like the ones BleParser.parse_data expects.
+    """
+    with open(path, "rb") as capture:
+        try:
+            buffer = mmap.mmap(capture.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return
+        try:
+            if buffer[:8] == BTSNOOP_MAGIC:
+                records = _btsnoop_records(buffer)
+            else:
+                records = _pcap_records(buffer)
+            for timestamp, start, end, indicator in records:
+                if indicator is None:
+                    # H4 packet, starts with the packet type indicator
+                    indicator = buffer[start]
+                    event = start + 1
+                else:
+                    event = start
+                if (
+                    indicator == HCI_EVENT_PKT
+                    and end - event > 2
+                    and buffer[event] == HCI_LE_META_EVENT
+                    and buffer[event + 2] in LE_ADVERTISING_REPORTS
+                ):
+                    if event == start:
+                        yield timestamp, bytes([HCI_EVENT_PKT]) + buffer[start:end]
+                    else:
+                        yield timestamp, buffer[start:end]
+        finally:
+            buffer.close()
+
+
+def _btsnoop_records(buffer):
+    """Yield (timestamp, start, end, indicator) of the HCI packets of a btsnoop capture.
+
+    The indicator is None for H4 packets, which already start with it.
+    """
+    (_, _, datalink) = BTSNOOP_HEADER.unpack_from(buffer, 0)
+    if datalink not in (BTSNOOP_HCI_UART, BTSNOOP_HCI_H4):
+        raise ValueError("Unsupported btsnoop datalink type: %s" % datalink)
+    offset = BTSNOOP_HEADER.size
+    size = len(buffer)
+    while offset + BTSNOOP_RECORD.size <= size:
+        (_, incl_len, flags, _, timestamp) = BTSNOOP_RECORD.unpack_from(buffer, offset)
+        offset += BTSNOOP_RECORD.size
+        if offset + incl_len > size:
+            _LOGGER.debug("Truncated btsnoop record at offset %s", offset)
+            return
+        timestamp = (timestamp - BTSNOOP_EPOCH_DELTA) / 1000000
+        if datalink == BTSNOOP_HCI_H4:
+            if incl_len > 0:
+                yield timestamp, offset, offset + incl_len, None
+        elif flags == 0x03:
+            # H1 has no packet type indicator, flags 0x03 is a received event
+            yield timestamp, offset, offset + incl_len, HCI_EVENT_PKT
+        offset += incl_len
+
+
+def _pcap_records(buffer):
+    """Yield (timestamp, start, end, None) of the H4 packets of a pcap capture."""
+    if len(buffer) < PCAP_HEADER.size:
+        raise ValueError("Not a btsnoop or pcap capture")
+    for byte_order in ("<", ">"):
+        (magic,) = struct.unpack_from(byte_order + "I", buffer, 0)
+        if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            break
+    else:
+        raise ValueError("Not a btsnoop or pcap capture")
+    header = struct.Struct(byte_order + PCAP_HEADER.format)
+    record = struct.Struct(byte_order + PCAP_RECORD.format)
+    linktype = header.unpack_from(buffer, 0)[6] & 0x0FFFFFFF
+    if linktype == LINKTYPE_BLUETOOTH_HCI_H4:
+        skip = 0
+    elif linktype == LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR:
+        # 4 bytes direction pseudo-header
+        skip = 4
+    else:
+        raise ValueError("Unsupported pcap link type: %s" % linktype)
+    divider = 1000000000 if magic == PCAP_MAGIC_NS else 1000000
+    offset = header.size
+    size = len(buffer)
+    while offset + record.size <= size:
+        (ts_sec, ts_frac, incl_len, _) = record.unpack_from(buffer, offset)
+        offset += record.size
+        if offset + incl_len > size:
+            _LOGGER.debug("Truncated pcap record at offset %s", offset)
+            return
+        if incl_len > skip:
+            yield ts_sec + ts_frac / divider, offset + skip, offset + incl_len, None
+        offset += incl_len
+
+
+def replay(parser, path, realtime=False, speed=1.0):
+    """Feed a capture to a BleParser, yield (timestamp, sensor_data, tracker_data) for every report.
+
+    With realtime=True frames are fed with the original timing (divided by speed),
+    otherwise as fast as the parser can go.
+    """
+    capture_start = None
+    replay_start = None
+    for timestamp, frame in read_capture(path):
+        if realtime:
+            if capture_start is None:
+                capture_start = timestamp
+                replay_start = time.monotonic()
+            delay = replay_start + (timestamp - capture_start) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        for sensor_data, tracker_data in parser.parse_event(frame):
+            yield timestamp, sensor_data, tracker_data
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from ble_parser import BleParser
+
+    argparser = argparse.ArgumentParser(description="Replay a btsnoop/pcap capture through BleParser")
+    argparser.add_argument("capture")
+    argparser.add_argument("--realtime", action="store_true", help="keep the original timing")
+    argparser.add_argument("--speed", type=float, default=1.0, help="speed factor for --realtime")
+    argparser.add_argument("--quiet", action="store_true", help="only print the throughput")
+    args = argparser.parse_args()
+
+    frames = 0
+    results = 0
+    start = time.perf_counter()
+    for timestamp, sensor_data, tracker_data in replay(BleParser(), args.capture, args.realtime, args.speed):
+        frames += 1
+        if sensor_data is not None:
+            results += 1
+            if not args.quiet:
+                print(timestamp, sensor_data)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{frames} frames, {results} results in {elapsed:.3f} s "
+        f"({frames / elapsed if elapsed else 0:.0f} frames/s)"
+    )
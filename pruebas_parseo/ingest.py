@@ -0,0 +1,374 @@
+"""Ingest server and sniffer client, sending batches of HCI frames over TCP or UDP."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import logging
+import socket
+import struct
+import time
+
+from sharded_parser import ShardedParser
+
+_LOGGER = logging.getLogger(__name__)
+
+# Batch header: magic, version, receiver id, frame count, base timestamp, length of the frame records
+BATCH_HEADER = struct.Struct("<2sBHHdI")
+BATCH_MAGIC = b"BL"
+BATCH_VERSION = 1
+# Frame record header: microseconds since the base timestamp, frame length
+FRAME_HEADER = struct.Struct("<IH")
+MAX_FRAME_DELTA = 0xFFFFFFFF
+# HCI event header, LE meta subevent and number of reports
+MIN_FRAME_LENGTH = 5
+
+# Payload of a UDP datagram without IP fragmentation on Ethernet
+MAX_DATAGRAM = 1400
+
+
+def encode_batch(receiver, frames):
+    """Return a batch of (timestamp, frame) of a receiver in the binary framing.
+
+    The timestamps have a resolution of a microsecond and should span less
+    than about an hour.
+    """
+    base = frames[0][0] if frames else 0.0
+    records = bytearray()
+    for timestamp, frame in frames:
+        delta = round((timestamp - base) * 1e6)
+        if not 0 <= delta <= MAX_FRAME_DELTA:
+            raise ValueError("Frame timestamp out of the range of the batch: %s" % timestamp)
+        records += FRAME_HEADER.pack(delta, len(frame))
+        records += frame
+    return BATCH_HEADER.pack(BATCH_MAGIC, BATCH_VERSION, receiver, len(frames), base, len(records)) + records
+
+
+def decode_batch_header(data):
+    """Return (receiver, frame count, base timestamp, length of the frame records) of a batch header."""
+    (magic, version, receiver, count, base, length) = BATCH_HEADER.unpack_from(data)
+    if magic != BATCH_MAGIC or version != BATCH_VERSION:
+        raise ValueError("Not a frame batch of version %d" % BATCH_VERSION)
+    return receiver, count, base, length
+
+
+def decode_batch(data):
+    """Return (receiver, [(timestamp, frame)]) of an encoded batch."""
+    if len(data) < BATCH_HEADER.size:
+        raise ValueError("Truncated frame batch")
+    (receiver, count, base, length) = decode_batch_header(data)
+    return receiver, decode_frames(memoryview(data)[BATCH_HEADER.size:], count, base, length)
+
+
+def decode_frames(records, count, base, length):
+    """Return [(timestamp, frame)] of the frame records of a batch."""
+    if len(records) != length:
+        raise ValueError("Frame batch length mismatch")
+    frames = []
+    offset = 0
+    for _ in range(count):
+        if offset + FRAME_HEADER.size > length:
+            raise ValueError("Truncated frame batch")
+        (delta, frame_length) = FRAME_HEADER.unpack_from(records, offset)
+        offset += FRAME_HEADER.size
+        if offset + frame_length > length:
+            raise ValueError("Truncated frame batch")
+        if frame_length < MIN_FRAME_LENGTH:
+            raise ValueError("Frame too short for an HCI event: %d bytes" % frame_length)
+        frames.append((base + delta / 1e6, bytes(records[offset:offset + frame_length])))
+        offset += frame_length
+    if offset != length:
+        raise ValueError("Frame batch length mismatch")
+    return frames
+
+
+class SnifferClient:
+    """Sends the frames of a sniffer to an ingest server in batches.
+
+    Frames are sent when batch_size frames are buffered, when the oldest one
+    is batch_interval seconds old or on flush(). Over UDP a batch is also
+    sent before it would exceed max_datagram bytes.
+    """
+    def __init__(
+        self, address, receiver, transport="udp", batch_size=64, batch_interval=0.2, max_datagram=MAX_DATAGRAM
+    ):
+        if transport not in ("udp", "tcp"):
+            raise ValueError("Unsupported transport: %s" % transport)
+        self.address = address
+        self.receiver = receiver
+        self.transport = transport
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_datagram = max_datagram
+        self.frames = 0
+        self.batches = 0
+        self.bytes_sent = 0
+        if transport == "udp":
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self._sock = socket.create_connection(address)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._batch = []
+        self._batch_bytes = BATCH_HEADER.size
+
+    def send(self, frame, timestamp=None):
+        """Buffer a frame received at timestamp (now by default)."""
+        if timestamp is None:
+            timestamp = time.time()
+        record_size = FRAME_HEADER.size + len(frame)
+        if self._batch and (
+            (self.transport == "udp" and self._batch_bytes + record_size > self.max_datagram)
+            or (timestamp - self._batch[0][0]) * 1e6 > MAX_FRAME_DELTA
+        ):
+            self.flush()
+        self._batch.append((timestamp, bytes(frame)))
+        self._batch_bytes += record_size
+        self.frames += 1
+        if len(self._batch) >= self.batch_size or timestamp - self._batch[0][0] >= self.batch_interval:
+            self.flush()
+
+    def flush(self):
+        """Send the buffered frames."""
+        if not self._batch:
+            return
+        data = encode_batch(self.receiver, self._batch)
+        self._batch = []
+        self._batch_bytes = BATCH_HEADER.size
+        if self.transport == "udp":
+            self._sock.sendto(data, self.address)
+        else:
+            self._sock.sendall(data)
+        self.batches += 1
+        self.bytes_sent += len(data)
+
+    def close(self):
+        self.flush()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        try:
+            batch = decode_batch(data)
+        except (ValueError, struct.error):
+            self.server.invalid_batches += 1
+            return
+        self.server._hand_off(batch)
+
+
+class IngestServer:
+    """Receives frame batches of sniffers over TCP and UDP and parses them on worker processes.
+
+    Batches are queued as they arrive, a batch is dropped when the queue is
+    full. The parse stage takes the queued batches together and parses
+    them with a ShardedParser (workers processes, parser_kwargs are passed
+    to their BleParser), so the dedup state of a device stays in one
+    worker whichever sniffer heard it. sink(results) is called with
+    [(timestamp, receiver, sensor_data, tracker_data)] per parsed group of
+    batches, sink can be a coroutine function.
+
+    Frames that fail to parse are skipped by the workers and counted in
+    parse_errors, the frames of a group that can't be parsed at all (a
+    worker stopped) are counted in lost_frames.
+    """
+    def __init__(self, sink, workers=None, queue_size=256, max_frames=4096, **parser_kwargs):
+        self.sink = sink
+        self.workers = workers
+        self.queue_size = queue_size
+        # frames parsed together at most
+        self.max_frames = max_frames
+        self.parser_kwargs = parser_kwargs
+        self.tcp_address = None
+        self.udp_address = None
+        self.batches = 0
+        self.frames = 0
+        self.dropped_batches = 0
+        self.invalid_batches = 0
+        self.results = 0
+        self.parse_errors = 0
+        self.lost_frames = 0
+        self.sink_errors = 0
+        self._queue = None
+        self._servers = []
+        self._transports = []
+        self._connections = set()
+        self._parse_task = None
+        self._parser = None
+        self._executor = None
+
+    def stats(self):
+        """Return the batch, frame, drop and result counters."""
+        return {
+            "batches": self.batches,
+            "frames": self.frames,
+            "dropped_batches": self.dropped_batches,
+            "invalid_batches": self.invalid_batches,
+            "results": self.results,
+            "parse_errors": self.parse_errors,
+            "lost_frames": self.lost_frames,
+            "sink_errors": self.sink_errors,
+        }
+
+    async def start(self, host="127.0.0.1", tcp_port=0, udp_port=0):
+        """Start the worker processes and listen, a port of None disables its transport.
+
+        The bound addresses are in tcp_address and udp_address.
+        """
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.queue_size)
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="ingest-parser")
+        self._parser = await loop.run_in_executor(
+            self._executor, lambda: ShardedParser(self.workers, **self.parser_kwargs)
+        )
+        if tcp_port is not None:
+            server = await asyncio.start_server(self._handle_connection, host, tcp_port)
+            self._servers.append(server)
+            self.tcp_address = server.sockets[0].getsockname()[:2]
+        if udp_port is not None:
+            (transport, _) = await loop.create_datagram_endpoint(
+                lambda: _DatagramProtocol(self), local_addr=(host, udp_port)
+            )
+            self._transports.append(transport)
+            self.udp_address = transport.get_extra_info("sockname")[:2]
+        self._parse_task = asyncio.ensure_future(self._parse())
+
+    async def close(self):
+        """Stop listening, parse the queued batches and stop the worker processes."""
+        for server in self._servers:
+            server.close()
+        for transport in self._transports:
+            transport.close()
+        for connection in list(self._connections):
+            connection.cancel()
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+        self._transports = []
+        if self._parse_task is not None:
+            await self._queue.put(None)
+            await self._parse_task
+            self._parse_task = None
+        if self._parser is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._parser.close)
+            self._parser = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    async def _handle_connection(self, reader, writer):
+        self._connections.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(BATCH_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                try:
+                    (receiver, count, base, length) = decode_batch_header(header)
+                    frames = decode_frames(await reader.readexactly(length), count, base, length)
+                except (ValueError, asyncio.IncompleteReadError):
+                    # the stream can't be resynchronized
+                    self.invalid_batches += 1
+                    break
+                self._hand_off((receiver, frames))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._connections.discard(asyncio.current_task())
+            writer.close()
+
+    def _hand_off(self, batch):
+        try:
+            self._queue.put_nowait(batch)
+        except asyncio.QueueFull:
+            self.dropped_batches += 1
+
+    async def _parse(self):
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        stopping = False
+        while not stopping:
+            batch = await queue.get()
+            if batch is None:
+                break
+            # parse all the queued batches together
+            batches = [batch]
+            count = len(batch[1])
+            while count < self.max_frames and not queue.empty():
+                batch = queue.get_nowait()
+                if batch is None:
+                    stopping = True
+                    break
+                batches.append(batch)
+                count += len(batch[1])
+            frames = []
+            sources = []
+            for receiver, batch_frames in batches:
+                for timestamp, frame in batch_frames:
+                    frames.append(frame)
+                    sources.append((timestamp, receiver))
+            self.batches += len(batches)
+            self.frames += len(frames)
+            parse_errors = self._parser.parse_errors
+            try:
+                parsed = await loop.run_in_executor(self._executor, self._parser.parse_many, frames)
+            except Exception:
+                # the workers skip the frames that fail, this is a stopped worker or a timeout
+                self.lost_frames += len(frames)
+                _LOGGER.exception("Failed to parse a group of %s frames", len(frames))
+                continue
+            finally:
+                self.parse_errors += self._parser.parse_errors - parse_errors
+            results = [sources[index] + (sensor_data, tracker_data) for index, sensor_data, tracker_data in parsed]
+            if results:
+                await self._publish(results)
+
+    async def _publish(self, results):
+        self.results += len(results)
+        try:
+            if inspect.iscoroutinefunction(self.sink):
+                await self.sink(results)
+            else:
+                self.sink(results)
+        except Exception:
+            self.sink_errors += 1
+            _LOGGER.exception("Sink failed for a batch of %s results", len(results))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser(description="Run an ingest server for remote sniffers")
+    argparser.add_argument("--host", default="0.0.0.0")
+    argparser.add_argument("--tcp-port", type=int, default=7600)
+    argparser.add_argument("--udp-port", type=int, default=7600)
+    argparser.add_argument("--workers", type=int, help="parser processes, one per CPU by default")
+    args = argparser.parse_args()
+
+    def print_results(results):
+        for timestamp, receiver, sensor_data, tracker_data in results:
+            print(timestamp, receiver, sensor_data, tracker_data)
+
+    async def main():
+        server = IngestServer(print_results, args.workers)
+        await server.start(args.host, args.tcp_port, args.udp_port)
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        try:
+            import signal
+            loop.add_signal_handler(signal.SIGINT, stopped.set)
+            loop.add_signal_handler(signal.SIGTERM, stopped.set)
+        except (ImportError, NotImplementedError):
+            pass
+        await stopped.wait()
+        await server.close()
+        print(server.stats())
+
+    asyncio.run(main())
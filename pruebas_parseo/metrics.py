@@ -0,0 +1,161 @@
+"""Counters and parse time histograms of BleParser."""
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+import os
+
+# Drop reasons
+# the frame length doesn't match the HCI event
+DROP_INVALID_LENGTH = "invalid_length"
+# dropped by the whitelists, OUI lists or minimum RSSI
+DROP_FILTERED = "filtered"
+# no decoder for the AD structures
+DROP_UNKNOWN_ADVERTISEMENT = "unknown_advertisement"
+# the vendor parser couldn't be imported
+DROP_VENDOR_UNAVAILABLE = "vendor_unavailable"
+# byte-identical repeat of the last advertisement of the device
+DROP_REPEAT = "repeat"
+# same packet id as the previous advertisement of the device
+DROP_DUPLICATE = "duplicate"
+# a higher priority advertisement format of the device is received
+DROP_LOW_PRIORITY = "low_priority"
+# device or frame format not supported
+DROP_UNSUPPORTED = "unsupported"
+DROP_UNKNOWN_DEVICE = "unknown_device"
+DROP_MAC_MISMATCH = "mac_mismatch"
+# payload too short or without data
+DROP_INVALID_PAYLOAD = "invalid_payload"
+# encrypted payloads of devices in decryption backoff
+DROP_DECRYPTION_BLOCKED = "decryption_blocked"
+DROP_DECRYPTION_FAILED = "decryption_failed"
+
+# Parse time histogram buckets, upper bounds in seconds
+PARSE_TIME_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3)
+
+
+class ParserMetrics:
+    """Frame counters and parse time histograms.
+
+    Counters are plain dicts of ints, updating them costs about as much as
+    a dict lookup. Parse times are observed per vendor.
+    """
+    def __init__(self, buckets=PARSE_TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.frames = 0
+        # advertising reports in the frames, an event can hold several
+        self.reports = 0
+        # results served from the raw payload cache, without decoding
+        self.cache_hits = 0
+        # {vendor: count}
+        self.vendor_frames = defaultdict(int)
+        self.vendor_results = defaultdict(int)
+        # {drop reason: count}
+        self.drops = defaultdict(int)
+        # all drops, parsers compare it before and after a frame to tell drops from results
+        self.dropped = 0
+        # {device type: count}
+        self.device_types = defaultdict(int)
+        # {vendor: counts per bucket, the last one is +Inf}
+        self.parse_times = {}
+        self.parse_time_sums = defaultdict(float)
+
+    def drop(self, reason):
+        """Count a dropped frame."""
+        self.drops[reason] += 1
+        self.dropped += 1
+
+    def retract(self, vendor, device_type):
+        """Take back a result that was counted before it turned out to be a drop."""
+        self.vendor_results[vendor] -= 1
+        if device_type is not None:
+            self.device_types[device_type] -= 1
+
+    def observe(self, vendor, seconds):
+        """Add a parse time of a vendor parser to the histogram."""
+        try:
+            counts = self.parse_times[vendor]
+        except KeyError:
+            counts = self.parse_times[vendor] = array("Q", [0] * (len(self.buckets) + 1))
+        counts[bisect_left(self.buckets, seconds)] += 1
+        self.parse_time_sums[vendor] += seconds
+
+    def reset(self):
+        """Set all counters back to zero."""
+        self.__init__(self.buckets)
+
+    def snapshot(self):
+        """Return the metrics as a dict of plain values.
+
+        Histogram buckets are cumulative, like in Prometheus.
+        """
+        parse_times = {}
+        for vendor, counts in self.parse_times.items():
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                buckets[bound] = cumulative
+            parse_times[vendor] = {
+                "buckets": buckets,
+                "count": cumulative,
+                "sum": self.parse_time_sums[vendor],
+            }
+        return {
+            "frames": self.frames,
+            "reports": self.reports,
+            "cache_hits": self.cache_hits,
+            "vendor_frames": dict(self.vendor_frames),
+            "vendor_results": dict(self.vendor_results),
+            "drops": dict(self.drops),
+            "device_types": dict(self.device_types),
+            "parse_times": parse_times,
+        }
+
+    def prometheus(self, prefix="ble_parser"):
+        """Return the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+
+        def counter(name, help_text, values, label=None):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+            lines.append("# TYPE %s_%s counter" % (prefix, name))
+            if label is None:
+                lines.append("%s_%s %s" % (prefix, name, values))
+            else:
+                for key, value in sorted(values.items()):
+                    lines.append('%s_%s{%s="%s"} %s' % (prefix, name, label, _escape(key), value))
+
+        counter("frames_total", "Frames passed to the parser.", snapshot["frames"])
+        counter("reports_total", "Advertising reports in the frames.", snapshot["reports"])
+        counter("cache_hits_total", "Repeated advertisements served from the cache.", snapshot["cache_hits"])
+        counter("vendor_frames_total", "Frames decoded per vendor.", snapshot["vendor_frames"], "vendor")
+        counter("vendor_results_total", "Results per vendor.", snapshot["vendor_results"], "vendor")
+        counter("dropped_frames_total", "Dropped frames per reason.", snapshot["drops"], "reason")
+        counter("device_type_results_total", "Results per device type.", snapshot["device_types"], "type")
+
+        name = "%s_parse_seconds" % prefix
+        lines.append("# HELP %s Parse time of the vendor parsers." % name)
+        lines.append("# TYPE %s histogram" % name)
+        for vendor, histogram in sorted(snapshot["parse_times"].items()):
+            vendor = _escape(vendor)
+            for bound, count in histogram["buckets"].items():
+                bound = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('%s_bucket{vendor="%s",le="%s"} %s' % (name, vendor, bound, count))
+            lines.append('%s_sum{vendor="%s"} %r' % (name, vendor, histogram["sum"]))
+            lines.append('%s_count{vendor="%s"} %s' % (name, vendor, histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="ble_parser"):
+        """Write the Prometheus text to a file, for the node exporter textfile collector.
+
+        The file is replaced atomically, so the collector never reads a partial file.
+        """
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus(prefix))
+        os.replace(tmp_path, path)
+
+
+def _escape(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
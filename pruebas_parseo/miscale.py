@@ -1,9 +1,93 @@
 """Parser for Xiaomi Mi Scale BLE advertisements"""
 import logging
-from struct import unpack
+from struct import unpack_from
+
+from device_state import format_mac
+from metrics import DROP_DUPLICATE, DROP_UNKNOWN_DEVICE
+from readings import Reading
 
 _LOGGER = logging.getLogger(__name__)
 
+# Fixed schema of Mi Scale results, for columnar storage
+MISCALE_DTYPE = [
+    ("mac", "U12"),
+    ("type", "U11"),
+    ("packet", "U26"),
+    ("rssi", "i1"),
+    ("non-stabilized weight", "f4"),
+    ("weight", "f4"),
+    ("weight unit", "U3"),
+    ("weight removed", "u1"),
+    ("stabilized", "u1"),
+    ("impedance", "i4"),
+]
+
+
+class MiScaleReading(Reading):
+    """Reading of a Mi Scale, weight and flags are derived on access."""
+    __slots__ = (
+        "device_type", "address", "rssi", "control", "raw_weight", "divider",
+        "weight_unit", "impedance", "packet_id", "packet_length",
+    )
+    KEYS = {
+        "non-stabilized weight": "non_stabilized_weight",
+        "weight unit": "weight_unit",
+        "weight removed": "weight_removed",
+        "stabilized": "stabilized",
+        "weight": "weight",
+        "impedance": "impedance",
+        "type": "device_type",
+        "firmware": "device_type",
+        "mac": "mac",
+        "packet": "packet",
+        "rssi": "rssi",
+        "data": "data",
+    }
+    OPTIONAL = frozenset(["weight", "impedance"])
+    data = True
+
+    def __init__(
+        self, device_type, address, rssi, control, raw_weight, divider,
+        weight_unit, impedance, packet_id, packet_length
+    ):
+        self.device_type = device_type
+        self.address = address
+        self.rssi = rssi
+        self.control = control
+        self.raw_weight = raw_weight
+        self.divider = divider
+        self.weight_unit = weight_unit
+        self.impedance = impedance
+        self.packet_id = packet_id
+        self.packet_length = packet_length
+
+    @property
+    def non_stabilized_weight(self):
+        return self.raw_weight / self.divider
+
+    @property
+    def stabilized(self):
+        return 1 if self.control & (1 << 5) else 0
+
+    @property
+    def weight_removed(self):
+        return 1 if self.control & (1 << 7) else 0
+
+    @property
+    def weight(self):
+        """Weight, only when stabilized and not removed."""
+        if self.control & 0xA0 == 0x20:
+            return self.raw_weight / self.divider
+        return None
+
+    @property
+    def mac(self):
+        return format_mac(self.address)
+
+    @property
+    def packet(self):
+        return "%0*x" % (2 * self.packet_length, self.packet_id)
+
 
 def parse_miscale(self, data, source_mac, rssi):
     """Parser for Xiaomi Mi Scales."""
@@ -12,46 +96,41 @@ def parse_miscale(self, data, source_mac, rssi):
 
     if msg_length == 14 and uuid16 == 0x181D:  # Mi Scale V1
         device_type = "Mi Scale V1"
-        xvalue = data[4:]
-        (control_byte, weight) = unpack("<BH7x", xvalue)
-
-        has_impedance = False
-        is_stabilized = control_byte & (1 << 5)
-        weigth_removed = control_byte & (1 << 7)
+        (control_byte, weight) = unpack_from("<BH7x", data, 4)
+        impedance = None
 
         if control_byte & (1 << 0):
-            weight = weight / 100
+            divider = 100
             weight_unit = 'lbs'
         elif control_byte & (1 << 4):
-            weight = weight / 100
+            divider = 100
             weight_unit = 'jin'
         else:
-            weight = weight / 200
+            divider = 200
             weight_unit = 'kg'
 
     elif msg_length == 17 and uuid16 == 0x181B:  # Mi Scale V2
         device_type = "Mi Scale V2"
-        xvalue = data[4:]
-        (measunit, control_byte, impedance, weight) = unpack("<BB7xHH", xvalue)
-        has_impedance = control_byte & (1 << 1)
-        is_stabilized = control_byte & (1 << 5)
-        weigth_removed = control_byte & (1 << 7)
+        (measunit, control_byte, impedance, weight) = unpack_from("<BB7xHH", data, 4)
+        if not control_byte & (1 << 1):
+            # no impedance measured
+            impedance = None
 
         if measunit & (1 << 4):
             # measurement in Chinese Catty unit
-            weight = weight / 100
+            divider = 100
             weight_unit = "jin"
         elif measunit == 3:
             # measurement in lbs
-            weight = weight / 100
+            divider = 100
             weight_unit = "lbs"
         elif measunit == 2:
             # measurement in kg
-            weight = weight / 200
+            divider = 200
             weight_unit = "kg"
         else:
             # measurement in unknown unit
-            weight = weight / 100
+            divider = 100
             weight_unit = None
     else:
         device_type = None
@@ -63,26 +142,13 @@ def parse_miscale(self, data, source_mac, rssi):
                 to_mac(source_mac),
                 data.hex()
             )
+        self.metrics.drop(DROP_UNKNOWN_DEVICE)
         return None
 
-    result = {
-        "non-stabilized weight": weight,
-        "weight unit": weight_unit,
-        "weight removed": 0 if weigth_removed == 0 else 1,
-        "stabilized": 0 if is_stabilized == 0 else 1
-    }
-
-    if is_stabilized and not weigth_removed:
-        result.update({"weight": weight})
-
-    if has_impedance:
-        result.update({"impedance": impedance})
-
-    firmware = device_type
     miscale_mac = source_mac
 
-    # Check for duplicate messages
-    packet_id = xvalue.hex()
+    # Check for duplicate messages, the packet id is the measurement as integer
+    packet_id = int.from_bytes(data[4:], "big")
     try:
         prev_packet = self.lpacket_ids[miscale_mac]
     except KeyError:
@@ -91,29 +157,49 @@ def parse_miscale(self, data, source_mac, rssi):
     if prev_packet == packet_id:
         # only process new messages
         if self.filter_duplicates is True:
+            self.metrics.drop(DROP_DUPLICATE)
             return None
     self.lpacket_ids[miscale_mac] = packet_id
     if prev_packet is None:
         if self.filter_duplicates is True:
             # ignore first message after a restart
+            self.metrics.drop(DROP_DUPLICATE)
             return None
 
-    # check for MAC presence in sensor whitelist, if needed
-    if self.discovery is False and miscale_mac not in self.sensor_whitelist:
-        _LOGGER.debug("Discovery is disabled. MAC: %s is not whitelisted!", to_mac(miscale_mac))
-        return None
+    return MiScaleReading(
+        device_type, miscale_mac, rssi, control_byte, weight, divider,
+        weight_unit, impedance, packet_id, msg_length - 4
+    )
 
-    result.update({
-        "type": device_type,
-        "firmware": firmware,
-        "mac": ''.join('{:02X}'.format(x) for x in miscale_mac),
-        "packet": packet_id,
-        "rssi": rssi,
-        "data": True,
-    })
-    return result
+
+def miscale_array(columns):
+    """Convert Mi Scale result columns of BleParser.parse_many to a NumPy structured array.
+
+    Missing weights are NaN, missing impedances are -1.
+    """
+    try:
+        # NumPy is only imported for structured arrays, it slows down the first Mi Scale frame
+        import numpy as np
+    except ImportError:
+        raise ImportError("NumPy is needed for structured arrays") from None
+    rows = [i for i, device_type in enumerate(columns.get("type", [])) if device_type in ("Mi Scale V1", "Mi Scale V2")]
+    array = np.zeros(len(rows), dtype=MISCALE_DTYPE)
+    for name, _ in MISCALE_DTYPE:
+        column = columns.get(name)
+        if column is None:
+            column = [None] * len(columns["type"])
+        if name == "weight":
+            missing = np.nan
+        elif name == "impedance":
+            missing = -1
+        elif name == "weight unit":
+            missing = ""
+        else:
+            missing = 0
+        array[name] = [missing if column[i] is None else column[i] for i in rows]
+    return array
 
 
 def to_mac(addr: int):
     """Return formatted MAC address"""
-    return ':'.join('{:02x}'.format(x) for x in addr).upper()
+    return ':'.join('{:02X}'.format(x) for x in addr.to_bytes(6, 'big'))
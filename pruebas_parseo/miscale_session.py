@@ -0,0 +1,151 @@
+"""Aggregation of Mi Scale frames into one measurement per weigh-in."""
+from collections import OrderedDict
+import time
+
+from device_state import format_mac
+from miscale import MiScaleReading
+from readings import Reading
+
+
+class MiScaleMeasurement(Reading):
+    """Measurement of a weigh-in, the last stabilized weight of a session."""
+    __slots__ = (
+        "address", "device_type", "rssi", "weight", "weight_unit", "impedance", "duration", "samples",
+    )
+    KEYS = {
+        "mac": "mac",
+        "type": "device_type",
+        "rssi": "rssi",
+        "weight": "weight",
+        "weight unit": "weight_unit",
+        "impedance": "impedance",
+        "duration": "duration",
+        "samples": "samples",
+    }
+    OPTIONAL = frozenset(["impedance"])
+
+    def __init__(self, address, device_type, rssi, weight, weight_unit, impedance, duration, samples):
+        self.address = address
+        self.device_type = device_type
+        self.rssi = rssi
+        self.weight = weight
+        self.weight_unit = weight_unit
+        self.impedance = impedance
+        self.duration = duration
+        self.samples = samples
+
+    @property
+    def mac(self):
+        return format_mac(self.address)
+
+
+class _Session:
+    """Frames of a weigh-in that is in progress."""
+    __slots__ = ("started", "last_seen", "samples", "last", "stabilized", "impedance")
+
+    def __init__(self, now):
+        self.started = now
+        self.last_seen = now
+        self.samples = 0
+        # last frame and last stabilized frame
+        self.last = None
+        self.stabilized = None
+        self.impedance = None
+
+
+class MiScaleSessions:
+    """Streaming stage that turns Mi Scale frames into one measurement per weigh-in.
+
+    A session starts with the first frame of a scale with weight on it, and
+    ends with a "weight removed" frame or after timeout seconds without
+    frames. The measurement of a session is its last stabilized weight, with
+    the last measured impedance, the weight removed frame included (V2
+    scales send the impedance in it). Sessions that never stabilized are
+    dropped. The frames a scale keeps sending after the weight is removed
+    don't start a new session.
+    """
+    def __init__(self, timeout=30, max_sessions=256, clock=time.monotonic):
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self.aborted = 0
+        # {mac: session}, in least recently seen order
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def add(self, reading):
+        """Add a Mi Scale frame, return the measurements of the sessions it ends."""
+        now = self.clock()
+        measurements = self.expire(now)
+        mac = reading.address
+        session = self._sessions.get(mac)
+        if reading.weight_removed:
+            if session is not None:
+                # the last frame can hold the stabilized weight and the impedance (V2)
+                del self._sessions[mac]
+                self._record(session, reading, now)
+                self._close(session, measurements)
+            return measurements
+
+        if session is None:
+            if len(self._sessions) >= self.max_sessions:
+                (_, oldest) = self._sessions.popitem(last=False)
+                self._close(oldest, measurements)
+            session = self._sessions[mac] = _Session(now)
+        else:
+            self._sessions.move_to_end(mac)
+        session.samples += 1
+        self._record(session, reading, now)
+        return measurements
+
+    def _record(self, session, reading, now):
+        session.last_seen = now
+        session.last = reading
+        if reading.stabilized:
+            session.stabilized = reading
+            if reading.impedance is not None:
+                session.impedance = reading.impedance
+
+    def run(self, readings):
+        """Add the Mi Scale frames of a batch of results, return the measurements."""
+        measurements = []
+        for reading in readings:
+            if isinstance(reading, MiScaleReading):
+                measurements.extend(self.add(reading))
+        return measurements
+
+    def expire(self, now=None):
+        """Return the measurements of the sessions without frames for timeout seconds."""
+        if now is None:
+            now = self.clock()
+        deadline = now - self.timeout
+        measurements = []
+        sessions = self._sessions
+        while sessions:
+            mac = next(iter(sessions))
+            session = sessions[mac]
+            if session.last_seen > deadline:
+                break
+            del sessions[mac]
+            self._close(session, measurements)
+        return measurements
+
+    def flush(self):
+        """End all sessions, return their measurements."""
+        measurements = []
+        while self._sessions:
+            (_, session) = self._sessions.popitem(last=False)
+            self._close(session, measurements)
+        return measurements
+
+    def _close(self, session, measurements):
+        reading = session.stabilized
+        if reading is None:
+            self.aborted += 1
+            return
+        measurements.append(MiScaleMeasurement(
+            reading.address, reading.device_type, session.last.rssi, reading.non_stabilized_weight,
+            reading.weight_unit, session.impedance, session.last_seen - session.started, session.samples
+        ))
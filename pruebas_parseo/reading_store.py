@@ -0,0 +1,276 @@
+"""Append-only columnar store for parsed readings, in memory-mapped segment files."""
+import json
+import os
+import time
+
+from device_state import mac_to_int
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Fixed-width columns of the store
+# {column: dtype}
+READING_COLUMNS = {
+    "timestamp": "<f8",
+    "mac": "<u8",
+    "type": "<u2",
+    "weight": "<f4",
+    "impedance": "<i4",
+    "temperature": "<f4",
+    "humidity": "<f4",
+    "rssi": "i1",
+}
+
+# Values stored for missing fields, floats are NaN
+MISSING_IMPEDANCE = -1
+MISSING_RSSI = -128
+
+SEGMENT_META = "segment.json"
+TYPES_FILE = "types.json"
+
+
+def _write_json(path, value):
+    """Replace a JSON file atomically."""
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+class ReadingStore:
+    """Append-only store of readings, one memory-mapped file per column and segment.
+
+    Readings are appended to the active segment. A full segment is sealed:
+    its rows are sorted by MAC and timestamp and the segment is read-only
+    from then on, so a sealed segment is its own per-MAC index and a time
+    range of a device is found with two binary searches. Only the active
+    segment is scanned.
+
+    Appended readings are buffered, flush() writes them to the segment
+    files. Readings that weren't flushed are lost when the process stops.
+    """
+    def __init__(self, path, segment_size=1 << 20, buffer_size=4096):
+        if np is None:
+            raise ImportError("NumPy is needed for the reading store")
+        self.path = path
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+        os.makedirs(path, exist_ok=True)
+        # device type names, type code 0 is unknown
+        self._types_path = os.path.join(path, TYPES_FILE)
+        try:
+            with open(self._types_path) as f:
+                self.types = json.load(f)
+        except FileNotFoundError:
+            self.types = [None]
+        self._type_codes = {name: code for code, name in enumerate(self.types)}
+        self._buffer = []
+        self._segments = [
+            _Segment(os.path.join(path, name))
+            for name in sorted(os.listdir(path)) if name.startswith("segment-")
+        ]
+        if not self._segments or self._segments[-1].sealed:
+            self._new_segment()
+
+    def __len__(self):
+        return sum(segment.count for segment in self._segments) + len(self._buffer)
+
+    def type_code(self, device_type):
+        """Return the code of a device type, adding new device types to the store."""
+        try:
+            return self._type_codes[device_type]
+        except KeyError:
+            pass
+        code = self._type_codes[device_type] = len(self.types)
+        self.types.append(device_type)
+        _write_json(self._types_path, self.types)
+        return code
+
+    def append(self, reading, timestamp=None):
+        """Append a result of BleParser.parse_data."""
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            mac = reading.address
+        except AttributeError:
+            mac = mac_to_int(reading["mac"])
+        get = reading.get
+        weight = get("weight")
+        impedance = get("impedance")
+        temperature = get("temperature")
+        humidity = get("humidity")
+        rssi = get("rssi")
+        self._buffer.append((
+            timestamp,
+            mac,
+            self.type_code(get("type")),
+            float("nan") if weight is None else weight,
+            MISSING_IMPEDANCE if impedance is None else impedance,
+            float("nan") if temperature is None else temperature,
+            float("nan") if humidity is None else humidity,
+            MISSING_RSSI if rssi is None else rssi,
+        ))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def extend(self, readings, timestamps=None):
+        """Append a batch of results, with their timestamps or the current time."""
+        if timestamps is None:
+            now = time.time()
+            for reading in readings:
+                self.append(reading, now)
+        else:
+            for reading, timestamp in zip(readings, timestamps):
+                self.append(reading, timestamp)
+
+    def flush(self):
+        """Write the buffered readings to the segment files."""
+        rows = self._buffer
+        self._buffer = []
+        start = 0
+        while start < len(rows):
+            segment = self._segments[-1]
+            end = start + min(len(rows) - start, segment.capacity - segment.count)
+            segment.write(_to_columns(rows[start:end]))
+            start = end
+            if segment.count >= segment.capacity:
+                segment.seal()
+                self._new_segment()
+        self._segments[-1].save_meta()
+
+    def query(self, mac, start=None, end=None):
+        """Return the readings of a device from start (inclusive) to end (exclusive) as a structured array.
+
+        The readings are in timestamp order, device types are type codes (see types).
+        """
+        self.flush()
+        mac = mac_to_int(mac)
+        start = -np.inf if start is None else start
+        end = np.inf if end is None else end
+        parts = [
+            segment.query(mac, start, end)
+            for segment in self._segments
+            if segment.count and segment.start < end and segment.end >= start
+        ]
+        dtype = np.dtype(list(READING_COLUMNS.items()))
+        result = np.empty(sum(len(part["timestamp"]) for part in parts), dtype=dtype)
+        for name in READING_COLUMNS:
+            if parts:
+                result[name] = np.concatenate([part[name] for part in parts])
+        return result[np.argsort(result["timestamp"], kind="stable")]
+
+    def close(self):
+        self.flush()
+        for segment in self._segments:
+            segment.close()
+        self._segments = []
+
+    def _new_segment(self):
+        name = "segment-%06d" % len(self._segments)
+        self._segments.append(_Segment(os.path.join(self.path, name), self.segment_size))
+
+
+class _Segment:
+    """Column files of a segment, with count, time range and sealed flag in segment.json."""
+    def __init__(self, path, capacity=None):
+        self.path = path
+        meta_path = os.path.join(path, SEGMENT_META)
+        if capacity is not None:
+            # new segment, the column files are allocated at full size
+            os.makedirs(path)
+            self.capacity = capacity
+            self.count = 0
+            self.sealed = False
+            self.start = np.inf
+            self.end = -np.inf
+            for name, dtype in READING_COLUMNS.items():
+                with open(self._column_path(name), "wb") as f:
+                    f.truncate(capacity * np.dtype(dtype).itemsize)
+        else:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.capacity = meta["capacity"]
+            self.count = meta["count"]
+            self.sealed = meta["sealed"]
+            self.start = np.inf if meta["start"] is None else meta["start"]
+            self.end = -np.inf if meta["end"] is None else meta["end"]
+        self._map_columns()
+        if capacity is not None:
+            self.save_meta()
+
+    def _column_path(self, name):
+        return os.path.join(self.path, name + ".col")
+
+    def _map_columns(self):
+        mode = "r" if self.sealed else "r+"
+        self.columns = {
+            name: np.memmap(self._column_path(name), dtype=dtype, mode=mode, shape=(self.capacity,))
+            for name, dtype in READING_COLUMNS.items()
+        }
+
+    def save_meta(self):
+        if not self.sealed:
+            for column in self.columns.values():
+                column.flush()
+        _write_json(os.path.join(self.path, SEGMENT_META), {
+            "capacity": self.capacity,
+            "count": self.count,
+            "sealed": self.sealed,
+            "start": None if self.start == np.inf else self.start,
+            "end": None if self.end == -np.inf else self.end,
+        })
+
+    def write(self, columns):
+        """Append rows given as {column: array}."""
+        rows = len(columns["timestamp"])
+        for name, values in columns.items():
+            self.columns[name][self.count:self.count + rows] = values
+        self.count += rows
+        self.start = min(self.start, float(columns["timestamp"].min()))
+        self.end = max(self.end, float(columns["timestamp"].max()))
+
+    def seal(self):
+        """Sort the rows by MAC and timestamp and make the segment read-only."""
+        count = self.count
+        order = np.lexsort((self.columns["timestamp"][:count], self.columns["mac"][:count]))
+        for column in self.columns.values():
+            column[:count] = column[:count][order]
+        for column in self.columns.values():
+            column.flush()
+        self.sealed = True
+        self.save_meta()
+        self._map_columns()
+
+    def query(self, mac, start, end):
+        """Return {column: values} of the rows of a device in a time range."""
+        count = self.count
+        columns = self.columns
+        if self.sealed:
+            macs = columns["mac"][:count]
+            first = np.searchsorted(macs, mac, "left")
+            last = np.searchsorted(macs, mac, "right")
+            timestamps = columns["timestamp"][first:last]
+            rows = slice(
+                first + np.searchsorted(timestamps, start, "left"),
+                first + np.searchsorted(timestamps, end, "left"),
+            )
+        else:
+            timestamps = columns["timestamp"][:count]
+            rows = np.flatnonzero(
+                (columns["mac"][:count] == mac) & (timestamps >= start) & (timestamps < end)
+            )
+        return {name: np.array(column[rows]) for name, column in columns.items()}
+
+    def close(self):
+        self.columns = {}
+
+
+def _to_columns(rows):
+    """Return buffered rows as {column: array}."""
+    values = list(zip(*rows))
+    return {
+        name: np.array(column, dtype=dtype)
+        for (name, dtype), column in zip(READING_COLUMNS.items(), values)
+    }
@@ -0,0 +1,74 @@
+"""Result types of the vendor parsers."""
+from copy import copy
+
+
+class Reading:
+    """Base class of the parsed readings.
+
+    Readings are slotted objects with derived fields computed on access.
+    They can be read like the result dicts of the parsers (reading["mac"]),
+    as_dict() returns such a dict.
+    """
+    __slots__ = ()
+    # {result key: attribute}
+    KEYS = {}
+    # keys that are left out of the result when their value is None
+    OPTIONAL = frozenset()
+
+    def with_rssi(self, rssi):
+        """Return a copy of the reading with another RSSI."""
+        reading = copy(self)
+        reading.rssi = rssi
+        return reading
+
+    def as_dict(self):
+        """Return the reading as a result dict."""
+        result = {}
+        for key, attribute in self.KEYS.items():
+            value = getattr(self, attribute)
+            if value is not None or key not in self.OPTIONAL:
+                result[key] = value
+        return result
+
+    def __getitem__(self, key):
+        try:
+            attribute = self.KEYS[key]
+        except KeyError:
+            raise KeyError(key) from None
+        value = getattr(self, attribute)
+        if value is None and key in self.OPTIONAL:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.as_dict())
+
+    def __len__(self):
+        return len(self.as_dict())
+
+    def keys(self):
+        return self.as_dict().keys()
+
+    def items(self):
+        return self.as_dict().items()
+
+    def __eq__(self, other):
+        if isinstance(other, (Reading, dict)):
+            return self.as_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.as_dict())
@@ -0,0 +1,222 @@
+"""Suppression of the copies of an advertisement heard by several receivers."""
+from collections import deque
+from hashlib import blake2b
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import struct
+
+# Index entry: MAC + 1 (0 for empty entries), fingerprint, first seen,
+# receivers bit mask, best RSSI, best receiver, emitted flag
+ENTRY = struct.Struct("<QQdQbBB5x")
+
+# Offer outcomes
+OFFER_NEW = 0  # first copy, the caller emits the advertisement after the window
+OFFER_COPY = 1  # copy within the window, merged into the entry
+OFFER_LATE = 2  # copy after the window, dropped
+OFFER_FULL = 3  # no room in the index, the caller emits the copy as it is
+
+MAX_RECEIVERS = 64
+
+
+def fingerprint(payload):
+    """Return a 64-bit fingerprint of an advertisement payload, the same in every process."""
+    return int.from_bytes(blake2b(payload, digest_size=8).digest(), "little")
+
+
+class DedupIndex:
+    """Hash index of recently seen advertisements in shared memory.
+
+    The index is split in stripes, each with its own lock and open
+    addressing table, so processes offering different advertisements rarely
+    wait for each other. Entries older than the retention time are reused.
+    An index can be passed to processes started with multiprocessing.
+    """
+    def __init__(self, slots=1 << 16, stripes=16):
+        stripes = max(1, min(stripes, slots))
+        self.stripes = stripes
+        self.stripe_slots = slots // stripes
+        self.memory = shared_memory.SharedMemory(create=True, size=stripes * self.stripe_slots * ENTRY.size)
+        self.memory.buf[:] = bytes(len(self.memory.buf))
+        self.locks = [multiprocessing.Lock() for _ in range(stripes)]
+        # the creating process removes the shared memory
+        self._owner_pid = os.getpid()
+
+    def __getstate__(self):
+        return {
+            "stripes": self.stripes,
+            "stripe_slots": self.stripe_slots,
+            "name": self.memory.name,
+            "locks": self.locks,
+            "owner_pid": self._owner_pid,
+        }
+
+    def __setstate__(self, state):
+        self.stripes = state["stripes"]
+        self.stripe_slots = state["stripe_slots"]
+        self.memory = shared_memory.SharedMemory(state["name"])
+        self.locks = state["locks"]
+        self._owner_pid = state["owner_pid"]
+
+    def offer(self, mac, fingerprint, receiver, rssi, timestamp, window, retention):
+        """Add a copy of an advertisement, return (outcome, slot)."""
+        key = (fingerprint ^ (mac * 0x9E3779B97F4A7C15)) & 0xFFFFFFFFFFFFFFFF
+        stripe = key % self.stripes
+        stripe_slots = self.stripe_slots
+        first_slot = stripe * stripe_slots
+        home = (key // self.stripes) % stripe_slots
+        buffer = self.memory.buf
+        with self.locks[stripe]:
+            free = None
+            for probe in range(stripe_slots):
+                slot = first_slot + (home + probe) % stripe_slots
+                offset = slot * ENTRY.size
+                (entry_mac, entry_fingerprint, first_seen, receivers, best_rssi, best_receiver, emitted) = \
+                    ENTRY.unpack_from(buffer, offset)
+                if entry_mac == 0:
+                    if free is None:
+                        free = slot
+                    break
+                if timestamp - first_seen >= retention:
+                    if free is None:
+                        free = slot
+                    continue
+                if entry_mac != mac + 1 or entry_fingerprint != fingerprint:
+                    continue
+                if emitted or timestamp - first_seen >= window:
+                    return OFFER_LATE, slot
+                receivers |= 1 << receiver
+                if rssi > best_rssi:
+                    best_rssi = rssi
+                    best_receiver = receiver
+                ENTRY.pack_into(
+                    buffer, offset, entry_mac, entry_fingerprint, first_seen, receivers, best_rssi, best_receiver, 0
+                )
+                return OFFER_COPY, slot
+            if free is None:
+                return OFFER_FULL, None
+            ENTRY.pack_into(buffer, free * ENTRY.size, mac + 1, fingerprint, timestamp, 1 << receiver, rssi, receiver, 0)
+            return OFFER_NEW, free
+
+    def take(self, slot, mac, fingerprint):
+        """Mark an entry as emitted, return (best RSSI, best receiver, receivers bit mask).
+
+        Returns None if the entry was reused by another advertisement.
+        """
+        stripe = slot // self.stripe_slots
+        offset = slot * ENTRY.size
+        buffer = self.memory.buf
+        with self.locks[stripe]:
+            entry = ENTRY.unpack_from(buffer, offset)
+            if entry[0] != mac + 1 or entry[1] != fingerprint:
+                return None
+            ENTRY.pack_into(buffer, offset, *entry[:6], 1)
+        return entry[4], entry[5], entry[3]
+
+    def close(self):
+        """Release the shared memory, the process that created the index also removes it."""
+        self.memory.close()
+        if os.getpid() == self._owner_pid:
+            self.memory.unlink()
+
+
+class ReceiverDedup:
+    """Emits one copy of every advertisement heard by several receivers.
+
+    Frames of all the receivers are added with the name of the receiver.
+    The first copy of an advertisement (same MAC and payload) is held for
+    window seconds, copies heard by other receivers meanwhile only update
+    the best RSSI and the receivers that heard it, they aren't parsed.
+    After the window the
+    advertisement is emitted as (timestamp, sensor_data, best receiver,
+    receivers), with the best RSSI. Copies arriving later are dropped.
+
+    Processes or gateways sharing a DedupIndex deduplicate between each
+    other, each advertisement is emitted by the process that heard it
+    first. receivers has to be the same list in all of them. The parser
+    shouldn't filter duplicates, tracker results are ignored.
+    """
+    def __init__(self, parser, receivers, index=None, window=0.5):
+        if len(receivers) > MAX_RECEIVERS:
+            raise ValueError("At most %d receivers are supported" % MAX_RECEIVERS)
+        self.parser = parser
+        self.receivers = list(receivers)
+        self._receiver_ids = {receiver: number for number, receiver in enumerate(self.receivers)}
+        self._own_index = index is None
+        self.index = DedupIndex() if index is None else index
+        self.window = window
+        # entries are kept twice the window to drop late copies
+        self.retention = 2 * window
+        self.copies = 0
+        self.late_copies = 0
+        self.overflows = 0
+        # (deadline, slot, mac, fingerprint, timestamp, sensor_data, receiver) of the advertisements this process emits
+        self._pending = deque()
+
+    def add(self, receiver, timestamp, data):
+        """Add an HCI advertising report event heard by a receiver, return the advertisements that are due."""
+        try:
+            receiver_id = self._receiver_ids[receiver]
+        except KeyError:
+            raise ValueError("Unknown receiver: %s" % receiver) from None
+        parser = self.parser
+        emitted = []
+        for adpayload_start, adpayload_size, mac, rssi in parser.event_reports(data):
+            packet = fingerprint(data[adpayload_start:adpayload_start + adpayload_size])
+            (outcome, slot) = self.index.offer(
+                mac, packet, receiver_id, rssi, timestamp, self.window, self.retention
+            )
+            if outcome == OFFER_COPY:
+                self.copies += 1
+                continue
+            if outcome == OFFER_LATE:
+                self.late_copies += 1
+                continue
+            # only the first copy is parsed
+            sensor_data, _ = parser.parse_report(data, adpayload_start, adpayload_size, mac, rssi)
+            if sensor_data is None:
+                continue
+            if outcome == OFFER_NEW:
+                self._pending.append((timestamp + self.window, slot, mac, packet, timestamp, sensor_data, receiver))
+            else:
+                self.overflows += 1
+                emitted.append((timestamp, sensor_data, receiver, [receiver]))
+        emitted.extend(self.expire(timestamp))
+        return emitted
+
+    def expire(self, now):
+        """Return the held advertisements whose window has ended."""
+        emitted = []
+        pending = self._pending
+        while pending and pending[0][0] <= now:
+            emitted.append(self._emit(*pending.popleft()[1:]))
+        return emitted
+
+    def flush(self):
+        """Return all held advertisements."""
+        emitted = [self._emit(*entry[1:]) for entry in self._pending]
+        self._pending.clear()
+        return emitted
+
+    def _emit(self, slot, mac, packet, timestamp, sensor_data, receiver):
+        best = self.index.take(slot, mac, packet)
+        if best is None:
+            # the entry was reused, only this copy is known
+            return timestamp, sensor_data, receiver, [receiver]
+        (rssi, best_receiver, receivers) = best
+        if rssi != sensor_data.get("rssi"):
+            if isinstance(sensor_data, dict):
+                sensor_data = dict(sensor_data, rssi=rssi)
+            else:
+                sensor_data = sensor_data.with_rssi(rssi)
+        return (
+            timestamp,
+            sensor_data,
+            self.receivers[best_receiver],
+            [receiver for number, receiver in enumerate(self.receivers) if receivers >> number & 1],
+        )
+
+    def close(self):
+        """Release the index if it was created by this stage."""
+        if self._own_index:
+            self.index.close()
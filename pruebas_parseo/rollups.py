@@ -0,0 +1,187 @@
+"""Incremental min/max/mean/last rollups of sensor readings per time window."""
+from array import array
+import math
+
+from device_state import mac_to_int
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Rollup windows
+# {window: (bucket width in seconds, buckets kept)}
+DEFAULT_WINDOWS = {
+    "minute": (60, 360),
+    "hour": (3600, 24 * 31),
+    "day": (86400, 366),
+}
+
+# Result fields that are rolled up
+DEFAULT_FIELDS = ("weight", "temperature", "humidity")
+
+
+class _Buckets:
+    """Ring of fixed-size accumulators of one series and window.
+
+    A bucket is overwritten by the bucket that is size windows later, readings
+    older than the buckets in the ring are ignored.
+    """
+    __slots__ = ("width", "size", "ids", "count", "sum", "min", "max", "last", "last_ts")
+
+    def __init__(self, width, size):
+        self.width = width
+        self.size = size
+        # bucket number (timestamp // width) held by each slot, -1 for empty slots
+        self.ids = array("q", [-1]) * size
+        self.count = array("Q", [0]) * size
+        self.sum = array("d", [0.0]) * size
+        self.min = array("d", [0.0]) * size
+        self.max = array("d", [0.0]) * size
+        self.last = array("d", [0.0]) * size
+        self.last_ts = array("d", [0.0]) * size
+
+    def add(self, timestamp, value):
+        self.merge(int(timestamp // self.width), 1, value, value, value, value, timestamp)
+
+    def merge(self, bucket, count, total, minimum, maximum, last, last_ts):
+        """Add the aggregates of some readings of a bucket."""
+        slot = bucket % self.size
+        current = self.ids[slot]
+        if current != bucket:
+            if current > bucket:
+                # the ring has moved past this bucket
+                return
+            self.ids[slot] = bucket
+            self.count[slot] = count
+            self.sum[slot] = total
+            self.min[slot] = minimum
+            self.max[slot] = maximum
+            self.last[slot] = last
+            self.last_ts[slot] = last_ts
+            return
+        self.count[slot] += count
+        self.sum[slot] += total
+        if minimum < self.min[slot]:
+            self.min[slot] = minimum
+        if maximum > self.max[slot]:
+            self.max[slot] = maximum
+        if last_ts >= self.last_ts[slot]:
+            self.last[slot] = last
+            self.last_ts[slot] = last_ts
+
+    def query(self, start, end):
+        """Return the buckets from start (inclusive) to end (exclusive) as columns."""
+        width = self.width
+        first = -1 if start is None else math.floor(start / width)
+        last = None if end is None else math.ceil(end / width)
+        slots = sorted(
+            (bucket, slot) for slot, bucket in enumerate(self.ids)
+            if bucket >= first and bucket >= 0 and (last is None or bucket < last)
+        )
+        return {
+            "start": [bucket * width for bucket, _ in slots],
+            "count": [self.count[slot] for _, slot in slots],
+            "min": [self.min[slot] for _, slot in slots],
+            "max": [self.max[slot] for _, slot in slots],
+            "mean": [self.sum[slot] / self.count[slot] for _, slot in slots],
+            "last": [self.last[slot] for _, slot in slots],
+        }
+
+
+class RollupEngine:
+    """Per-device rollups of sensor readings for every window.
+
+    update() adds a result of BleParser in O(1) per field and window,
+    backfill() adds historical readings in bulk with NumPy. Buckets are
+    allocated on the first reading of a device and field.
+    """
+    def __init__(self, windows=DEFAULT_WINDOWS, fields=DEFAULT_FIELDS):
+        self.windows = dict(windows)
+        self.fields = tuple(fields)
+        # {(mac, field): {window: buckets}}
+        self._series = {}
+
+    def __len__(self):
+        return len(self._series)
+
+    def series(self):
+        """Return the (mac, field) pairs with rollups."""
+        return list(self._series)
+
+    def _buckets(self, mac, field):
+        try:
+            return self._series[mac, field]
+        except KeyError:
+            buckets = self._series[mac, field] = {
+                window: _Buckets(width, size) for window, (width, size) in self.windows.items()
+            }
+            return buckets
+
+    def update(self, reading, timestamp):
+        """Add the fields of a parse_data result, received at timestamp."""
+        try:
+            mac = reading.address
+        except AttributeError:
+            mac = mac_to_int(reading["mac"])
+        get = reading.get
+        for field in self.fields:
+            value = get(field)
+            if value is None or value != value:
+                continue
+            for buckets in self._buckets(mac, field).values():
+                buckets.add(timestamp, value)
+
+    def backfill(self, readings):
+        """Add historical readings in bulk.
+
+        readings is a structured array or dict of columns with timestamp, the
+        MAC as integer and the fields, like the result of ReadingStore.query.
+        Missing values are NaN.
+        """
+        if np is None:
+            raise ImportError("NumPy is needed for backfilling rollups")
+        timestamps = np.asarray(readings["timestamp"], dtype="f8")
+        macs = np.asarray(readings["mac"], dtype="u8")
+        names = readings.dtype.names if hasattr(readings, "dtype") else readings.keys()
+        for field in self.fields:
+            if field not in names:
+                continue
+            values = np.asarray(readings[field], dtype="f8")
+            present = ~np.isnan(values)
+            for window, (width, _) in self.windows.items():
+                self._backfill_window(window, width, field, macs[present], timestamps[present], values[present])
+
+    def _backfill_window(self, window, width, field, macs, timestamps, values):
+        if not len(values):
+            return
+        buckets = np.floor_divide(timestamps, width).astype("i8")
+        order = np.lexsort((timestamps, buckets, macs))
+        macs = macs[order]
+        buckets = buckets[order]
+        timestamps = timestamps[order]
+        values = values[order]
+        # first row of every (mac, bucket) group
+        change = np.flatnonzero((macs[1:] != macs[:-1]) | (buckets[1:] != buckets[:-1])) + 1
+        starts = np.concatenate(([0], change))
+        ends = np.concatenate((change, [len(values)])) - 1
+        counts = np.diff(np.concatenate((starts, [len(values)])))
+        totals = np.add.reduceat(values, starts)
+        minima = np.minimum.reduceat(values, starts)
+        maxima = np.maximum.reduceat(values, starts)
+        for group in range(len(starts)):
+            last = ends[group]
+            self._buckets(int(macs[last]), field)[window].merge(
+                int(buckets[last]), int(counts[group]), float(totals[group]), float(minima[group]),
+                float(maxima[group]), float(values[last]), float(timestamps[last])
+            )
+
+    def query(self, mac, field, window, start=None, end=None):
+        """Return the buckets of a device, field and window from start to end as columns.
+
+        The columns are start (of the bucket), count, min, max, mean and last.
+        """
+        buckets = self._series.get((mac_to_int(mac), field))
+        if buckets is None:
+            return {"start": [], "count": [], "min": [], "max": [], "mean": [], "last": []}
+        return buckets[window].query(start, end)
@@ -0,0 +1,286 @@
+"""Parsing on several processes, sharded by MAC address."""
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import struct
+
+from ble_parser import BleParser, report_offsets
+
+_LOGGER = logging.getLogger(__name__)
+
+# Ring header: write position, read position (bytes written and read since the start)
+RING_HEADER = struct.Struct("<QQ")
+# Record header: frame length, sequence number of the frame, report number in the frame
+RECORD_HEADER = struct.Struct("<HQH")
+# Frame lengths with a special meaning
+RECORD_PADDING = 0xFFFF  # the rest of the ring is unused, continue at its start
+RECORD_STOP = 0xFFFE  # the worker stops
+RECORD_DONE = 0xFFFD  # end of the frames of a parse_many call
+
+
+def split_event(data):
+    """Return [(MAC, frame)] for the reports of an HCI advertising report event.
+
+    Events with one report are returned as they are, the reports of events
+    with several reports are returned as events with a single report.
+    Returns None if the event length is invalid.
+    """
+    reports = report_offsets(data)
+    if reports is None:
+        return None
+    frames = []
+    for adpayload_start, adpayload_size, mac_start, rssi_index in reports:
+        mac = int.from_bytes(data[mac_start:mac_start + 6], "little")
+        if len(reports) == 1:
+            frames.append((mac, data))
+        else:
+            if data[3] == 0x0D:
+                report = data[mac_start - 3:adpayload_start + adpayload_size]
+            else:
+                report = data[mac_start - 2:rssi_index + 1]
+            frames.append((mac, bytes([data[0], data[1], len(report) + 2, data[3], 1]) + report))
+    return frames
+
+
+class _Ring:
+    """Single producer, single consumer ring of frames in a shared memory buffer.
+
+    The positions in the header only grow, the producer publishes the write
+    position after a batch of frames and the consumer the read position
+    after parsing them. The semaphores of the shard are the memory barriers.
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.capacity = len(buffer) - RING_HEADER.size
+        # position of the next record to write or read, the producer publishes it later
+        self.position = 0
+
+    def _offset(self, position):
+        return RING_HEADER.size + position % self.capacity
+
+    def write(self, length, seq, report=0, frame=b""):
+        """Write a record after the last one, return False if the ring is full."""
+        (_, read_position) = RING_HEADER.unpack_from(self.buffer)
+        position = self.position
+        space = self.capacity - position % self.capacity
+        padding = space if space < RECORD_HEADER.size + len(frame) else 0
+        if position + padding + RECORD_HEADER.size + len(frame) - read_position > self.capacity:
+            return False
+        if padding:
+            if padding >= RECORD_HEADER.size:
+                RECORD_HEADER.pack_into(self.buffer, self._offset(position), RECORD_PADDING, 0, 0)
+            position += padding
+        offset = self._offset(position)
+        RECORD_HEADER.pack_into(self.buffer, offset, length, seq, report)
+        offset += RECORD_HEADER.size
+        self.buffer[offset:offset + len(frame)] = frame
+        self.position = position + RECORD_HEADER.size + len(frame)
+        return True
+
+    def publish(self):
+        """Make the written records visible to the consumer."""
+        struct.pack_into("<Q", self.buffer, 0, self.position)
+
+    def read(self):
+        """Yield (length, seq, report, frame) of the published records, frame is a copy."""
+        (write_position, _) = RING_HEADER.unpack_from(self.buffer)
+        position = self.position
+        while position < write_position:
+            space = self.capacity - position % self.capacity
+            if space < RECORD_HEADER.size:
+                position += space
+                continue
+            offset = self._offset(position)
+            (length, seq, report) = RECORD_HEADER.unpack_from(self.buffer, offset)
+            if length == RECORD_PADDING:
+                position += space
+                continue
+            offset += RECORD_HEADER.size
+            if length == RECORD_STOP or length == RECORD_DONE:
+                position += RECORD_HEADER.size
+                self.position = position
+                yield length, seq, report, None
+                continue
+            frame = bytes(self.buffer[offset:offset + length])
+            position += RECORD_HEADER.size + length
+            self.position = position
+            yield length, seq, report, frame
+
+    def release(self):
+        """Give the space of the read records back to the producer."""
+        struct.pack_into("<Q", self.buffer, 8, self.position)
+
+
+def _worker(shard, memory_name, items, space, results, parser_kwargs):
+    """Parse the frames of a ring, put (shard, done, [(seq, report, sensor_data, tracker_data)], errors) per batch.
+
+    done is True for the batch that ends the frames of a parse_many call,
+    errors is the number of frames of the batch that failed to parse.
+    """
+    memory = shared_memory.SharedMemory(memory_name)
+    try:
+        ring = _Ring(memory.buf)
+        parser = BleParser(**parser_kwargs)
+        parse_event = parser.parse_event
+        stopping = False
+        while not stopping:
+            items.acquire()
+            batch = []
+            errors = 0
+            for length, seq, report, frame in ring.read():
+                if length == RECORD_STOP:
+                    stopping = True
+                    break
+                if length == RECORD_DONE:
+                    results.put((shard, True, batch, errors))
+                    batch = []
+                    errors = 0
+                    continue
+                try:
+                    reports = parse_event(frame)
+                except Exception:
+                    errors += 1
+                    _LOGGER.exception("Failed to parse frame %s", frame.hex())
+                    continue
+                for sensor_data, tracker_data in reports:
+                    if sensor_data is not None or tracker_data is not None:
+                        batch.append((seq, report, sensor_data, tracker_data))
+            ring.release()
+            space.release()
+            if batch or errors:
+                results.put((shard, False, batch, errors))
+        results.put((shard, None, parser.metrics.snapshot(), 0))
+        del ring
+    finally:
+        memory.close()
+
+
+class ShardedParser:
+    """Front end that parses frames on worker processes, each with its own BleParser.
+
+    The reports of a device always go to the same worker (MAC modulo the
+    number of workers), so the dedup state of every device stays in one
+    parser. Frames are copied to the workers through shared memory rings,
+    only the results are pickled. Results are returned in the order of the
+    frames.
+    """
+    def __init__(self, workers=None, ring_size=1 << 20, batch_size=256, timeout=30, **parser_kwargs):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        # frames written to a ring before the worker is woken up
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.invalid_frames = 0
+        # frames whose parser raised an exception, the workers log and skip them
+        self.parse_errors = 0
+        self._seq = 0
+        self._results = multiprocessing.Queue()
+        self._shards = []
+        for shard in range(workers):
+            memory = shared_memory.SharedMemory(create=True, size=RING_HEADER.size + ring_size)
+            memory.buf[:RING_HEADER.size] = bytes(RING_HEADER.size)
+            items = multiprocessing.Semaphore(0)
+            space = multiprocessing.Semaphore(0)
+            process = multiprocessing.Process(
+                target=_worker, name="ble-parser-%d" % shard, daemon=True,
+                args=(shard, memory.name, items, space, self._results, parser_kwargs),
+            )
+            process.start()
+            self._shards.append(_Shard(memory, items, space, process))
+
+    def parse_many(self, frames):
+        """Parse an iterable of frames, return [(frame index, sensor_data, tracker_data)] in frame order.
+
+        The reports of a frame are in their order in the frame. Only the reports with a sensor or tracker result are returned.
+        """
+        first_seq = self._seq
+        used_shards = set()
+        workers = self.workers
+        for seq, data in enumerate(frames, first_seq):
+            reports = split_event(data)
+            if reports is None:
+                self.invalid_frames += 1
+                continue
+            for report, (mac, frame) in enumerate(reports):
+                shard = mac % workers
+                self._write(shard, len(frame), seq, report, frame)
+                used_shards.add(shard)
+            self._seq = seq + 1
+        # the workers answer the end marker after the results of all the frames before it
+        for shard in used_shards:
+            self._write(shard, RECORD_DONE, 0)
+            self._shards[shard].publish()
+
+        results = []
+        pending = used_shards
+        while pending:
+            try:
+                (shard, done, batch, errors) = self._results.get(timeout=self.timeout)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            results.extend(batch)
+            self.parse_errors += errors
+            if done:
+                pending.discard(shard)
+        results.sort(key=lambda result: result[:2])
+        return [(seq - first_seq, sensor_data, tracker_data) for seq, _, sensor_data, tracker_data in results]
+
+    def _write(self, shard, length, seq, report=0, frame=b""):
+        shard = self._shards[shard]
+        while not shard.ring.write(length, seq, report, frame):
+            # ring full, let the worker catch up
+            shard.publish()
+            shard.space.acquire(timeout=0.1)
+            self._check_workers()
+        shard.unpublished += 1
+        if shard.unpublished >= self.batch_size:
+            shard.publish()
+
+    def _check_workers(self):
+        for shard in self._shards:
+            if not shard.process.is_alive():
+                raise RuntimeError("Parser worker %s stopped" % shard.process.name)
+
+    def close(self):
+        """Stop the workers, return the metrics snapshots of their parsers."""
+        for shard in range(len(self._shards)):
+            self._write(shard, RECORD_STOP, 0)
+            self._shards[shard].publish()
+        metrics = {}
+        while len(metrics) < len(self._shards):
+            (shard, done, batch, _) = self._results.get(timeout=self.timeout)
+            if done is None:
+                metrics[shard] = batch
+        for shard in self._shards:
+            shard.process.join()
+            shard.ring = None
+            shard.memory.close()
+            shard.memory.unlink()
+        self._shards = []
+        return [metrics[shard] for shard in sorted(metrics)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._shards:
+            self.close()
+
+
+class _Shard:
+    """Shared memory ring, semaphores and process of a worker."""
+    def __init__(self, memory, items, space, process):
+        self.memory = memory
+        self.ring = _Ring(memory.buf)
+        self.items = items
+        self.space = space
+        self.process = process
+        self.unpublished = 0
+
+    def publish(self):
+        self.ring.publish()
+        self.unpublished = 0
+        self.items.release()
@@ -0,0 +1,195 @@
+"""Snapshots of the per-MAC dedup state of BleParser, for warm restarts."""
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+_LOGGER = logging.getLogger(__name__)
+
+# File header: magic, version, record size
+FILE_HEADER = struct.Struct("<4sHH24x")
+FILE_MAGIC = b"BLDS"
+FILE_VERSION = 1
+# Record: MAC, packet id (little endian), adv priority, flags, then the CRC32 of the record
+RECORD_BODY = struct.Struct("<Q16sbB2x")
+RECORD_CRC = struct.Struct("<I")
+RECORD_SIZE = RECORD_BODY.size + RECORD_CRC.size
+EMPTY_RECORD = bytes(RECORD_SIZE)
+
+# Record flags
+HAS_PACKET = 0x01
+HAS_ADV_PRIORITY = 0x02
+
+
+def encode_record(mac, packet_id, adv_priority):
+    """Return the 32-byte record of a device, None if the packet id can't be stored."""
+    flags = 0
+    packet = bytes(16)
+    if packet_id is not None:
+        if not isinstance(packet_id, int) or not 0 <= packet_id < 1 << 128:
+            return None
+        packet = packet_id.to_bytes(16, "little")
+        flags |= HAS_PACKET
+    if adv_priority is not None:
+        flags |= HAS_ADV_PRIORITY
+    else:
+        adv_priority = 0
+    body = RECORD_BODY.pack(mac, packet, adv_priority, flags)
+    return body + RECORD_CRC.pack(zlib.crc32(body))
+
+
+class StateSnapshots:
+    """Writes the packet ids and adv priorities of the devices of a parser to a file.
+
+    The file is a header followed by fixed-size records, one slot per
+    device. Every snapshot only writes the records of the devices that
+    changed since the last one, and clears the slots of devices that are
+    gone. A record torn by a crash fails its CRC and is skipped on restore.
+    start() takes snapshots every interval seconds on a background thread.
+    """
+    def __init__(self, parser, path, interval=10.0):
+        self.parser = parser
+        self.path = path
+        self.interval = interval
+        self.records_written = 0
+        # {mac: slot} and {mac: record} of the records in the file
+        self._slots = {}
+        self._records = {}
+        self._free = []
+        self._slot_count = 0
+        self._fd = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def restore(self):
+        """Load the state of the devices in the file into the parser, return the number of devices."""
+        with self._lock:
+            self._slots = {}
+            self._records = {}
+            self._free = []
+            self._slot_count = 0
+            try:
+                f = open(self.path, "rb")
+            except FileNotFoundError:
+                return 0
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                if size < FILE_HEADER.size:
+                    return 0
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                    (magic, version, record_size) = FILE_HEADER.unpack_from(view)
+                    if magic != FILE_MAGIC or version != FILE_VERSION or record_size != RECORD_SIZE:
+                        _LOGGER.warning("Ignoring state snapshot %s of another format", self.path)
+                        return 0
+                    self._restore_records(view, (size - FILE_HEADER.size) // RECORD_SIZE)
+            return len(self._records)
+
+    def _restore_records(self, view, slot_count):
+        lpacket_ids = self.parser.lpacket_ids
+        adv_priority = self.parser.adv_priority
+        corrupt = 0
+        for slot in range(slot_count):
+            offset = FILE_HEADER.size + slot * RECORD_SIZE
+            record = view[offset:offset + RECORD_SIZE]
+            (mac, packet, priority, flags) = RECORD_BODY.unpack_from(record)
+            if not flags or RECORD_CRC.unpack_from(record, RECORD_BODY.size)[0] != zlib.crc32(record[:RECORD_BODY.size]):
+                if flags or record != EMPTY_RECORD:
+                    corrupt += 1
+                self._free.append(slot)
+                continue
+            if flags & HAS_PACKET:
+                lpacket_ids[mac] = int.from_bytes(packet, "little")
+            if flags & HAS_ADV_PRIORITY:
+                adv_priority[mac] = priority
+            self._slots[mac] = slot
+            self._records[mac] = record
+        self._slot_count = slot_count
+        if corrupt:
+            _LOGGER.warning("Skipped %s corrupt records of state snapshot %s", corrupt, self.path)
+
+    def snapshot(self):
+        """Write the devices that changed since the last snapshot, return the number of records written."""
+        packets = self.parser.lpacket_ids.snapshot()
+        priorities = self.parser.adv_priority.snapshot()
+        with self._lock:
+            if self._fd is None:
+                self._open()
+            writes = {}
+            records = {}
+            for mac in packets.keys() | priorities.keys():
+                record = encode_record(mac, packets.get(mac), priorities.get(mac))
+                if record is None:
+                    continue
+                records[mac] = record
+                if self._records.get(mac) == record:
+                    continue
+                slot = self._slots.get(mac)
+                if slot is None:
+                    slot = self._allocate()
+                    self._slots[mac] = slot
+                writes[slot] = record
+            for mac in self._records.keys() - records.keys():
+                slot = self._slots.pop(mac)
+                self._free.append(slot)
+                writes[slot] = EMPTY_RECORD
+            self._records = records
+            self._write(writes)
+            self.records_written += len(writes)
+            return len(writes)
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if not self._slot_count:
+            # new file, or one that restore() didn't load
+            os.ftruncate(self._fd, 0)
+            os.pwrite(self._fd, FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, RECORD_SIZE), 0)
+
+    def _allocate(self):
+        if self._free:
+            return self._free.pop()
+        self._slot_count += 1
+        return self._slot_count - 1
+
+    def _write(self, writes):
+        """Write {slot: record}, consecutive slots with one call."""
+        if not writes:
+            return
+        slots = sorted(writes)
+        start = 0
+        for end in range(1, len(slots) + 1):
+            if end == len(slots) or slots[end] != slots[end - 1] + 1:
+                data = b"".join(writes[slot] for slot in slots[start:end])
+                os.pwrite(self._fd, data, FILE_HEADER.size + slots[start] * RECORD_SIZE)
+                start = end
+        os.fsync(self._fd)
+
+    def start(self):
+        """Take snapshots on a background thread."""
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="ble-state-snapshots", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.snapshot()
+            except OSError:
+                _LOGGER.exception("Failed to write state snapshot %s", self.path)
+
+    def stop(self):
+        """Stop the background thread and take a last snapshot."""
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+        self.snapshot()
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
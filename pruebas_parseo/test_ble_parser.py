@@ -0,0 +1,228 @@
+"""The tests for the BleParser dispatch."""
+import os
+import subprocess
+import sys
+import threading
+
+from ble_parser import BleParser
+
+MISCALE_V1 = "043e1d020100008995c08c47c8110201060d161d1820584d0000000000000064"
+XIAOMI_PLAIN = "043e200201000001000038c1a414131695fe50505b050101000038c1a4041002e600c4"
+
+
+class TestBleParser:
+    """Tests for the BleParser"""
+    def test_register_decoder(self):
+        """Test registering and removing a vendor decoder at runtime."""
+        data = bytes(bytearray.fromhex(MISCALE_V1))
+        calls = []
+
+        def parse_custom(self, adstruct, mac, rssi):
+            calls.append(mac)
+            return {"custom": True}
+
+        ble_parser = BleParser()
+        ble_parser.register_decoder(0x16, 0x181D, "custom", parse_custom)
+        sensor_msg, tracker_msg = ble_parser.parse_data(data)
+        assert sensor_msg == {"custom": True}
+        assert calls == [0xC8478CC09589]
+
+        assert ble_parser.unregister_decoder(0x16, 0x181D)
+        assert not ble_parser.unregister_decoder(0x16, 0x181D)
+        sensor_msg, tracker_msg = ble_parser.parse_data(data)
+        assert sensor_msg is None
+
+    def test_missing_vendor_parser(self):
+        """Test that vendors without a parser in this tree are skipped."""
+        # Qingping service data (UUID16 0xFDCD)
+        data = bytes(bytearray.fromhex("043e1d020100008995c08c47c8110201060d16cdfd20584d0000000000000064"))
+
+        ble_parser = BleParser()
+        sensor_msg, tracker_msg = ble_parser.parse_data(data)
+        assert sensor_msg is None
+        assert tracker_msg is None
+
+    def test_zero_copy(self):
+        """Test parsing a memoryview of a mutable buffer."""
+        data = bytearray.fromhex(MISCALE_V1)
+
+        ble_parser = BleParser(zero_copy=True, tracker_whitelist=[bytes.fromhex("C8478CC09589")])
+        sensor_msg, tracker_msg = ble_parser.parse_data(data)
+
+        assert sensor_msg["mac"] == "C8478CC09589"
+        assert sensor_msg["packet"] == "20584d00000000000000"
+        assert sensor_msg["weight"] == 99.0
+        assert tracker_msg["mac"] == "C8478CC09589"
+        assert ble_parser.lpacket_ids[0xC8478CC09589] == 0x20584d00000000000000
+
+    def test_admission_filter(self):
+        """Test dropping frames on whitelist, OUI and RSSI before decoding."""
+        data = bytes(bytearray.fromhex(MISCALE_V1))
+        calls = []
+
+        def parse_custom(self, adstruct, mac, rssi):
+            calls.append(mac)
+            return {"custom": True}
+
+        ble_parser = BleParser(discovery=False, tracker_whitelist=["C8:47:8C:C0:95:89"])
+        ble_parser.register_decoder(0x16, 0x181D, "custom", parse_custom)
+        sensor_msg, tracker_msg = ble_parser.parse_data(data)
+        assert sensor_msg is None
+        assert tracker_msg == {"is connected": True, "mac": "C8478CC09589", "rssi": 100}
+        assert calls == []
+
+        ble_parser.sensor_whitelist.add(0xC8478CC09589)
+        sensor_msg, tracker_msg = ble_parser.parse_data(data)
+        assert sensor_msg == {"custom": True}
+
+        # discovery and the whitelists can be changed after construction
+        ble_parser = BleParser(cache_raw=False)
+        ble_parser.register_decoder(0x16, 0x181D, "custom", lambda parser, adstruct, mac, rssi: {"custom": True})
+        ble_parser.discovery = False
+        assert ble_parser.parse_data(data) == (None, None)
+        ble_parser.sensor_whitelist.append(bytes.fromhex("C8478CC09589"))
+        assert ble_parser.parse_data(data)[0] == {"custom": True}
+        ble_parser.sensor_whitelist = []
+        assert ble_parser.parse_data(data) == (None, None)
+        ble_parser.tracker_whitelist = ["C8:47:8C:C0:95:89"]
+        assert ble_parser.parse_data(data)[1]["mac"] == "C8478CC09589"
+        ble_parser.discovery = True
+        assert ble_parser.parse_data(data)[0] == {"custom": True}
+
+        for options in ({"oui_deny": ["C8:47:8C"]}, {"oui_allow": ["A4:C1:38"]}, {"min_rssi": 101}):
+            ble_parser = BleParser(**options)
+            ble_parser.register_decoder(0x16, 0x181D, "custom", parse_custom)
+            assert ble_parser.parse_data(data) == (None, None)
+        assert len(calls) == 1
+
+    def test_raw_cache(self):
+        """Test that byte-identical repeats are not decoded again."""
+        data = bytearray.fromhex(MISCALE_V1)
+        calls = []
+
+        def parse_custom(self, adstruct, mac, rssi):
+            calls.append(mac)
+            return {"custom": True, "rssi": rssi}
+
+        ble_parser = BleParser()
+        ble_parser.register_decoder(0x16, 0x181D, "custom", parse_custom)
+        assert ble_parser.parse_data(bytes(data))[0] == {"custom": True, "rssi": 100}
+        # same advertisement with another RSSI
+        data[-1] = 0xC4
+        assert ble_parser.parse_data(bytes(data))[0] == {"custom": True, "rssi": -60}
+        assert len(calls) == 1
+
+        # results without RSSI are copies of the cached result too
+        untyped = BleParser()
+        untyped.register_decoder(0x16, 0x181D, "custom", lambda parser, adstruct, mac, rssi: {"custom": True})
+        untyped.parse_data(bytes(data))[0]["custom"] = False
+        first = untyped.parse_data(bytes(data))[0]
+        first["custom"] = False
+        assert untyped.parse_data(bytes(data))[0] == {"custom": True}
+
+        ble_parser.filter_duplicates = True
+        assert ble_parser.parse_data(bytes(data)) == (None, None)
+        assert len(calls) == 1
+
+    def test_raw_cache_miscale_duplicates(self):
+        """Test that duplicate filtering is the same with and without the raw cache."""
+        frames = [bytes(bytearray.fromhex(data_string)) for data_string in [
+            MISCALE_V1,
+            MISCALE_V1,
+            "043e1d020100008995c08c47c8110201060d161d1820684d0000000000000064",
+            "043e1d020100008995c08c47c8110201060d161d1820684d0000000000000064",
+            MISCALE_V1,
+        ]]
+        for filter_duplicates in (False, True):
+            results = []
+            for cache_raw in (False, True):
+                ble_parser = BleParser(filter_duplicates=filter_duplicates, cache_raw=cache_raw)
+                results.append([
+                    None if sensor_msg is None else sensor_msg.as_dict()
+                    for sensor_msg, tracker_msg in map(ble_parser.parse_data, frames)
+                ])
+            assert results[0] == results[1]
+
+    def test_lazy_vendor_import(self):
+        """Test that vendor modules and Cryptodome are imported on first use."""
+        script = (
+            "import sys\n"
+            "from ble_parser import BleParser\n"
+            "assert 'xiaomi' not in sys.modules and 'miscale' not in sys.modules\n"
+            f"BleParser().parse_data(bytes.fromhex('{MISCALE_V1}'))\n"
+            "assert 'miscale' in sys.modules and 'xiaomi' not in sys.modules\n"
+            f"BleParser().parse_data(bytes.fromhex('{XIAOMI_PLAIN}'))\n"
+            "assert 'xiaomi' in sys.modules and 'Cryptodome' not in sys.modules\n"
+        )
+        subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(__file__), check=True)
+
+    def test_multiple_reports(self):
+        """Test legacy and extended events with several advertising reports."""
+        def event(subevent, frames):
+            reports = b"".join(bytes.fromhex(frame)[5:] for frame in frames)
+            return bytes([0x04, 0x3E, len(reports) + 2, subevent, len(frames)]) + reports
+
+        ble_parser = BleParser()
+        reports = ble_parser.parse_event(event(0x02, [MISCALE_V1, XIAOMI_PLAIN]))
+        assert [(sensor_msg["type"], sensor_msg["rssi"]) for sensor_msg, _ in reports] == [
+            ("Mi Scale V1", 100), ("LYWSD03MMC", -60)
+        ]
+        assert ble_parser.parse_data(event(0x02, [XIAOMI_PLAIN, MISCALE_V1]))[0]["type"] == "LYWSD03MMC"
+
+        extended = "043e390d011300008995c08c47c80100ff7fc70000000000000000001f02010603021d1809ff5701c8478cc095890d161d18821400e507040b101708"
+        reports = ble_parser.parse_event(event(0x0D, [extended, extended, extended]))
+        assert [sensor_msg["non-stabilized weight"] for sensor_msg, _ in reports] == [0.1] * 3
+        assert ble_parser.metrics.reports == 7
+
+        # a report that doesn't fit in the event drops the event
+        assert ble_parser.parse_event(event(0x02, [MISCALE_V1, XIAOMI_PLAIN])[:-1]) == []
+        data = bytearray(event(0x02, [MISCALE_V1, XIAOMI_PLAIN]))
+        data[4] = 3
+        assert ble_parser.parse_event(bytes(data)) == []
+        assert ble_parser.parse_event(b"") == []
+        assert ble_parser.metrics.drops["invalid_length"] == 3
+        # manufacturer data too short for a company identifier
+        short = extended.replace("09ff5701", "02ff5701", 1)
+        assert ble_parser.parse_event(bytes.fromhex(short)) == [(None, None)]
+        assert ble_parser.metrics.drops["invalid_length"] == 4
+
+        # whole-payload decoders get the AD structures up to the end of their report
+        payloads = []
+
+        def parse_custom(self, adstruct, mac, rssi):
+            payloads.append(bytes(adstruct))
+            return {"custom": True}
+
+        ble_parser = BleParser()
+        ble_parser.register_decoder(0x16, 0x181D, "custom", parse_custom, whole_payload=True)
+        ble_parser.parse_event(event(0x02, [MISCALE_V1, XIAOMI_PLAIN]))
+        assert payloads == [bytes.fromhex(MISCALE_V1)[17:-1]]
+
+    def test_concurrent_threads(self):
+        """Test that duplicates are filtered once when threads share a parser."""
+        frames = []
+        for device in range(50):
+            data = bytearray.fromhex(XIAOMI_PLAIN)
+            # MAC of the report and of the MiBeacon payload
+            data[7] = data[23] = device
+            frames.append(bytes(data))
+        ble_parser = BleParser(filter_duplicates=True)
+        results = []
+
+        def scan():
+            for data in frames:
+                sensor_msg, _ = ble_parser.parse_data(data)
+                if sensor_msg is not None:
+                    results.append(sensor_msg["mac"])
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=scan) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        assert sorted(results) == sorted("A4C1380000%02X" % device for device in range(50))
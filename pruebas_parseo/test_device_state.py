@@ -0,0 +1,67 @@
+"""The tests for the per-MAC state table."""
+import pytest
+
+from device_state import DeviceStateTable
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeviceState:
+    """Tests for the DeviceStateTable"""
+    def test_lru_eviction(self):
+        """Test that the least recently used device is evicted when full."""
+        table = DeviceStateTable(capacity=2)
+        packets = table.column("packet")
+        priorities = table.column("adv_priority")
+
+        packets[b"A"] = 1
+        packets[b"B"] = 2
+        priorities[b"B"] = 19
+        # touch A, so B is the least recently used
+        assert packets[b"A"] == 1
+        packets[b"C"] = 3
+
+        assert b"B" not in table
+        assert dict(packets) == {b"A": 1, b"C": 3}
+        with pytest.raises(KeyError):
+            priorities[b"B"]
+        # the slot of B is reused without its old state
+        with pytest.raises(KeyError):
+            priorities[b"C"]
+        assert table.stats() == {"devices": 2, "capacity": 2, "evictions": 1, "expirations": 0}
+
+    def test_ttl_expiry(self):
+        """Test that idle devices are expired."""
+        clock = FakeClock()
+        table = DeviceStateTable(capacity=10, ttl=60, clock=clock)
+        packets = table.column("packet")
+
+        packets[b"A"] = 1
+        clock.now = 30
+        packets[b"B"] = 2
+        clock.now = 70
+        assert packets.get(b"A") is None
+        assert packets[b"B"] == 2
+        clock.now = 125
+        assert packets[b"B"] == 2
+        assert len(table) == 1
+        assert table.expirations == 1
+
+    def test_stripes(self):
+        """Test that the capacity is shared by the stripes."""
+        table = DeviceStateTable(capacity=10, stripes=4)
+        packets = table.column("packet")
+        for mac in range(100):
+            packets[mac] = mac
+            with table.lock(mac):
+                assert packets[mac] == mac
+        assert len(table) == 10
+        assert len(packets) == 10
+        assert table.evictions == 90
+        assert all(packets[mac] == mac for mac in packets)
@@ -0,0 +1,116 @@
+"""The tests for the asyncio gateway."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ble_parser import BleParser
+from gateway import Gateway, stream_source
+
+MISCALE_V1 = bytes.fromhex("043e1d020100008995c08c47c8110201060d161d1820584d0000000000000064")
+XIAOMI_PLAIN = bytes.fromhex("043e200201000001000038c1a414131695fe50505b050101000038c1a4041002e600c4")
+
+
+async def frame_source(frames, delay=0):
+    for timestamp, frame in enumerate(frames):
+        await asyncio.sleep(delay)
+        yield float(timestamp), frame
+
+
+class TestGateway:
+    """Tests for the Gateway"""
+    def test_pipeline(self):
+        """Test that every frame is parsed and published in order."""
+        published = []
+        gateway = Gateway(
+            BleParser(), frame_source([MISCALE_V1, XIAOMI_PLAIN, MISCALE_V1[:-1]] * 10),
+            published.extend, batch_size=4
+        )
+        asyncio.run(gateway.run())
+
+        assert gateway.stats() == {
+            "frames": 30, "dropped_frames": 0, "results": 20, "parse_errors": 0, "sink_errors": 0
+        }
+        assert [timestamp for timestamp, _, _ in published] == [t for t in range(30) if t % 3 != 2]
+        assert published[1][1]["type"] == "LYWSD03MMC"
+
+    def test_slow_sink(self):
+        """Test that a slow sink drops batches at ingestion instead of stalling it."""
+        published = []
+
+        async def slow_sink(results):
+            await asyncio.sleep(0.05)
+            published.extend(results)
+
+        gateway = Gateway(
+            BleParser(), frame_source([XIAOMI_PLAIN] * 200, 0.001), slow_sink,
+            queue_size=1, batch_size=5
+        )
+        asyncio.run(gateway.run())
+
+        stats = gateway.stats()
+        assert stats["frames"] == 200
+        assert stats["dropped_frames"] > 0
+        assert len(published) == stats["results"] == 200 - stats["dropped_frames"]
+
+    def test_stop_drains(self):
+        """Test that stop() publishes the frames that were ingested."""
+        published = []
+
+        async def endless():
+            while True:
+                await asyncio.sleep(0.001)
+                yield 0.0, MISCALE_V1
+
+        async def main():
+            gateway = Gateway(BleParser(), endless(), published.extend, batch_interval=0.01)
+            task = asyncio.ensure_future(gateway.run())
+            await asyncio.sleep(0.1)
+            gateway.stop()
+            await task
+            return gateway
+
+        gateway = asyncio.run(main())
+        assert gateway.frames > 0
+        assert len(published) == gateway.frames
+
+    def test_parse_errors(self):
+        """Test that a frame failing to parse is counted and the other frames are published."""
+        def parse_custom(self, adstruct, mac, rssi):
+            raise ValueError("Broken decoder")
+
+        ble_parser = BleParser()
+        ble_parser.register_decoder(0x16, 0x181D, "custom", parse_custom)
+        published = []
+        gateway = Gateway(ble_parser, frame_source([XIAOMI_PLAIN, MISCALE_V1, XIAOMI_PLAIN]), published.extend)
+        asyncio.run(gateway.run())
+
+        assert gateway.parse_errors == 1
+        assert [timestamp for timestamp, _, _ in published] == [0.0, 2.0]
+
+    def test_failed_stage(self):
+        """Test that a failed stage stops the other stages."""
+        async def endless():
+            while True:
+                await asyncio.sleep(0.001)
+                yield 0.0, MISCALE_V1
+
+        async def main():
+            executor = ThreadPoolExecutor(1)
+            executor.shutdown()
+            gateway = Gateway(BleParser(), endless(), list, batch_interval=0.01, executor=executor)
+            with pytest.raises(RuntimeError):
+                await asyncio.wait_for(gateway.run(), 5)
+            return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+        assert asyncio.run(main()) == []
+
+    def test_stream_source(self):
+        """Test reading H4 event packets from a stream."""
+        async def main():
+            reader = asyncio.StreamReader()
+            reader.feed_data(MISCALE_V1 + XIAOMI_PLAIN + XIAOMI_PLAIN[:5])
+            reader.feed_eof()
+            return [frame async for _, frame in stream_source(reader)]
+
+        assert asyncio.run(main()) == [MISCALE_V1, XIAOMI_PLAIN]
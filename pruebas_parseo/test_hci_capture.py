@@ -0,0 +1,60 @@
+"""The tests for the btsnoop/pcap capture reader."""
+import struct
+
+from ble_parser import BleParser
+from hci_capture import BTSNOOP_EPOCH_DELTA, read_capture, replay
+
+MISCALE_V1 = bytes.fromhex("043e1d020100008995c08c47c8110201060d161d1820584d0000000000000064")
+MISCALE_V2 = bytes.fromhex("043e2402010001ef148244dedf1802010603021b1810161b180204b207010112101a0000a852ae")
+# HCI command (LE Set Scan Enable), not an advertising report
+SCAN_ENABLE = bytes.fromhex("010c20020100")
+
+
+def write_btsnoop(path, packets, datalink=1002):
+    with open(path, "wb") as capture:
+        capture.write(b"btsnoop\x00" + struct.pack(">II", 1, datalink))
+        for timestamp, flags, packet in packets:
+            timestamp = int(timestamp * 1000000) + BTSNOOP_EPOCH_DELTA
+            capture.write(struct.pack(">IIIIq", len(packet), len(packet), flags, 0, timestamp) + packet)
+
+
+def write_pcap(path, packets, linktype=187):
+    with open(path, "wb") as capture:
+        capture.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, linktype))
+        for timestamp, packet in packets:
+            capture.write(struct.pack("<IIII", int(timestamp), int(timestamp % 1 * 1000000), len(packet), len(packet)))
+            capture.write(packet)
+
+
+class TestCapture:
+    """Tests for the capture reader"""
+    def test_btsnoop_h4(self, tmp_path):
+        """Test reading advertising reports from a btsnoop H4 capture."""
+        path = tmp_path / "hci.log"
+        write_btsnoop(path, [(1.5, 2, SCAN_ENABLE), (2.0, 3, MISCALE_V1), (2.5, 3, MISCALE_V2)])
+
+        assert list(read_capture(path)) == [(2.0, MISCALE_V1), (2.5, MISCALE_V2)]
+
+    def test_btsnoop_h1(self, tmp_path):
+        """Test reading advertising reports from a btsnoop H1 capture."""
+        path = tmp_path / "hci.log"
+        write_btsnoop(path, [(1.5, 2, SCAN_ENABLE[1:]), (2.0, 3, MISCALE_V1[1:])], datalink=1001)
+
+        assert list(read_capture(path)) == [(2.0, MISCALE_V1)]
+
+    def test_pcap_replay(self, tmp_path):
+        """Test replaying a pcap capture through the parser."""
+        path = tmp_path / "hci.pcap"
+        write_pcap(path, [(10.25, SCAN_ENABLE), (10.5, MISCALE_V1), (10.75, MISCALE_V2)])
+
+        results = list(replay(BleParser(), path))
+        assert [timestamp for timestamp, sensor_msg, tracker_msg in results] == [10.5, 10.75]
+        assert results[0][1]["mac"] == "C8478CC09589"
+        assert results[1][1]["mac"] == "DFDE448214EF"
+
+    def test_pcap_with_phdr(self, tmp_path):
+        """Test reading a pcap capture with the direction pseudo-header."""
+        path = tmp_path / "hci.pcap"
+        write_pcap(path, [(10.5, b"\x00\x00\x00\x01" + MISCALE_V1)], linktype=201)
+
+        assert list(read_capture(path)) == [(10.5, MISCALE_V1)]
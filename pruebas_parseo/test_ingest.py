@@ -0,0 +1,116 @@
+"""The tests for the sniffer ingest server and client."""
+import asyncio
+
+import pytest
+
+from ingest import IngestServer, SnifferClient, decode_batch, encode_batch
+
+MISCALE_V1 = bytes.fromhex("043e1d020100008995c08c47c8110201060d161d1820584d0000000000000064")
+XIAOMI_PLAIN = bytes.fromhex("043e200201000001000038c1a414131695fe50505b050101000038c1a4041002e600c4")
+
+
+def with_packet(packet):
+    data = bytearray(XIAOMI_PLAIN)
+    # MiBeacon frame counter
+    data[22] = packet
+    return bytes(data)
+
+
+class TestIngest:
+    """Tests for the IngestServer and SnifferClient"""
+    def test_batch_framing(self):
+        """Test encoding and decoding a batch of frames."""
+        frames = [(1000.5, MISCALE_V1), (1000.75, XIAOMI_PLAIN)]
+        data = encode_batch(7, frames)
+        assert len(data) == 19 + 2 * 6 + len(MISCALE_V1) + len(XIAOMI_PLAIN)
+        assert decode_batch(data) == (7, frames)
+        assert decode_batch(encode_batch(1, [])) == (1, [])
+        with pytest.raises(ValueError):
+            decode_batch(data[:-1])
+        with pytest.raises(ValueError):
+            decode_batch(b"XX" + data[2:])
+        # frames too short for an HCI event
+        with pytest.raises(ValueError):
+            decode_batch(encode_batch(1, [(1000.5, b"")]))
+
+    def test_localhost(self):
+        """Test sniffers sending over UDP and TCP to a server on localhost."""
+        published = []
+
+        async def main():
+            server = IngestServer(published.extend, workers=2)
+            await server.start()
+            loop = asyncio.get_running_loop()
+
+            def sniff():
+                with SnifferClient(server.udp_address, 1, batch_size=16) as client:
+                    for packet in range(40):
+                        client.send(with_packet(packet), 100.0 + packet / 1000)
+                with SnifferClient(server.tcp_address, 2, "tcp", batch_size=16) as client:
+                    for packet in range(40, 80):
+                        client.send(with_packet(packet), 100.0 + packet / 1000)
+                    client.send(MISCALE_V1, 200.0)
+                    client.send(MISCALE_V1[:-1], 201.0)
+
+            await loop.run_in_executor(None, sniff)
+            for _ in range(200):
+                if server.frames == 82:
+                    break
+                await asyncio.sleep(0.01)
+            await server.close()
+            return server
+
+        server = asyncio.run(main())
+        assert server.stats() == {
+            "batches": 7, "frames": 82, "dropped_batches": 0, "invalid_batches": 0,
+            "results": 81, "parse_errors": 0, "lost_frames": 0, "sink_errors": 0,
+        }
+        published.sort(key=lambda result: result[0])
+        assert [(timestamp, receiver) for timestamp, receiver, _, _ in published[:2]] == [(100.0, 1), (100.001, 1)]
+        assert [sensor_data["packet"] for _, _, sensor_data, _ in published[:80]] == list(range(80))
+        assert (published[-1][1], published[-1][2]["type"]) == (2, "Mi Scale V1")
+
+    def test_parse_errors(self, monkeypatch):
+        """Test that the server counts the frames that fail and keeps parsing the others."""
+        import miscale
+
+        def broken_parser(self, data, mac, rssi):
+            raise IndexError("broken frame")
+
+        # the workers are forked with the patched parser
+        monkeypatch.setattr(miscale, "parse_miscale", broken_parser)
+        published = []
+
+        async def main():
+            server = IngestServer(published.extend, workers=1)
+            await server.start(tcp_port=None)
+            parse_many = server._parser.parse_many
+            calls = []
+
+            def failing_parse_many(frames):
+                calls.append(frames)
+                if len(calls) == 1:
+                    raise RuntimeError("Parser worker stopped")
+                return parse_many(frames)
+
+            server._parser.parse_many = failing_parse_many
+            loop = asyncio.get_running_loop()
+
+            def sniff(receiver):
+                with SnifferClient(server.udp_address, receiver) as client:
+                    client.send(with_packet(receiver), 100.0)
+                    client.send(MISCALE_V1, 100.1)
+                    client.send(with_packet(receiver + 10), 100.2)
+
+            for receiver in (1, 2):
+                await loop.run_in_executor(None, sniff, receiver)
+                for _ in range(200):
+                    if len(calls) == receiver:
+                        break
+                    await asyncio.sleep(0.01)
+            await server.close()
+            return server
+
+        server = asyncio.run(main())
+        assert (server.lost_frames, server.parse_errors, server.frames, server.results) == (3, 1, 6, 2)
+        assert [(receiver, sensor_data["packet"]) for _, receiver, sensor_data, _ in published] == [(2, 2), (2, 12)]
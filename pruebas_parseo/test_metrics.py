@@ -0,0 +1,86 @@
+"""The tests for the parser metrics."""
+from ble_parser import BleParser
+from metrics import ParserMetrics
+
+MISCALE_V1 = "043e1d020100008995c08c47c8110201060d161d1820584d0000000000000064"
+MISCALE_V1_NEXT = "043e1d020100008995c08c47c8110201060d161d1820684d0000000000000064"
+XIAOMI_PLAIN = "043e200201000001000038c1a414131695fe50505b050101000038c1a4041002e600c4"
+XIAOMI_ENCRYPTED = "043e270201000001000038c1a41b1a1695fe58585b050101000038c1a445bb342b34112233cc8c416ac4"
+
+
+class TestMetrics:
+    """Tests for the ParserMetrics"""
+    def test_parser_counters(self):
+        """Test the frame, vendor, drop reason and device type counters."""
+        ble_parser = BleParser(filter_duplicates=True, cache_raw=False)
+        for data_string in [MISCALE_V1, MISCALE_V1, MISCALE_V1_NEXT, XIAOMI_PLAIN, XIAOMI_PLAIN]:
+            ble_parser.parse_data(bytes.fromhex(data_string))
+        ble_parser.parse_data(bytes.fromhex(XIAOMI_PLAIN)[:-1])
+
+        snapshot = ble_parser.metrics.snapshot()
+        assert snapshot["frames"] == 6
+        assert snapshot["vendor_frames"] == {"miscale": 3, "xiaomi": 2}
+        assert snapshot["vendor_results"] == {"miscale": 1, "xiaomi": 1}
+        # the first Mi Scale frame after a start is dropped with filter_duplicates
+        assert snapshot["drops"] == {"duplicate": 3, "invalid_length": 1}
+        assert snapshot["device_types"] == {"Mi Scale V1": 1, "LYWSD03MMC": 1}
+        assert snapshot["parse_times"]["xiaomi"]["count"] == 2
+        assert snapshot["parse_times"]["xiaomi"]["buckets"][float("inf")] == 2
+
+    def test_cache_and_filter_counters(self):
+        """Test the counters of cached repeats and filtered frames."""
+        ble_parser = BleParser(discovery=False)
+        for data_string in [MISCALE_V1, XIAOMI_PLAIN]:
+            ble_parser.parse_data(bytes.fromhex(data_string))
+        assert ble_parser.metrics.drops == {"filtered": 2}
+
+        ble_parser = BleParser()
+        for data_string in [XIAOMI_PLAIN, XIAOMI_PLAIN]:
+            ble_parser.parse_data(bytes.fromhex(data_string))
+        assert ble_parser.metrics.cache_hits == 1
+        assert ble_parser.metrics.vendor_frames == {"xiaomi": 1}
+        assert ble_parser.metrics.device_types == {"LYWSD03MMC": 2}
+
+    def test_drops_are_not_results(self):
+        """Test that readings of dropped frames and results without type aren't counted as results."""
+        data = bytearray.fromhex(XIAOMI_ENCRYPTED)
+        # fails verification
+        data[22] = 0
+        for workers in (0, 2):
+            ble_parser = BleParser(aeskeys={"A4C138000001": bytes(range(16))}, decrypt_workers=workers)
+            (columns, _) = ble_parser.parse_many([bytes(data)])
+            ble_parser.close()
+            assert columns["data"] == [False]
+            assert ble_parser.metrics.drops == {"decryption_failed": 1}
+            assert not any(ble_parser.metrics.vendor_results.values())
+            assert not any(ble_parser.metrics.device_types.values())
+
+        ble_parser = BleParser()
+        ble_parser.register_decoder(0x16, 0x181D, "custom", lambda parser, adstruct, mac, rssi: {"rssi": rssi})
+        assert ble_parser.parse_data(bytes.fromhex(MISCALE_V1))[0] == {"rssi": 100}
+        assert ble_parser.metrics.vendor_results == {"custom": 1}
+        assert ble_parser.metrics.device_types == {}
+
+    def test_prometheus(self, tmp_path):
+        """Test the Prometheus text export."""
+        metrics = ParserMetrics(buckets=(1e-6, 1e-3))
+        metrics.frames = 3
+        metrics.drop("duplicate")
+        metrics.device_types['LY"1'] += 1
+        metrics.observe("xiaomi", 5e-4)
+        metrics.observe("xiaomi", 2.0)
+
+        path = tmp_path / "ble_parser.prom"
+        metrics.write_prometheus(str(path))
+        lines = path.read_text().splitlines()
+        assert "ble_parser_frames_total 3" in lines
+        assert 'ble_parser_dropped_frames_total{reason="duplicate"} 1' in lines
+        assert 'ble_parser_device_type_results_total{type="LY\\"1"} 1' in lines
+        assert 'ble_parser_parse_seconds_bucket{vendor="xiaomi",le="1e-06"} 0' in lines
+        assert 'ble_parser_parse_seconds_bucket{vendor="xiaomi",le="0.001"} 1' in lines
+        assert 'ble_parser_parse_seconds_bucket{vendor="xiaomi",le="+Inf"} 2' in lines
+        assert 'ble_parser_parse_seconds_count{vendor="xiaomi"} 2' in lines
+        assert list(tmp_path.iterdir()) == [path]
+
+        metrics.reset()
+        assert metrics.snapshot()["frames"] == 0
@@ -1,5 +1,7 @@
 """The tests for the Mi Scale ble_parser."""
 from ble_parser import BleParser
+from miscale import miscale_array
+from miscale_session import MiScaleSessions
 
 
 class TestMiscale:
@@ -110,3 +112,106 @@ class TestMiscale:
         assert sensor_msg["stabilized"] == 1
         assert sensor_msg["impedance"] == 396
         assert sensor_msg["rssi"] == -66
+
+    def test_miscale_parse_many(self):
+        """Test Mi Scale results from the batch parser."""
+        data_strings = [
+            "043e1d020100008995c08c47c8110201060d161d1820584d0000000000000064",
+            "043e2402010001ef148244dedf1802010603021b1810161b180204b207010112101a0000a852ae",
+            "043e2402010001ef148244dedf1802010603021b1810161b1802a6b20701011201128c01a852be",
+        ]
+        frames = [bytes(bytearray.fromhex(data_string)) for data_string in data_strings]
+
+        ble_parser = BleParser()
+        sensor_columns, tracker_columns = ble_parser.parse_many(frames)
+
+        assert sensor_columns["mac"] == ["C8478CC09589", "DFDE448214EF", "DFDE448214EF"]
+        assert sensor_columns["weight"] == [99.0, None, None]
+        assert sensor_columns["impedance"] == [None, None, 396]
+        assert tracker_columns == {}
+
+        array = miscale_array(sensor_columns)
+        assert array["rssi"].tolist() == [100, -82, -66]
+        assert array["impedance"].tolist() == [-1, -1, 396]
+        assert array["weight unit"].tolist() == ["kg", "kg", "kg"]
+
+    def test_miscale_reading_as_dict(self):
+        """Test the dict of a Mi Scale reading."""
+        data_string = "043e2402010001ef148244dedf1802010603021b1810161b1802a6b20701011201128c01a852be"
+        data = bytes(bytearray.fromhex(data_string))
+
+        ble_parser = BleParser()
+        sensor_msg, tracker_msg = ble_parser.parse_data(data)
+
+        assert sensor_msg.as_dict() == {
+            "non-stabilized weight": 105.8,
+            "weight unit": "kg",
+            "weight removed": 1,
+            "stabilized": 1,
+            "impedance": 396,
+            "type": "Mi Scale V2",
+            "firmware": "Mi Scale V2",
+            "mac": "DFDE448214EF",
+            "packet": "02a6b20701011201128c01a852",
+            "rssi": -66,
+            "data": True,
+        }
+        assert "weight" not in sensor_msg
+        assert not hasattr(sensor_msg, "__dict__")
+
+    def test_miscale_sessions(self):
+        """Test aggregating the frames of weigh-ins into measurements."""
+        frames = [
+            # control byte, weight: non-stabilized, stabilized and weight removed frames
+            bytes(bytearray.fromhex("043e1d020100008995c08c47c8110201060d161d18%s0000000000000064" % frame))
+            for frame in ["00104d", "00504d", "20584d", "20584d", "a0584d", "a0584d", "00104d"]
+        ]
+        clock = [0.0]
+        ble_parser = BleParser()
+        sessions = MiScaleSessions(timeout=10, clock=lambda: clock[0])
+
+        measurements = []
+        for data in frames:
+            clock[0] += 1
+            sensor_msg, tracker_msg = ble_parser.parse_data(data)
+            measurements.extend(sessions.add(sensor_msg))
+        (measurement,) = measurements
+        assert measurement == {
+            "mac": "C8478CC09589",
+            "type": "Mi Scale V1",
+            "rssi": 100,
+            "weight": 99.0,
+            "weight unit": "kg",
+            "duration": 4.0,
+            "samples": 4,
+        }
+        # the last frame started a new session, that times out without a stabilized weight
+        assert len(sessions) == 1
+        assert sessions.expire(clock[0] + 5) == []
+        assert sessions.expire(clock[0] + 10) == []
+        assert sessions.aborted == 1
+        assert len(sessions) == 0
+
+    def test_miscale_v2_sessions(self):
+        """Test a Mi Scale V2 weigh-in that stabilizes in the weight removed frame with the impedance."""
+        frames = [
+            bytes(bytearray.fromhex(
+                "043e2402010001ef148244dedf1802010603021b1810161b1802%sb2070101120112%sa852be" % frame
+            ))
+            # control byte, impedance: non-stabilized, stabilized and weight removed with impedance
+            for frame in [("04", "0000"), ("24", "0000"), ("a6", "8c01")]
+        ]
+        clock = [0.0]
+        ble_parser = BleParser()
+        sessions = MiScaleSessions(clock=lambda: clock[0])
+
+        measurements = []
+        for data in frames:
+            clock[0] += 1
+            sensor_msg, tracker_msg = ble_parser.parse_data(data)
+            measurements.extend(sessions.add(sensor_msg))
+        (measurement,) = measurements
+        assert measurement["weight"] == 105.8
+        assert measurement["impedance"] == 396
+        assert measurement["samples"] == 2
+        assert len(sessions) == 0
@@ -0,0 +1,47 @@
+"""The tests for the reading store."""
+import pytest
+
+from ble_parser import BleParser
+from reading_store import ReadingStore
+
+np = pytest.importorskip("numpy")
+
+MISCALE_V1 = "043e1d020100008995c08c47c8110201060d161d1820584d0000000000000064"
+XIAOMI_PLAIN = "043e200201000001000038c1a414131695fe50505b050101000038c1a4041002e600c4"
+
+
+class TestReadingStore:
+    """Tests for the ReadingStore"""
+    def test_append_and_query(self, tmp_path):
+        """Test storing parse_data results and reading them back."""
+        ble_parser = BleParser()
+        scale, _ = ble_parser.parse_data(bytes.fromhex(MISCALE_V1))
+        sensor, _ = ble_parser.parse_data(bytes.fromhex(XIAOMI_PLAIN))
+
+        store = ReadingStore(str(tmp_path), segment_size=4, buffer_size=2)
+        for timestamp in range(10):
+            store.append(scale, timestamp)
+            store.append(sensor, timestamp + 0.5)
+        store.append({"mac": "A4C138000002", "type": "custom", "temperature": 20.5, "rssi": -70}, 3.0)
+        assert len(store) == 21
+
+        readings = store.query("A4C138000001", 2, 5)
+        assert list(readings["timestamp"]) == [2.5, 3.5, 4.5]
+        assert list(readings["temperature"]) == [23.0] * 3
+        assert np.isnan(readings["weight"]).all()
+        assert list(readings["rssi"]) == [-60] * 3
+        assert store.types[readings["type"][0]] == "LYWSD03MMC"
+
+        readings = store.query(0xC8478CC09589)
+        assert list(readings["timestamp"]) == list(range(10))
+        assert list(readings["weight"]) == [99.0] * 10
+        assert list(readings["impedance"]) == [-1] * 10
+        store.close()
+
+        # sealed segments are sorted by MAC, the active segment isn't
+        store = ReadingStore(str(tmp_path), segment_size=4)
+        assert len(store) == 21
+        assert list(store.query("A4C138000002")["temperature"]) == [20.5]
+        assert list(store.query("A4C138000001", 8)["timestamp"]) == [8.5, 9.5]
+        assert len(store.query("A4C138000003")) == 0
+        store.close()
@@ -0,0 +1,69 @@
+"""The tests for the cross-receiver duplicate suppression."""
+import multiprocessing
+
+from ble_parser import BleParser
+from receiver_dedup import DedupIndex, ReceiverDedup
+
+XIAOMI_PLAIN = "043e200201000001000038c1a414131695fe50505b050101000038c1a4041002e600c4"
+
+
+def heard(rssi, temperature=0xE6):
+    """Return the Xiaomi frame as heard with an RSSI."""
+    data = bytearray.fromhex(XIAOMI_PLAIN)
+    data[-3] = temperature
+    data[-1] = rssi & 0xFF
+    return bytes(data)
+
+
+def offer_copy(index, receiver, timestamp, data):
+    dedup = ReceiverDedup(BleParser(), ["gw1", "gw2", "gw3"], index)
+    assert dedup.add(receiver, timestamp, data) == []
+    assert dedup.flush() == []
+    index.close()
+
+
+class TestReceiverDedup:
+    """Tests for the ReceiverDedup"""
+    def test_best_rssi(self):
+        """Test that copies are merged into one result with the best RSSI."""
+        ble_parser = BleParser()
+        dedup = ReceiverDedup(ble_parser, ["gw1", "gw2", "gw3"], window=0.5)
+        try:
+            assert dedup.add("gw1", 10.0, heard(-80)) == []
+            assert dedup.add("gw2", 10.1, heard(-50)) == []
+            assert dedup.add("gw3", 10.2, heard(-70)) == []
+            # another advertisement of the device
+            assert dedup.add("gw3", 10.3, heard(-70, 0xE7)) == []
+
+            emitted = dedup.add("gw1", 10.6, heard(-80))
+            assert [(timestamp, best, receivers) for timestamp, _, best, receivers in emitted] == [
+                (10.0, "gw2", ["gw1", "gw2", "gw3"])
+            ]
+            assert emitted[0][1]["rssi"] == -50
+            assert emitted[0][1]["temperature"] == 23.0
+            assert dedup.late_copies == 1
+
+            [(timestamp, sensor_data, best, receivers)] = dedup.flush()
+            assert (timestamp, sensor_data["temperature"], best, receivers) == (10.3, 23.1, "gw3", ["gw3"])
+            assert dedup.copies == 2
+            # only the first copy of each advertisement is parsed
+            assert ble_parser.metrics.frames == 5
+            assert ble_parser.metrics.vendor_frames == {"xiaomi": 2}
+        finally:
+            dedup.close()
+
+    def test_shared_index(self):
+        """Test that copies heard by another process are merged into the first one."""
+        index = DedupIndex(slots=64, stripes=4)
+        dedup = ReceiverDedup(BleParser(), ["gw1", "gw2", "gw3"], index)
+        try:
+            assert dedup.add("gw1", 10.0, heard(-80)) == []
+            process = multiprocessing.Process(target=offer_copy, args=(index, "gw3", 10.1, heard(-60)))
+            process.start()
+            process.join()
+            assert process.exitcode == 0
+
+            [(_, sensor_data, best, receivers)] = dedup.expire(11.0)
+            assert (sensor_data["rssi"], best, receivers) == (-60, "gw3", ["gw1", "gw3"])
+        finally:
+            index.close()
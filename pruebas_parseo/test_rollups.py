@@ -0,0 +1,71 @@
+"""The tests for the rollup engine."""
+import pytest
+
+from ble_parser import BleParser
+from rollups import RollupEngine
+
+MISCALE_V1 = "043e1d020100008995c08c47c8110201060d161d1820584d0000000000000064"
+XIAOMI_PLAIN = "043e200201000001000038c1a414131695fe50505b050101000038c1a4041002e600c4"
+
+
+class TestRollups:
+    """Tests for the RollupEngine"""
+    def test_update(self):
+        """Test rolling up parse_data results per window."""
+        ble_parser = BleParser()
+        scale, _ = ble_parser.parse_data(bytes.fromhex(MISCALE_V1))
+        sensor, _ = ble_parser.parse_data(bytes.fromhex(XIAOMI_PLAIN))
+
+        rollups = RollupEngine()
+        rollups.update(scale, 30.0)
+        for timestamp, temperature in [(60.0, 20.0), (90.0, 24.0), (100.0, 22.0), (130.0, 25.0)]:
+            rollups.update({"mac": "A4C138000001", "temperature": temperature}, timestamp)
+        rollups.update(sensor, 3600.0)
+        assert sorted(rollups.series()) == [
+            (0xA4C138000001, "temperature"), (0xC8478CC09589, "weight")
+        ]
+
+        assert rollups.query("A4C138000001", "temperature", "minute", 60, 120) == {
+            "start": [60],
+            "count": [3],
+            "min": [20.0],
+            "max": [24.0],
+            "mean": [22.0],
+            "last": [22.0],
+        }
+        hours = rollups.query("A4C138000001", "temperature", "hour")
+        assert hours["start"] == [0, 3600]
+        assert hours["count"] == [4, 1]
+        assert hours["last"] == [25.0, 23.0]
+        assert rollups.query(0xC8478CC09589, "weight", "day")["mean"] == [99.0]
+        assert rollups.query(0xC8478CC09589, "humidity", "day")["count"] == []
+
+    def test_ring_and_backfill(self):
+        """Test that backfilled buckets equal the incremental ones, and that old buckets are dropped."""
+        np = pytest.importorskip("numpy")
+        windows = {"minute": (60, 10), "hour": (3600, 2)}
+        rng = np.random.default_rng(1)
+        readings = {
+            "timestamp": np.sort(rng.uniform(0, 7200, 500)),
+            "mac": rng.choice([1, 2, 3], 500).astype("u8"),
+            "temperature": np.round(rng.normal(20, 2, 500), 1),
+        }
+        readings["temperature"][::7] = np.nan
+
+        incremental = RollupEngine(windows, fields=["temperature"])
+        for timestamp, mac, temperature in zip(*readings.values()):
+            incremental.update({"mac": int(mac), "temperature": temperature}, timestamp)
+        backfilled = RollupEngine(windows, fields=["temperature"])
+        backfilled.backfill(readings)
+
+        for mac in (1, 2, 3):
+            for window in windows:
+                expected = incremental.query(mac, "temperature", window)
+                result = backfilled.query(mac, "temperature", window)
+                assert result["start"] == expected["start"]
+                assert result["count"] == expected["count"]
+                assert result["min"] == expected["min"]
+                assert result["last"] == expected["last"]
+                assert result["mean"] == pytest.approx(expected["mean"])
+            # only the last 10 minutes are kept
+            assert len(incremental.query(mac, "temperature", "minute")["start"]) <= 10
@@ -0,0 +1,96 @@
+"""The tests for the sharded multiprocess parser."""
+from ble_parser import BleParser
+from sharded_parser import ShardedParser, split_event
+
+MISCALE_V1 = "043e1d020100008995c08c47c8110201060d161d1820584d0000000000000064"
+MISCALE_V1_NEXT = "043e1d020100008995c08c47c8110201060d161d1820684d0000000000000064"
+XIAOMI_PLAIN = "043e200201000001000038c1a414131695fe50505b050101000038c1a4041002e600c4"
+
+
+def with_mac(data_string, low_byte):
+    data = bytearray.fromhex(data_string)
+    data[7] = low_byte
+    return bytes(data)
+
+
+def xiaomi_with_mac(low_byte):
+    data = bytearray.fromhex(XIAOMI_PLAIN)
+    # MAC of the report and of the MiBeacon payload
+    data[7] = data[23] = low_byte
+    return bytes(data)
+
+
+def multi_report_event(frames):
+    reports = b"".join(frame[5:] for frame in frames)
+    return bytes([0x04, 0x3E, len(reports) + 2, 0x02, len(frames)]) + reports
+
+
+class TestShardedParser:
+    """Tests for the ShardedParser"""
+    def test_split_event(self):
+        """Test splitting a multi-report event into single report events."""
+        scale = bytes.fromhex(MISCALE_V1)
+        sensor = bytes.fromhex(XIAOMI_PLAIN)
+        assert split_event(scale) == [(0xC8478CC09589, scale)]
+        assert split_event(multi_report_event([scale, sensor])) == [
+            (0xC8478CC09589, scale), (0xA4C138000001, sensor)
+        ]
+        assert split_event(scale[:-1]) is None
+
+    def test_same_results_as_one_parser(self):
+        """Test that sharded parsing keeps the results, their order and the dedup state per device."""
+        frames = []
+        for count in range(300):
+            device = count % 5
+            frames.append(with_mac(MISCALE_V1 if count % 10 < 5 else MISCALE_V1_NEXT, device))
+            frames.append(with_mac(XIAOMI_PLAIN, device))
+        frames.insert(7, bytes.fromhex(XIAOMI_PLAIN)[:-1])
+        frames.append(multi_report_event([with_mac(MISCALE_V1, 9), with_mac(MISCALE_V1_NEXT, 10)]))
+
+        ble_parser = BleParser(filter_duplicates=True)
+        expected = [
+            (index, sensor_data, tracker_data)
+            for index, frame in enumerate(frames)
+            for sensor_data, tracker_data in ble_parser.parse_event(frame)
+            if sensor_data is not None or tracker_data is not None
+        ]
+
+        with ShardedParser(3, ring_size=512, batch_size=4, filter_duplicates=True) as sharded_parser:
+            assert sharded_parser.parse_many(frames) == expected
+            assert sharded_parser.invalid_frames == 1
+            assert sharded_parser.parse_many([bytes.fromhex(XIAOMI_PLAIN)]) == []
+            metrics = sharded_parser.close()
+        assert sum(snapshot["reports"] for snapshot in metrics) == 603
+
+    def test_reports_across_batches(self):
+        """Test multi-report events whose reports are published in different batches or go to several workers."""
+        frames = []
+        for count in range(50):
+            frames.append(xiaomi_with_mac(1))
+            frames.append(multi_report_event([xiaomi_with_mac(4), xiaomi_with_mac(3), xiaomi_with_mac(2)]))
+        for workers in (1, 2):
+            ble_parser = BleParser()
+            with ShardedParser(workers, batch_size=2) as sharded_parser:
+                for start in range(0, len(frames), 2):
+                    expected = [
+                        (index, sensor_data, tracker_data)
+                        for index, frame in enumerate(frames[start:start + 2])
+                        for sensor_data, tracker_data in ble_parser.parse_event(frame)
+                    ]
+                    assert len(expected) == 4
+                    assert sharded_parser.parse_many(frames[start:start + 2]) == expected
+
+    def test_parse_errors(self, monkeypatch):
+        """Test that a frame whose parser raises is counted and skipped by its worker."""
+        import miscale
+
+        def broken_parser(self, data, mac, rssi):
+            raise IndexError("broken frame")
+
+        # the workers are forked with the patched parser
+        monkeypatch.setattr(miscale, "parse_miscale", broken_parser)
+        frames = [xiaomi_with_mac(1), with_mac(MISCALE_V1, 2), xiaomi_with_mac(3)]
+        with ShardedParser(2) as sharded_parser:
+            assert [index for index, _, _ in sharded_parser.parse_many(frames)] == [0, 2]
+            assert sharded_parser.parse_errors == 1
+            assert [index for index, _, _ in sharded_parser.parse_many(frames[:1])] == [0]
@@ -0,0 +1,50 @@
+"""The tests for the dedup state snapshots."""
+import os
+
+from ble_parser import BleParser
+from state_snapshot import FILE_HEADER, RECORD_SIZE, StateSnapshots
+
+MISCALE_V1 = bytes.fromhex("043e1d020100008995c08c47c8110201060d161d1820584d0000000000000064")
+MISCALE_V1_NEXT = bytes.fromhex("043e1d020100008995c08c47c8110201060d161d1820684d0000000000000064")
+XIAOMI_PLAIN = bytes.fromhex("043e200201000001000038c1a414131695fe50505b050101000038c1a4041002e600c4")
+
+
+class TestStateSnapshots:
+    """Tests for the StateSnapshots"""
+    def test_warm_restart(self, tmp_path):
+        """Test that a restarted parser keeps filtering the duplicates of the previous one."""
+        path = str(tmp_path / "state.bin")
+        ble_parser = BleParser(filter_duplicates=True, cache_raw=False)
+        ble_parser.parse_data(MISCALE_V1)
+        ble_parser.parse_data(XIAOMI_PLAIN)
+        snapshots = StateSnapshots(ble_parser, path)
+        assert snapshots.snapshot() == 2
+        # nothing changed
+        assert snapshots.snapshot() == 0
+        ble_parser.parse_data(MISCALE_V1_NEXT)
+        assert snapshots.snapshot() == 1
+        snapshots.close()
+        assert os.path.getsize(path) == FILE_HEADER.size + 2 * RECORD_SIZE
+
+        restarted = BleParser(filter_duplicates=True, cache_raw=False)
+        restored = StateSnapshots(restarted, path)
+        assert restored.restore() == 2
+        assert restarted.adv_priority[0xA4C138000001] == 19
+        assert restarted.parse_data(XIAOMI_PLAIN) == (None, None)
+        assert restarted.parse_data(MISCALE_V1_NEXT) == (None, None)
+        assert restarted.parse_data(MISCALE_V1)[0]["weight"] == 99.0
+        # without the snapshot the first message is ignored
+        assert BleParser(filter_duplicates=True).parse_data(MISCALE_V1)[0] is None
+        assert restored.snapshot() == 1
+        restarted.device_state.discard(0xA4C138000001)
+        assert restored.snapshot() == 1
+        restored.close()
+
+        # torn records are skipped
+        with open(path, "r+b") as f:
+            for slot in range(2):
+                f.seek(FILE_HEADER.size + slot * RECORD_SIZE + 5)
+                f.write(b"\xff")
+        fresh = BleParser()
+        assert StateSnapshots(fresh, path).restore() == 0
+        assert len(fresh.device_state) == 0
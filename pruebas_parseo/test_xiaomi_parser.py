@@ -0,0 +1,153 @@
+"""The tests for the Xiaomi ble_parser."""
+from ble_parser import DIAGNOSTICS_DEBUG, BleParser
+from xiaomi import parse_payload
+
+AESKEY = bytes(range(16))
+PLAIN = "043e200201000001000038c1a414131695fe50505b050101000038c1a4041002e600c4"
+ENCRYPTED = "043e270201000001000038c1a41b1a1695fe58585b050101000038c1a445bb342b34112233cc8c416ac4"
+
+
+class TestXiaomi:
+    """Tests for the Xiaomi parser"""
+    def test_xiaomi_lywsd03mmc(self):
+        """Test Xiaomi parser for LYWSD03MMC without encryption."""
+        data = bytes(bytearray.fromhex(PLAIN))
+
+        # pylint: disable=unused-variable
+        ble_parser = BleParser()
+        sensor_msg, tracker_msg = ble_parser.parse_data(data)
+
+        assert sensor_msg["firmware"] == "Xiaomi (MiBeacon V5)"
+        assert sensor_msg["type"] == "LYWSD03MMC"
+        assert sensor_msg["mac"] == "A4C138000001"
+        assert sensor_msg["packet"] == 1
+        assert sensor_msg["data"]
+        assert sensor_msg["temperature"] == 23.0
+        assert sensor_msg["rssi"] == -60
+
+    def test_xiaomi_lywsd03mmc_encrypted(self):
+        """Test Xiaomi parser for LYWSD03MMC with MiBeacon V5 encryption."""
+        data = bytes(bytearray.fromhex(ENCRYPTED))
+
+        # pylint: disable=unused-variable
+        ble_parser = BleParser(aeskeys={bytes.fromhex("A4C138000001"): AESKEY})
+        sensor_msg, tracker_msg = ble_parser.parse_data(data)
+
+        assert sensor_msg["firmware"] == "Xiaomi (MiBeacon V5 encrypted)"
+        assert sensor_msg["type"] == "LYWSD03MMC"
+        assert sensor_msg["mac"] == "A4C138000001"
+        assert sensor_msg["packet"] == 1
+        assert sensor_msg["data"]
+        assert sensor_msg["temperature"] == 23.0
+        assert sensor_msg["rssi"] == -60
+
+    def test_xiaomi_missing_key_backoff(self, caplog):
+        """Test that a device without key is logged once and then ignored."""
+        ble_parser = BleParser(cache_raw=False)
+        for counter in range(3):
+            # different frame counters, so the frames are not duplicates
+            data = bytearray.fromhex(ENCRYPTED)
+            data[22] = counter
+            sensor_msg, tracker_msg = ble_parser.parse_data(bytes(data))
+            assert sensor_msg["data"] is False
+        assert len([record for record in caplog.records if record.levelname == "ERROR"]) == 1
+
+        ble_parser.set_aeskey(bytes.fromhex("A4C138000001"), AESKEY)
+        sensor_msg, tracker_msg = ble_parser.parse_data(bytes.fromhex(ENCRYPTED))
+        assert sensor_msg["temperature"] == 23.0
+
+    def test_xiaomi_wrong_key_backoff(self):
+        """Test that repeated verification failures start a backoff."""
+        ble_parser = BleParser(cache_raw=False, aeskeys={bytes.fromhex("A4C138000001"): bytes(16)})
+        for counter in range(4):
+            data = bytearray.fromhex(ENCRYPTED)
+            data[22] = counter
+            ble_parser.parse_data(bytes(data))
+        failures = ble_parser.aes_failures[0xA4C138000001]
+        assert failures[0] == 3
+        assert failures[2] == ble_parser.decrypt_backoff
+
+    def test_xiaomi_parallel_decryption(self):
+        """Test that the decryption stage gives the same results as inline decryption."""
+        key = bytes.fromhex("A4C138000001")
+        frames = []
+        for counter in range(10):
+            data = bytearray.fromhex(ENCRYPTED)
+            data[22] = counter
+            # byte-identical repeats are served from the raw cache
+            frames.extend([bytes(data)] * 2)
+        # counter 1 decrypts, the others fail verification and start a backoff
+        frames.append(bytes.fromhex(ENCRYPTED))
+
+        columns = []
+        counters = []
+        for workers in (0, 4):
+            ble_parser = BleParser(aeskeys={key: AESKEY}, decrypt_workers=workers, decrypt_batch_size=2)
+            columns.append(ble_parser.parse_many(frames)[0])
+            ble_parser.close()
+            snapshot = ble_parser.metrics.snapshot()
+            counters.append((snapshot["drops"], snapshot["vendor_results"], snapshot["device_types"]))
+        assert columns[0] == columns[1]
+        assert counters[0] == counters[1]
+        assert counters[1][0] == {"decryption_failed": 4, "decryption_blocked": 6}
+        assert columns[1]["temperature"][2:4] == [23.0, 23.0]
+        assert columns[1]["data"] == [False, False, True, True] + [False] * 17
+
+        # repeats of a frame with a wrong key
+        for workers in (0, 4):
+            ble_parser = BleParser(aeskeys={key: bytes(16)}, decrypt_workers=workers)
+            ble_parser.parse_many([bytes.fromhex(ENCRYPTED)] * 2)
+            ble_parser.close()
+            assert ble_parser.metrics.drops == {"decryption_failed": 1}
+            assert all(count >= 0 for count in ble_parser.metrics.vendor_results.values())
+            assert not any(ble_parser.metrics.vendor_results.values())
+
+    def test_xiaomi_parallel_decryption_cache(self):
+        """Test that a repeat after parse_many gets the decrypted reading from the raw cache."""
+        data = bytes.fromhex(ENCRYPTED)
+        ble_parser = BleParser(aeskeys={bytes.fromhex("A4C138000001"): AESKEY}, decrypt_workers=2)
+        (columns, _) = ble_parser.parse_many([data])
+        ble_parser.close()
+        assert columns["temperature"] == [23.0]
+
+        (sensor_msg, _) = ble_parser.parse_data(data)
+        assert ble_parser.metrics.cache_hits == 1
+        assert sensor_msg["data"]
+        assert sensor_msg["temperature"] == 23.0
+        assert sensor_msg.pending is None
+
+    def test_xiaomi_diagnostics(self):
+        """Test the diagnostic records of the debug mode."""
+        data = bytes(bytearray.fromhex(PLAIN))
+
+        ble_parser = BleParser()
+        ble_parser.parse_data(data)
+        assert not ble_parser.diagnostic_records
+
+        ble_parser = BleParser(diagnostics=DIAGNOSTICS_DEBUG)
+        ble_parser.parse_data(data)
+        ble_parser.parse_data(data[:-1])
+        (frame, invalid) = ble_parser.diagnostic_records
+        assert frame["message"] == "MiBeacon frame"
+        assert frame["device_type"] == "LYWSD03MMC"
+        assert frame["object_data"] == "041002e600"
+        assert frame["auth_mode"] == "old version certification"
+        assert invalid["message"] == "Invalid message length"
+
+    def test_xiaomi_device_specific_objects(self):
+        """Test the device specific decoders of button and motion objects."""
+        ble_parser = BleParser()
+        button = bytes.fromhex("011003040000")
+        assert parse_payload(ble_parser, button, "K9B-3BTN") == {
+            "button switch": "single press",
+            "3_btn_switch_middle": "toggle",
+            "3_btn_switch_right": "toggle",
+        }
+        assert parse_payload(ble_parser, button, "YLYK01YL") == {"remote": "m", "button": "single press"}
+        assert parse_payload(ble_parser, button, "LYWSD03MMC") == {}
+
+        motion = bytes.fromhex("0f0003640000")
+        assert parse_payload(ble_parser, motion, "CGPR1") == {
+            "motion": 1, "motion timer": 1, "illuminance": 100, "light": 1
+        }
+        assert parse_payload(ble_parser, motion, "RTCGQ02LM") == {"motion": 1, "motion timer": 1, "light": 1}
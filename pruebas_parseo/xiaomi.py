@@ -2,11 +2,36 @@
 import logging
 import math
 import struct
-from Cryptodome.Cipher import AES
+import time
+from functools import lru_cache, partial
+
+from device_state import format_mac
+from metrics import (
+    DROP_DECRYPTION_BLOCKED,
+    DROP_DECRYPTION_FAILED,
+    DROP_DUPLICATE,
+    DROP_INVALID_PAYLOAD,
+    DROP_LOW_PRIORITY,
+    DROP_MAC_MISMATCH,
+    DROP_UNKNOWN_DEVICE,
+    DROP_UNSUPPORTED,
+)
+from readings import Reading
 
 
 _LOGGER = logging.getLogger(__name__)
 
+@lru_cache(maxsize=None)
+def load_aes():
+    """Import AES on the first encrypted advertisement, None if Cryptodome isn't installed."""
+    try:
+        from Cryptodome.Cipher import AES
+    except ImportError:
+        _LOGGER.error("Cryptodome is needed to decrypt MiBeacon advertisements")
+        return None
+    return AES
+
+
 # Device type dictionary
 # {device type code: device name}
 XIAOMI_TYPE_DICT = {
@@ -53,19 +78,27 @@ XIAOMI_TYPE_DICT = {
     0x069F: "ZNMS17LM",
 }
 
+# MiBeacon frame control authentication modes
+MIBEACON_AUTH_MODES = (
+    "old version certification",
+    "safety certification",
+    "standard certification",
+    None,
+)
+
 # Structured objects for data conversions
 TH_STRUCT = struct.Struct("<hH")
 H_STRUCT = struct.Struct("<H")
 T_STRUCT = struct.Struct("<h")
 TTB_STRUCT = struct.Struct("<hhB")
 CND_STRUCT = struct.Struct("<H")
-ILL_STRUCT = struct.Struct("<I")
-LIGHT_STRUCT = struct.Struct("<I")
 FMDH_STRUCT = struct.Struct("<H")
 M_STRUCT = struct.Struct("<L")
 P_STRUCT = struct.Struct("<H")
 BUTTON_STRUCT = struct.Struct("<BBB")
 FLOAT_STRUCT = struct.Struct("<f")
+LOCK_STRUCT = struct.Struct("<BLL")
+FINGERPRINT_STRUCT = struct.Struct("<LB")
 
 # Definition of lock messages
 BLE_LOCK_ERROR = {
@@ -124,6 +157,92 @@ BLE_LOCK_METHOD = {
 }
 
 
+# Definition of fingerprint messages
+FINGERPRINT_KEY_ID = {
+    0x00000000: "administrator",
+    0xFFFFFFFF: "unknown operator",
+}
+
+FINGERPRINT_RESULT = {
+    0x00: "match successful",
+    0x01: "match failed",
+    0x02: "timeout",
+    0x033: "low quality (too light, fuzzy)",
+    0x04: "insufficient area",
+    0x05: "skin is too dry",
+    0x06: "skin is too wet",
+}
+
+# Definition of button messages
+# {press: press type}, press 3 and 4 depend on the button type
+BUTTON_PRESS_TYPE = {
+    0: "single press",
+    1: "double press",
+    2: "long press",
+    5: "short press",
+    6: "long press",
+}
+
+BUTTON_SWITCH_PRESS_TYPE = {
+    0: "single press",
+    1: "long press",
+    2: "double press",
+}
+
+# {button type: command}
+REMOTE_COMMAND = {0: "on", 1: "off", 2: "sun", 3: "+", 4: "m", 5: "-"}
+
+REMOTE_BINARY = {0: 1, 1: 0, 3: 1, 5: 1}
+
+FAN_REMOTE_COMMAND = {
+    0: "fan toggle",
+    1: "light toggle",
+    2: "wind speed",
+    3: "color temperature",
+    4: "wind mode",
+    5: "brightness",
+}
+
+VEN_FAN_REMOTE_COMMAND = {
+    0: "swing",
+    1: "power toggle",
+    2: "timer 60 minutes",
+    3: "strong wind speed",
+    4: "timer 30 minutes",
+    5: "low wind speed",
+}
+
+BATHROOM_REMOTE_COMMAND = {
+    0: "stop",
+    1: "air exchange",
+    2: "fan",
+    3: "speed +",
+    4: "speed -",
+    5: "dry",
+    6: "light toggle",
+    7: "swing",
+    8: "heat",
+}
+
+CUBE_DIRECTION = {0: "right", 1: "left"}
+
+# {button type: toggled switches}
+TWO_BTN_SWITCH = {
+    0: ("2_btn_switch_left",),
+    1: ("2_btn_switch_right",),
+    2: ("2_btn_switch_left", "2_btn_switch_right"),
+}
+
+THREE_BTN_SWITCH = {
+    0: ("3_btn_switch_left",),
+    1: ("3_btn_switch_middle",),
+    2: ("3_btn_switch_right",),
+    3: ("3_btn_switch_left", "3_btn_switch_middle"),
+    4: ("3_btn_switch_middle", "3_btn_switch_right"),
+    5: ("3_btn_switch_left", "3_btn_switch_right"),
+    6: ("3_btn_switch_left", "3_btn_switch_middle", "3_btn_switch_right"),
+}
+
 # Advertisement conversion of measurement data
 # https://iot.mi.com/new/doc/embedded-development/ble/object-definition
 def obj0003(xobj):
@@ -134,37 +253,11 @@ def obj0003(xobj):
 def obj0006(xobj):
     # Fingerprint
     if len(xobj) == 5:
-        key_id = xobj[0:4]
-        match_byte = xobj[4]
-        if key_id == b'\x00\x00\x00\x00':
-            key_id = "administrator"
-        elif key_id == b'\xff\xff\xff\xff':
-            key_id = "unknown operator"
-        else:
-            key_id = int.from_bytes(key_id, 'little')
-        if match_byte == 0x00:
-            result = "match successful"
-        elif match_byte == 0x01:
-            result = "match failed"
-        elif match_byte == 0x02:
-            result = "timeout"
-        elif match_byte == 0x033:
-            result = "low quality (too light, fuzzy)"
-        elif match_byte == 0x04:
-            result = "insufficient area"
-        elif match_byte == 0x05:
-            result = "skin is too dry"
-        elif match_byte == 0x06:
-            result = "skin is too wet"
-        else:
-            result = None
-
-        fingerprint = 1 if match_byte == 0x00 else 0
-
+        (key_id, match_byte) = FINGERPRINT_STRUCT.unpack(xobj)
         return {
-            "fingerprint": fingerprint,
-            "result": result,
-            "key id": key_id,
+            "fingerprint": 1 if match_byte == 0x00 else 0,
+            "result": FINGERPRINT_RESULT.get(match_byte),
+            "key id": FINGERPRINT_KEY_ID.get(key_id, key_id),
         }
     else:
         return {}
@@ -181,11 +274,9 @@ def obj0010(xobj):
 def obj000b(xobj):
     # Lock
     if len(xobj) == 9:
-        action = xobj[0] & 0x0F
-        method = xobj[0] >> 4
-        key_id = int.from_bytes(xobj[1:5], 'little')
-        timestamp = int.from_bytes(xobj[5:], 'little')
-
+        (action_method, key_id, timestamp) = LOCK_STRUCT.unpack(xobj)
+        action = action_method & 0x0F
+        method = action_method >> 4
 
         # all keys except Bluetooth have only 65536 values
         error = BLE_LOCK_ERROR.get(key_id)
@@ -197,8 +288,7 @@ def obj000b(xobj):
         if action not in BLE_LOCK_ACTION or method not in BLE_LOCK_METHOD:
             return {}
 
-        lock = BLE_LOCK_ACTION[action][0]
-        action = BLE_LOCK_ACTION[action][1]
+        (lock, action) = BLE_LOCK_ACTION[action]
         method = BLE_LOCK_METHOD[method]
 
         return {
@@ -213,193 +303,151 @@ def obj000b(xobj):
         return {}
 
 
-def obj000f(xobj, device_type):
+def obj000f_light(xobj):
     # Moving with light
+    # MJYD02YL:  1 - moving no light, 100 - moving with light
+    # RTCGQ02LM: 0 - moving no light, 256 - moving with light
     if len(xobj) == 3:
-        (value,) = LIGHT_STRUCT.unpack(xobj + b'\x00')
-
-        if device_type in ["MJYD02YL", "RTCGQ02LM"]:
-            # MJYD02YL:  1 - moving no light, 100 - moving with light
-            # RTCGQ02LM: 0 - moving no light, 256 - moving with light
-            return {"motion": 1, "motion timer": 1, "light": int(value >= 100)}
-        elif device_type == "CGPR1":
-            # CGPR1:     moving, value is illumination in lux
-            return {"motion": 1, "motion timer": 1, "illuminance": value, "light": int(value >= 100)}
-        else:
-            return {}
+        value = int.from_bytes(xobj, 'little')
+        return {"motion": 1, "motion timer": 1, "light": int(value >= 100)}
     else:
         return {}
 
 
-def obj1001(xobj, device_type):
+def obj000f_illuminance(xobj):
+    # Moving with light
+    # CGPR1:     moving, value is illumination in lux
     if len(xobj) == 3:
-        (button_type, value, press) = BUTTON_STRUCT.unpack(xobj)
-
-        # remote command and remote binary
-        remote_command = None
-        fan_remote_command = None
-        ven_fan_remote_command = None
-        bathroom_remote_command = None
-        one_btn_switch = None
-        two_btn_switch_left = None
-        two_btn_switch_right = None
-        three_btn_switch_left = None
-        three_btn_switch_middle = None
-        three_btn_switch_right = None
-        cube_direction = None
-        remote_binary = None
+        value = int.from_bytes(xobj, 'little')
+        return {"motion": 1, "motion timer": 1, "illuminance": value, "light": int(value >= 100)}
+    else:
+        return {}
 
+
+def obj000f_unsupported(xobj):
+    return {}
+
+
+# {device type: moving with light decoder}
+OBJ000F_DEVICES = {
+    "MJYD02YL": obj000f_light,
+    "RTCGQ02LM": obj000f_light,
+    "CGPR1": obj000f_illuminance,
+}
+
+
+def obj000f(xobj, device_type):
+    # Moving with light
+    return OBJ000F_DEVICES.get(device_type, obj000f_unsupported)(xobj)
+
+
+def button_press(button_type, value, press):
+    """Return the press type and the dimmer value of a button object."""
+    if press == 3:
         if button_type == 0:
-            remote_command = "on"
-            fan_remote_command = "fan toggle"
-            ven_fan_remote_command = "swing"
-            bathroom_remote_command = "stop"
-            one_btn_switch = "toggle"
-            two_btn_switch_left = "toggle"
-            three_btn_switch_left = "toggle"
-            cube_direction = "right"
-            remote_binary = 1
-        elif button_type == 1:
-            remote_command = "off"
-            fan_remote_command = "light toggle"
-            ven_fan_remote_command = "power toggle"
-            bathroom_remote_command = "air exchange"
-            two_btn_switch_right = "toggle"
-            three_btn_switch_middle = "toggle"
-            cube_direction = "left"
-            remote_binary = 0
-        elif button_type == 2:
-            remote_command = "sun"
-            fan_remote_command = "wind speed"
-            ven_fan_remote_command = "timer 60 minutes"
-            bathroom_remote_command = "fan"
-            two_btn_switch_left = "toggle"
-            two_btn_switch_right = "toggle"
-            three_btn_switch_right = "toggle"
-            remote_binary = None
-        elif button_type == 3:
-            remote_command = "+"
-            fan_remote_command = "color temperature"
-            ven_fan_remote_command = "strong wind speed"
-            bathroom_remote_command = "speed +"
-            three_btn_switch_left = "toggle"
-            three_btn_switch_middle = "toggle"
-            remote_binary = 1
-        elif button_type == 4:
-            remote_command = "m"
-            fan_remote_command = "wind mode"
-            ven_fan_remote_command = "timer 30 minutes"
-            bathroom_remote_command = "speed -"
-            three_btn_switch_middle = "toggle"
-            three_btn_switch_right = "toggle"
-            remote_binary = None
-        elif button_type == 5:
-            remote_command = "-"
-            fan_remote_command = "brightness"
-            ven_fan_remote_command = "low wind speed"
-            bathroom_remote_command = "dry"
-            three_btn_switch_left = "toggle"
-            three_btn_switch_right = "toggle"
-            remote_binary = 1
-        elif button_type == 6:
-            bathroom_remote_command = "light toggle"
-            three_btn_switch_left = "toggle"
-            three_btn_switch_middle = "toggle"
-            three_btn_switch_right = "toggle"
-        elif button_type == 7:
-            bathroom_remote_command = "swing"
-        elif button_type == 8:
-            bathroom_remote_command = "heat"
-
-        # press type and dimmer
-        button_press_type = "no press"
-        btn_switch_press_type = "no press"
-        dimmer = None
-
-        if press == 0:
-            button_press_type = "single press"
-            btn_switch_press_type = "single press"
-        elif press == 1:
-            button_press_type = "double press"
-            btn_switch_press_type = "long press"
-        elif press == 2:
-            button_press_type = "long press"
-            btn_switch_press_type = "double press"
-        elif press == 3:
-            if button_type == 0:
-                button_press_type = "short press"
-                dimmer = value
-            if button_type == 1:
-                button_press_type = "long press"
-                dimmer = value
-        elif press == 4:
-            if button_type == 0:
-                if value <= 127:
-                    button_press_type = "rotate right"
-                    dimmer = value
-                else:
-                    button_press_type = "rotate left"
-                    dimmer = 256 - value
-            elif button_type <= 127:
-                button_press_type = "rotate right (pressed)"
-                dimmer = button_type
-            else:
-                button_press_type = "rotate left (pressed)"
-                dimmer = 256 - button_type
-        elif press == 5:
-            button_press_type = "short press"
-        elif press == 6:
-            button_press_type = "long press"
-
-        # return device specific output
-        result = {}
-        if device_type in ["RTCGQ02LM", "YLAI003", "JTYJGD03MI", "SJWS01LM"]:
-            result["button"] = button_press_type
-        elif device_type == "XMMF01JQD":
-            result["button"] = cube_direction
-        elif device_type == "YLYK01YL":
-            result["remote"] = remote_command
-            result["button"] = button_press_type
-            if remote_binary is not None:
-                if button_press_type == "single press":
-                    result["remote single press"] = remote_binary
-                else:
-                    result["remote long press"] = remote_binary
-        elif device_type == "YLYK01YL-FANRC":
-            result["fan remote"] = fan_remote_command
-            result["button"] = button_press_type
-        elif device_type == "YLYK01YL-VENFAN":
-            result["ventilator fan remote"] = ven_fan_remote_command
-            result["button"] = button_press_type
-        elif device_type == "YLYB01YL-BHFRC":
-            result["bathroom heater remote"] = bathroom_remote_command
-            result["button"] = button_press_type
-        elif device_type == "YLKG07YL/YLKG08YL":
-            result["dimmer"] = dimmer
-            result["button"] = button_press_type
-        elif device_type == "K9B-1BTN":
-            result["button switch"] = btn_switch_press_type
-            result["1_btn_switch"] = one_btn_switch
-        elif device_type == "K9B-2BTN":
-            result["button switch"] = btn_switch_press_type
-            if two_btn_switch_left:
-                result["2_btn_switch_left"] = two_btn_switch_left
-            if two_btn_switch_right:
-                result["2_btn_switch_right"] = two_btn_switch_right
-        elif device_type == "K9B-3BTN":
-            result["button switch"] = btn_switch_press_type
-            if three_btn_switch_left:
-                result["3_btn_switch_left"] = three_btn_switch_left
-            if three_btn_switch_middle:
-                result["3_btn_switch_middle"] = three_btn_switch_middle
-            if three_btn_switch_right:
-                result["3_btn_switch_right"] = three_btn_switch_right
+            return "short press", value
+        if button_type == 1:
+            return "long press", value
+        return "no press", None
+    if press == 4:
+        if button_type == 0:
+            if value <= 127:
+                return "rotate right", value
+            return "rotate left", 256 - value
+        if button_type <= 127:
+            return "rotate right (pressed)", button_type
+        return "rotate left (pressed)", 256 - button_type
+    return BUTTON_PRESS_TYPE.get(press, "no press"), None
+
+
+def button_result(button_type, value, press):
+    return {"button": button_press(button_type, value, press)[0]}
+
+
+def cube_result(button_type, value, press):
+    return {"button": CUBE_DIRECTION.get(button_type)}
+
+
+def remote_result(button_type, value, press):
+    button_press_type = button_press(button_type, value, press)[0]
+    result = {"remote": REMOTE_COMMAND.get(button_type), "button": button_press_type}
+    remote_binary = REMOTE_BINARY.get(button_type)
+    if remote_binary is not None:
+        if button_press_type == "single press":
+            result["remote single press"] = remote_binary
         else:
-            return None
+            result["remote long press"] = remote_binary
+    return result
+
+
+def command_remote_result(key, commands):
+    """Return the result function of a remote with a {button type: command} table."""
+    def result(button_type, value, press):
+        return {key: commands.get(button_type), "button": button_press(button_type, value, press)[0]}
+    return result
+
+
+def dimmer_result(button_type, value, press):
+    (button_press_type, dimmer) = button_press(button_type, value, press)
+    return {"dimmer": dimmer, "button": button_press_type}
+
+
+def one_btn_switch_result(button_type, value, press):
+    return {
+        "button switch": BUTTON_SWITCH_PRESS_TYPE.get(press, "no press"),
+        "1_btn_switch": "toggle" if button_type == 0 else None,
+    }
+
+
+def btn_switch_result(toggles):
+    """Return the result function of a switch with a {button type: toggled switches} table."""
+    def result(button_type, value, press):
+        result = {"button switch": BUTTON_SWITCH_PRESS_TYPE.get(press, "no press")}
+        for switch in toggles.get(button_type, ()):
+            result[switch] = "toggle"
         return result
+    return result
 
-    else:
-        return None
+
+def button_decoder(result):
+    """Return the decoder of button objects (0x1001) for a device specific result function."""
+    unpack = BUTTON_STRUCT.unpack
+
+    def decoder(xobj):
+        if len(xobj) == 3:
+            return result(*unpack(xobj))
+        else:
+            return None
+    return decoder
+
+
+def obj1001_unsupported(xobj):
+    return None
+
+
+# {device type: button object decoder}
+OBJ1001_DEVICES = {
+    device_type: button_decoder(result) for device_type, result in {
+        "RTCGQ02LM": button_result,
+        "YLAI003": button_result,
+        "JTYJGD03MI": button_result,
+        "SJWS01LM": button_result,
+        "XMMF01JQD": cube_result,
+        "YLYK01YL": remote_result,
+        "YLYK01YL-FANRC": command_remote_result("fan remote", FAN_REMOTE_COMMAND),
+        "YLYK01YL-VENFAN": command_remote_result("ventilator fan remote", VEN_FAN_REMOTE_COMMAND),
+        "YLYB01YL-BHFRC": command_remote_result("bathroom heater remote", BATHROOM_REMOTE_COMMAND),
+        "YLKG07YL/YLKG08YL": dimmer_result,
+        "K9B-1BTN": one_btn_switch_result,
+        "K9B-2BTN": btn_switch_result(TWO_BTN_SWITCH),
+        "K9B-3BTN": btn_switch_result(THREE_BTN_SWITCH),
+    }.items()
+}
+
+
+def obj1001(xobj, device_type):
+    # Button
+    return OBJ1001_DEVICES.get(device_type, obj1001_unsupported)(xobj)
 
 
 def obj1004(xobj):
@@ -427,7 +475,7 @@ def obj1006(xobj):
 def obj1007(xobj):
     # Illuminance
     if len(xobj) == 3:
-        (illum,) = ILL_STRUCT.unpack(xobj + b'\x00')
+        illum = int.from_bytes(xobj, 'little')
         return {"illuminance": illum, "light": 1 if illum == 100 else 0}
     else:
         return {}
@@ -601,47 +649,119 @@ xiaomi_dataobject_dict = {
 }
 
 
+def compile_object_decoders(device_types):
+    """Return the {(dataobject id, device type): decoder} table, with the device specific decoders resolved."""
+    decoders = {}
+    for device_type in device_types:
+        for obj_typecode, decoder in xiaomi_dataobject_dict.items():
+            decoders[obj_typecode, device_type] = decoder
+        decoders[0x000F, device_type] = OBJ000F_DEVICES.get(device_type, obj000f_unsupported)
+        decoders[0x1001, device_type] = OBJ1001_DEVICES.get(device_type, obj1001_unsupported)
+    return decoders
+
+
+XIAOMI_OBJECT_DECODERS = compile_object_decoders(set(XIAOMI_TYPE_DICT.values()))
+
+
+class XiaomiReading(Reading):
+    """Reading of a Xiaomi MiBeacon device, with the decoded objects in values."""
+    __slots__ = ("address", "rssi", "device_type", "packet", "firmware", "data", "values", "pending")
+    KEYS = {
+        "rssi": "rssi",
+        "mac": "mac",
+        "type": "device_type",
+        "packet": "packet",
+        "firmware": "firmware",
+        "data": "data",
+    }
+
+    def __init__(self, address, rssi, device_type, packet, firmware, data=False, values=None):
+        self.address = address
+        self.rssi = rssi
+        self.device_type = device_type
+        self.packet = packet
+        self.firmware = firmware
+        self.data = data
+        self.values = {} if values is None else values
+        # decryption job while the payload waits for decryption
+        self.pending = None
+
+    @property
+    def mac(self):
+        return format_mac(self.address)
+
+    def as_dict(self):
+        result = Reading.as_dict(self)
+        result.update(self.values)
+        return result
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            return getattr(self, self.KEYS[key])
+        return self.values[key]
+
+
+def mibeacon_info(frctrl, device_id, device_type, packet_id):
+    """Return the frame control and device fields of a MiBeacon frame, for diagnostics."""
+    return {
+        "version": frctrl >> 12,
+        "device_id": device_id,
+        "device_type": device_type,
+        "frame_counter": packet_id,
+        "request_timing": bool(frctrl & 1),
+        "registered": bool((frctrl >> 8) & 1),
+        "solicited": bool((frctrl >> 9) & 1),
+        "auth_mode": MIBEACON_AUTH_MODES[(frctrl >> 10) & 3],
+        "encrypted": bool((frctrl >> 3) & 1),
+    }
+
+
 def parse_xiaomi(self, data, source_mac, rssi):
     # check for adstruc length
     i = 9  # till Frame Counter
     msg_length = len(data)
     if msg_length < i:
-        _LOGGER.debug("Invalid data length (initial check), adv: %s", data.hex())
+        self.metrics.drop(DROP_INVALID_PAYLOAD)
+        if self.diagnostics:
+            self.diagnose("xiaomi", "Invalid data length (initial check)", adv=data.hex())
         return None
 
     # extract frame control bits
     frctrl = data[4] + (data[5] << 8)
     frctrl_mesh = (frctrl >> 7) & 1  # mesh device
     frctrl_version = frctrl >> 12  # version
-    frctrl_auth_mode = (frctrl >> 10) & 3
-    frctrl_solicited = (frctrl >> 9) & 1
-    frctrl_registered = (frctrl >> 8) & 1
     frctrl_object_include = (frctrl >> 6) & 1
     frctrl_capability_include = (frctrl >> 5) & 1
     frctrl_mac_include = (frctrl >> 4) & 1  # check for MAC address in data
     frctrl_is_encrypted = (frctrl >> 3) & 1  # check for encryption being used
-    frctrl_request_timing = frctrl & 1  # old version
 
     # Check that device is not of mesh type
     if frctrl_mesh != 0:
-        _LOGGER.debug("Xiaomi device data is a mesh type device, which is not supported. Data: %s", data.hex())
+        self.metrics.drop(DROP_UNSUPPORTED)
+        if self.diagnostics:
+            self.diagnose("xiaomi", "Xiaomi device data is a mesh type device, which is not supported", adv=data.hex())
         return None
 
     # Check that version is 2 or higher
     if frctrl_version < 2:
-        _LOGGER.debug("Xiaomi device data is using old data format, which is not supported. Data: %s", data.hex())
+        self.metrics.drop(DROP_UNSUPPORTED)
+        if self.diagnostics:
+            self.diagnose("xiaomi", "Xiaomi device data is using old data format, which is not supported", adv=data.hex())
         return None
 
     # Check that MAC in data is the same as the source MAC
     if frctrl_mac_include != 0:
         i += 6
         if msg_length < i:
-            _LOGGER.debug("Invalid data length (in MAC check), adv: %s", data.hex())
+            self.metrics.drop(DROP_INVALID_PAYLOAD)
+            if self.diagnostics:
+                self.diagnose("xiaomi", "Invalid data length (in MAC check)", adv=data.hex())
             return None
-        xiaomi_mac_reversed = data[9:15]
-        xiaomi_mac = xiaomi_mac_reversed[::-1]
+        xiaomi_mac = int.from_bytes(data[9:15], "little")
         if xiaomi_mac != source_mac:
-            _LOGGER.debug("Xiaomi MAC address doesn't match data MAC address. Data: %s", data.hex())
+            self.metrics.drop(DROP_MAC_MISMATCH)
+            if self.diagnostics:
+                self.diagnose("xiaomi", "Xiaomi MAC address doesn't match data MAC address", adv=data.hex())
             return None
     else:
         xiaomi_mac = source_mac
@@ -651,6 +771,7 @@ def parse_xiaomi(self, data, source_mac, rssi):
     try:
         device_type = XIAOMI_TYPE_DICT[device_id]
     except KeyError:
+        self.metrics.drop(DROP_UNKNOWN_DEVICE)
         if self.report_unknown == "Xiaomi":
             _LOGGER.info(
                 "BLE ADV from UNKNOWN Xiaomi device: RSSI: %s, MAC: %s, ADV: %s",
@@ -658,33 +779,16 @@ def parse_xiaomi(self, data, source_mac, rssi):
                 to_mac(source_mac),
                 data.hex()
             )
-        _LOGGER.debug("Unknown Xiaomi device found. Data: %s", data.hex())
+        if self.diagnostics:
+            self.diagnose("xiaomi", "Unknown Xiaomi device found", adv=data.hex())
         return None
 
     packet_id = data[8]
 
-    sinfo = 'MiVer: ' + str(frctrl_version)
-    sinfo += ', DevID: ' + hex(device_id) + ' : ' + device_type
-    sinfo += ', FnCnt: ' + str(packet_id)
-    if frctrl_request_timing != 0:
-        sinfo += ', Request timing'
-    if frctrl_registered != 0:
-        sinfo += ', Registered and bound'
+    if self.diagnostics:
+        info = mibeacon_info(frctrl, device_id, device_type, packet_id)
     else:
-        sinfo += ', Not bound'
-    if frctrl_solicited != 0:
-        sinfo += ', Request APP to register and bind'
-    if frctrl_auth_mode == 0:
-        sinfo += ', Old version certification'
-    elif frctrl_auth_mode == 1:
-        sinfo += ', Safety certification'
-    elif frctrl_auth_mode == 2:
-        sinfo += ', Standard certification'
-
-    # check for MAC presence in sensor whitelist, if needed
-    if self.discovery is False and xiaomi_mac not in self.sensor_whitelist:
-        _LOGGER.debug("Discovery is disabled. MAC: %s is not whitelisted!", to_mac(xiaomi_mac))
-        return None
+        info = None
 
     # check for unique packet_id and advertisement priority
     try:
@@ -708,6 +812,7 @@ def parse_xiaomi(self, data, source_mac, rssi):
             # only process messages with same priority that have a unique packet id
             if prev_packet == packet_id:
                 if self.filter_duplicates is True:
+                    self.metrics.drop(DROP_DUPLICATE)
                     return None
                 else:
                     pass
@@ -717,11 +822,13 @@ def parse_xiaomi(self, data, source_mac, rssi):
             # do not process advertisements with lower priority (ATC advertisements will be used instead)
             prev_adv_priority -= 1
             self.adv_priority[xiaomi_mac] = prev_adv_priority
+            self.metrics.drop(DROP_LOW_PRIORITY)
             return None
     else:
         if prev_packet == packet_id:
             if self.filter_duplicates is True:
                 # only process messages with highest priority and messages with unique packet id
+                self.metrics.drop(DROP_DUPLICATE)
                 return None
     self.lpacket_ids[xiaomi_mac] = packet_id
 
@@ -729,157 +836,253 @@ def parse_xiaomi(self, data, source_mac, rssi):
     if frctrl_capability_include != 0:
         i += 1
         if msg_length < i:
-            _LOGGER.debug("Invalid data length (in capability check), adv: %s", data.hex())
+            self.metrics.drop(DROP_INVALID_PAYLOAD)
+            if self.diagnostics:
+                self.diagnose("xiaomi", "Invalid data length (in capability check)", adv=data.hex())
             return None
         capability_types = data[i - 1]
-        sinfo += ', Capability: ' + hex(capability_types)
+        if info is not None:
+            info["capability"] = capability_types
         if (capability_types & 0x20) != 0:
             i += 1
             if msg_length < i:
-                _LOGGER.debug("Invalid data length (in capability type check), adv: %s", data.hex())
+                self.metrics.drop(DROP_INVALID_PAYLOAD)
+                if self.diagnostics:
+                    self.diagnose("xiaomi", "Invalid data length (in capability type check)", adv=data.hex())
                 return None
             capability_io = data[i - 1]
-            sinfo += ', IO: ' + hex(capability_io)
+            if info is not None:
+                info["io"] = capability_io
 
     # check that data contains object
     if frctrl_object_include != 0:
         # check for encryption
         if frctrl_is_encrypted != 0:
-            sinfo += ', Encryption'
             firmware = "Xiaomi (MiBeacon V" + str(frctrl_version) + " encrypted)"
             if frctrl_version <= 3:
-                payload = decrypt_mibeacon_legacy(self, data, i, xiaomi_mac)
+                job = decryption_job_legacy(self, data, i, xiaomi_mac)
             else:
-                payload = decrypt_mibeacon_v4_v5(self, data, i, xiaomi_mac)
+                job = decryption_job_v4_v5(self, data, i, xiaomi_mac)
+            if self.defer_decryption and job is not None:
+                # decrypted later by a DecryptionStage
+                result = XiaomiReading(xiaomi_mac, rssi, device_type, packet_id, firmware)
+                result.pending = job
+                if info is not None:
+                    self.diagnose("xiaomi", "MiBeacon frame", **info)
+                return result
+            payload = decrypt_job(self, job, xiaomi_mac)
         else:   # No encryption
             # check minimum advertisement length with data
             firmware = "Xiaomi (MiBeacon V" + str(frctrl_version) + ")"
-            sinfo += ', No encryption'
             if msg_length < i + 3:
-                _LOGGER.debug("Invalid data length (in non-encrypted data), adv: %s", data.hex())
+                self.metrics.drop(DROP_INVALID_PAYLOAD)
+                if self.diagnostics:
+                    self.diagnose("xiaomi", "Invalid data length (in non-encrypted data)", adv=data.hex())
                 return None
             payload = data[i:]
     else:
         # data does not contain Object
-        _LOGGER.debug("Advertisement doesn't contain payload, adv: %s", data.hex())
+        self.metrics.drop(DROP_INVALID_PAYLOAD)
+        if self.diagnostics:
+            self.diagnose("xiaomi", "Advertisement doesn't contain payload", adv=data.hex())
         return None
 
-    result = {
-        "rssi": rssi,
-        "mac": ''.join('{:02X}'.format(x) for x in xiaomi_mac),
-        "type": device_type,
-        "packet": packet_id,
-        "firmware": firmware,
-        "data": False,
-    }
+    result = XiaomiReading(xiaomi_mac, rssi, device_type, packet_id, firmware)
 
     if payload is not None:
-        result.update({"data": True})
-        sinfo += ', Object data: ' + payload.hex()
-        # loop through parse_xiaomi payload
-        payload_start = 0
-        payload_length = len(payload)
-        # assume that the data may have several values of different types
-        while payload_length >= payload_start + 3:
-            obj_typecode = payload[payload_start] + (payload[payload_start + 1] << 8)
-            obj_length = payload[payload_start + 2]
-            next_start = payload_start + 3 + obj_length
-            if payload_length < next_start:
-                _LOGGER.debug("Invalid payload data length, payload: %s", payload.hex())
-                break
-            object = payload[payload_start + 3:next_start]
-            if obj_length != 0:
-                resfunc = xiaomi_dataobject_dict.get(obj_typecode, None)
-                if resfunc:
-                    if hex(obj_typecode) in ["0x1001", "0xf"]:
-                        result.update(resfunc(object, device_type))
-                    else:
-                        result.update(resfunc(object))
-                else:
-                    if self.report_unknown == "Xiaomi":
-                        _LOGGER.info("%s, UNKNOWN dataobject in payload! Adv: %s", sinfo, data.hex())
-            payload_start = next_start
+        result.data = True
+        if info is not None:
+            info["object_data"] = payload.hex()
+        result.values = parse_payload(self, payload, device_type)
+    if info is not None:
+        self.diagnose("xiaomi", "MiBeacon frame", **info)
 
     return result
 
 
-def decrypt_mibeacon_v4_v5(self, data, i, xiaomi_mac):
-    # check for minimum length of encrypted advertisement
-    if len(data) < i + 9:
-        _LOGGER.debug("Invalid data length (for decryption), adv: %s", data.hex())
+def parse_payload(self, payload, device_type):
+    """Decode the objects of a (decrypted) MiBeacon payload."""
+    values = {}
+    decoders = XIAOMI_OBJECT_DECODERS
+    # loop through parse_xiaomi payload
+    payload_start = 0
+    payload_length = len(payload)
+    # assume that the data may have several values of different types
+    while payload_length >= payload_start + 3:
+        obj_typecode = payload[payload_start] + (payload[payload_start + 1] << 8)
+        obj_length = payload[payload_start + 2]
+        next_start = payload_start + 3 + obj_length
+        if payload_length < next_start:
+            if self.diagnostics:
+                self.diagnose("xiaomi", "Invalid payload data length", payload=payload.hex())
+            break
+        object = payload[payload_start + 3:next_start]
+        if obj_length != 0:
+            resfunc = decoders.get((obj_typecode, device_type))
+            if resfunc:
+                decoded = resfunc(object)
+                if decoded:
+                    values.update(decoded)
+            else:
+                if self.report_unknown == "Xiaomi":
+                    _LOGGER.info(
+                        "UNKNOWN dataobject 0x%04X in payload of %s! Payload: %s",
+                        obj_typecode, device_type, payload.hex()
+                    )
+        payload_start = next_start
+    return values
+
+
+def cipher_factory(self, xiaomi_mac, key_length):
+    """Return a cached AES-CCM cipher factory for a device, None without a usable key."""
+    try:
+        return self.aes_ciphers[xiaomi_mac]
+    except KeyError:
+        pass
     # try to find encryption key for current device
     try:
-        key = self.aeskeys[xiaomi_mac]
-        if len(key) != 16:
-            _LOGGER.error("Encryption key should be 16 bytes (32 characters) long")
-            return None
+        aeskey = self.aeskeys[xiaomi_mac]
     except KeyError:
         # no encryption key found
-        _LOGGER.error("No encryption key found for device with MAC %s", to_mac(xiaomi_mac))
+        decryption_failed(self, xiaomi_mac, "No encryption key found", permanent=True)
         return None
+    if len(aeskey) != key_length:
+        decryption_failed(
+            self, xiaomi_mac, "Encryption key should be %s bytes (%s characters) long",
+            key_length, 2 * key_length, permanent=True
+        )
+        return None
+    if key_length == 12:
+        # legacy MiBeacon key
+        aeskey = b"".join([aeskey[0:6], bytes.fromhex("8d3d3c97"), aeskey[6:]])
+    AES = load_aes()
+    if AES is None:
+        self.metrics.drop(DROP_DECRYPTION_FAILED)
+        return None
+    factory = partial(AES.new, aeskey, AES.MODE_CCM, mac_len=4)
+    self.aes_ciphers[xiaomi_mac] = factory
+    return factory
 
-    nonce = b"".join([xiaomi_mac[::-1], data[6:9], data[-7:-4]])
-    aad = b"\x11"
-    token = data[-4:]
-    cipherpayload = data[i:-7]
-    cipher = AES.new(key, AES.MODE_CCM, nonce=nonce, mac_len=4)
-    cipher.update(aad)
 
+def decryption_blocked(self, xiaomi_mac):
+    """Return True while the encrypted advertisements of a device are ignored."""
     try:
-        decrypted_payload = cipher.decrypt_and_verify(cipherpayload, token)
-    except ValueError as error:
-        _LOGGER.warning("Decryption failed: %s", error)
-        _LOGGER.debug("token: %s", token.hex())
-        _LOGGER.debug("nonce: %s", nonce.hex())
-        _LOGGER.debug("cipherpayload: %s", cipherpayload.hex())
-        return None
-    if decrypted_payload is None:
+        failures = self.aes_failures[xiaomi_mac]
+    except KeyError:
+        return False
+    return failures[1] > time.monotonic()
+
+
+def decryption_failed(self, xiaomi_mac, message, *args, permanent=False):
+    """Count a decryption failure, ignore the device for a while after repeated failures.
+
+    The backoff starts at decrypt_backoff seconds and doubles each time the
+    device fails again, up to decrypt_max_backoff. Only entering a backoff is
+    logged as an error.
+    """
+    try:
+        failures = self.aes_failures[xiaomi_mac]
+    except KeyError:
+        # [consecutive failures, ignored until, backoff]
+        failures = self.aes_failures[xiaomi_mac] = [0, 0.0, 0.0]
+    failures[0] += 1
+    self.metrics.drop(DROP_DECRYPTION_FAILED)
+    if permanent or failures[0] >= self.decrypt_max_failures:
+        failures[2] = min(2 * failures[2], self.decrypt_max_backoff) if failures[2] else self.decrypt_backoff
+        failures[1] = time.monotonic() + failures[2]
         _LOGGER.error(
-            "Decryption failed for %s, decrypted payload is None",
-            to_mac(xiaomi_mac),
+            message + " for device with MAC %s, ignoring its encrypted advertisements for %s s",
+            *args, to_mac(xiaomi_mac), failures[2]
         )
+    elif self.diagnostics:
+        self.diagnose("xiaomi", message % args, mac=to_mac(xiaomi_mac), failures=failures[0])
+
+
+def decryption_job_v4_v5(self, data, i, xiaomi_mac):
+    """Return (cipher factory, nonce, cipherpayload, token) for a MiBeacon V4/V5 advertisement."""
+    # check for minimum length of encrypted advertisement
+    if len(data) < i + 9:
+        if self.diagnostics:
+            self.diagnose("xiaomi", "Invalid data length (for decryption)", adv=data.hex())
+    if decryption_blocked(self, xiaomi_mac):
+        self.metrics.drop(DROP_DECRYPTION_BLOCKED)
         return None
-    return decrypted_payload
+    new_cipher = cipher_factory(self, xiaomi_mac, 16)
+    if new_cipher is None:
+        return None
+    nonce = b"".join([xiaomi_mac.to_bytes(6, "little"), data[6:9], data[-7:-4]])
+    return new_cipher, nonce, bytes(data[i:-7]), bytes(data[-4:])
 
 
-def decrypt_mibeacon_legacy(self, data, i, xiaomi_mac):
+def decryption_job_legacy(self, data, i, xiaomi_mac):
+    """Return (cipher factory, nonce, cipherpayload, None) for a legacy MiBeacon advertisement."""
     # check for minimum length of encrypted advertisement
     if len(data) < i + 7:
-        _LOGGER.debug("Invalid data length (for decryption), adv: %s", data.hex())
-    # try to find encryption key for current device
-    try:
-        aeskey = self.aeskeys[xiaomi_mac]
-        if len(aeskey) != 12:
-            _LOGGER.error("Encryption key should be 12 bytes (24 characters) long")
-            return None
-        key = b"".join([aeskey[0:6], bytes.fromhex("8d3d3c97"), aeskey[6:]])
-    except KeyError:
-        # no encryption key found
-        _LOGGER.error("No encryption key found for device with MAC %s", to_mac(xiaomi_mac))
+        if self.diagnostics:
+            self.diagnose("xiaomi", "Invalid data length (for decryption)", adv=data.hex())
+    if decryption_blocked(self, xiaomi_mac):
+        self.metrics.drop(DROP_DECRYPTION_BLOCKED)
         return None
+    new_cipher = cipher_factory(self, xiaomi_mac, 12)
+    if new_cipher is None:
+        return None
+    nonce = b"".join([data[4:9], data[-4:-1], xiaomi_mac.to_bytes(6, "little")[:-1]])
+    return new_cipher, nonce, bytes(data[i:-4]), None
 
-    nonce = b"".join([data[4:9], data[-4:-1], xiaomi_mac[::-1][:-1]])
-    aad = b"\x11"
-    cipherpayload = data[i:-4]
-    cipher = AES.new(key, AES.MODE_CCM, nonce=nonce, mac_len=4)
-    cipher.update(aad)
 
-    try:
+def run_decryption_job(job):
+    """Decrypt the payload of a decryption job, raise ValueError if it fails.
+
+    Doesn't touch any parser state, so jobs can run on other threads.
+    """
+    new_cipher, nonce, cipherpayload, token = job
+    cipher = new_cipher(nonce=nonce)
+    cipher.update(b"\x11")
+    if token is None:
+        # legacy MiBeacon has no verifiable token
         decrypted_payload = cipher.decrypt(cipherpayload)
-    except ValueError as error:
-        _LOGGER.warning("Decryption failed: %s", error)
-        _LOGGER.debug("nonce: %s", nonce.hex())
-        _LOGGER.debug("cipherpayload: %s", cipherpayload.hex())
-        return None
+    else:
+        decrypted_payload = cipher.decrypt_and_verify(cipherpayload, token)
     if decrypted_payload is None:
-        _LOGGER.warning(
-            "Decryption failed for %s, decrypted payload is None",
-            to_mac(xiaomi_mac),
+        raise ValueError("decrypted payload is None")
+    return decrypted_payload
+
+
+def decryption_done(self, xiaomi_mac, job, error):
+    """Account for the outcome of a decryption job."""
+    if error is None:
+        self.aes_failures.pop(xiaomi_mac, None)
+        return
+    decryption_failed(self, xiaomi_mac, "Decryption failed: %s", error)
+    if self.diagnostics:
+        (_, nonce, cipherpayload, token) = job
+        self.diagnose(
+            "xiaomi", "Decryption failed", mac=to_mac(xiaomi_mac),
+            token=None if token is None else token.hex(), nonce=nonce.hex(), cipherpayload=cipherpayload.hex()
         )
+
+
+def decrypt_job(self, job, xiaomi_mac):
+    """Run a decryption job inline, return the payload or None."""
+    if job is None:
         return None
+    try:
+        decrypted_payload = run_decryption_job(job)
+    except ValueError as error:
+        decryption_done(self, xiaomi_mac, job, error)
+        return None
+    decryption_done(self, xiaomi_mac, job, None)
     return decrypted_payload
 
 
+def decrypt_mibeacon_v4_v5(self, data, i, xiaomi_mac):
+    return decrypt_job(self, decryption_job_v4_v5(self, data, i, xiaomi_mac), xiaomi_mac)
+
+
+def decrypt_mibeacon_legacy(self, data, i, xiaomi_mac):
+    return decrypt_job(self, decryption_job_legacy(self, data, i, xiaomi_mac), xiaomi_mac)
+
+
 def to_mac(addr: int):
     """Return formatted MAC address"""
-    return ':'.join('{:02x}'.format(x) for x in addr).upper()
+    return ':'.join('{:02X}'.format(x) for x in addr.to_bytes(6, 'big'))